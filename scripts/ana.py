@@ -2,7 +2,7 @@ import sys
 from os.path import dirname, abspath
 sys.path.insert(0, dirname(dirname(dirname(abspath(__file__)))))
 
-from typing import List, Dict, Tuple, Set
+from typing import List, Dict, Tuple, Set, Iterator, Collection
 import argparse
 from operator import itemgetter
 import pandas
@@ -11,27 +11,90 @@ from collections import defaultdict
 from tqdm import tqdm
 import os
 import numpy as np
+import multiprocessing
+import hashlib
+import sqlite3
+import shutil
+import json
+import copy
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from matplotlib.ticker import PercentFormatter
 from probe import tokenizer_wrap, LamaPredictions, EvalContext, CsvLogFileContext, load_entity_lang, \
-    DATASET, PROMPT_LANG_PATH
+    DATASET, PROMPT_LANG_PATH, LM_NAME, GoldIndex, file_hash, CompactResult, load_columnar, jsonl_to_columnar, \
+    columnar_to_jsonl
 
 
-def load_result(filename: str) -> List[LamaPredictions]:
-    result: List[Dict] = []
+def load_result(filename: str, compact: bool=False) -> List[LamaPredictions]:
+    return list(iter_result(filename, compact=compact))
+
+
+def iter_result(filename: str, compact: bool=True) -> Iterator[LamaPredictions]:
     pid = filename.rsplit('/', 1)[1].rsplit('.', 1)[0]
+    if filename.endswith('.npz'):
+        for r in load_columnar(filename):
+            yield LamaPredictions(CompactResult(r) if compact else r, pid)
+        return
     with open(filename, 'r') as fin:
         for l in fin:
-            result.append(LamaPredictions.from_str(l, pid))
-    return result
+            yield LamaPredictions.from_str(l, pid, compact=compact)
 
 
-def compute_acc(in_file: str, eval: EvalContext, prettify_out_file: str=None, only_count: bool=False) \
-        -> Tuple[float, float, float, int, int, int]:
-    headers = ['sentence', 'prediction', 'gold', 'is_same', 'confidence', 'is_single_word', 'sub_uri', 'obj_uri']
+RESULT_EXTS = ['.jsonl', '.npz']  # in the order of preference when a relation has files in both formats
+
+
+def is_result_file(filename: str, files: Collection[str]=None) -> bool:
+    '''
+    Whether `filename` is a prediction file. When the other files of the directory (`files`) are given,
+    only the preferred format is used for relations with files in both formats (e.g., after conversion).
+    '''
+    for i, ext in enumerate(RESULT_EXTS):
+        if filename.endswith(ext):
+            relation = filename[:-len(ext)]
+            return files is None or not any(relation + e in files for e in RESULT_EXTS[:i])
+    return False
+
+
+def find_result_file(directory: str, relation: str) -> str:
+    for ext in RESULT_EXTS:
+        if os.path.exists(os.path.join(directory, relation + ext)):
+            return os.path.join(directory, relation + ext)
+    raise FileNotFoundError('no result of {} in {}'.format(relation, directory))
+
+
+def eval_by_fact(filename: str, eval: EvalContext) -> Dict[Tuple[str, str, str], bool]:
+    '''
+    Correctness of the facts in a prediction file indexed by (relation, sub_uri, obj_uri), where predictions
+    are streamed and only the first one of duplicate facts is kept.
+    '''
+    fact2correct: Dict[Tuple[str, str, str], bool] = {}
+    for r in iter_result(filename):
+        if eval.skip_cate and r.is_cate(eval.entity2iscate):
+            continue
+        key = (r.pid, r.result['sub_uri'], r.result['obj_uri'])
+        if key not in fact2correct:
+            fact2correct[key] = r.eval(eval)
+    return fact2correct
+
+
+def compute_acc(in_file: str, eval: EvalContext, prettify_out_file: str=None, only_count: bool=False,
+                fact_out: List[Tuple[str, str, int, int]]=None) -> Tuple[float, float, float, int, int, int]:
     result: List[LamaPredictions] = load_result(in_file)
+    return compute_acc_from_result(
+        result, eval, prettify_out_file=prettify_out_file, only_count=only_count, fact_out=fact_out)
+
+
+def compute_acc_from_result(result: List[LamaPredictions],
+                            eval: EvalContext,
+                            prettify_out_file: str=None,
+                            only_count: bool=False,
+                            fact_out: List[Tuple[str, str, int, int]]=None) -> Tuple[float, float, float, int, int, int]:
+    '''
+    Accuracy of all, single-word, and multi-word facts.
+    (sub_uri, obj_uri, correct, is_single_word) of each evaluated fact is appended to `fact_out` if given.
+    '''
+    headers = ['sentence', 'prediction', 'gold', 'is_same', 'confidence', 'is_single_word', 'sub_uri', 'obj_uri']
     correct = total = 0
     correct_single = total_single = 0
     correct_multi = total_mutli = 0
@@ -46,6 +109,8 @@ def compute_acc(in_file: str, eval: EvalContext, prettify_out_file: str=None, on
                     r.prettify(csv_file, eval)
             correct += right
             total += 1
+            if fact_out is not None:
+                fact_out.append((r.result['sub_uri'], r.result['obj_uri'], right, int(r.is_single_word)))
             if r.is_single_word:
                 correct_single += right
                 total_single += 1
@@ -58,10 +123,277 @@ def compute_acc(in_file: str, eval: EvalContext, prettify_out_file: str=None, on
            total, total_single, total_mutli
 
 
+def parse_eval_configs(configs: str, eval: EvalContext) -> List[Tuple[str, EvalContext]]:
+    '''
+    Parse configurations like "default|norm|norm,gold_len|skip_cate|multi_lang=fr" into contexts
+    which share everything loaded by `eval` and a gold index covering the languages of all configurations.
+    Options not specified in a configuration are off.
+    '''
+    results: List[Tuple[str, EvalContext]] = []
+    for config in configs.split('|'):
+        ctx = copy.copy(eval)
+        ctx.norm = ctx.gold_len = ctx.skip_cate = False
+        ctx.multi_lang = None
+        for option in config.split(','):
+            option = option.strip()
+            if option in {'', 'default'}:
+                continue
+            elif option in {'norm', 'gold_len', 'skip_cate'}:
+                setattr(ctx, option, True)
+            elif option.startswith('multi_lang='):
+                ctx.multi_lang = option.split('=', 1)[1]
+            else:
+                raise ValueError('unknown eval option {}'.format(option))
+        results.append((config, ctx))
+    if eval.gold_index is None:
+        gold_index = GoldIndex()  # in memory
+    else:
+        gold_index = GoldIndex.from_eval(os.path.dirname(eval.gold_index.filename), eval,
+                                         langs=[eval.lang] + [ctx.multi_lang for _, ctx in results])
+    for _, ctx in results:
+        ctx.gold_index = gold_index
+    return results
+
+
+def eval_config_name(eval: EvalContext) -> str:
+    '''
+    The eval configuration of a context in the syntax of `parse_eval_configs`.
+    '''
+    options = [o for o in ['norm', 'gold_len', 'skip_cate'] if getattr(eval, o)]
+    if eval.multi_lang:
+        options.append('multi_lang={}'.format(eval.multi_lang))
+    return ','.join(options) or 'default'
+
+
+class ResultCatalog(object):
+    '''
+    A SQLite catalog of evaluated predictions across runs, with per-relation metrics and per-fact correctness.
+    A run is a directory of prediction files evaluated under an eval configuration.
+    Its model, language, and decoding configuration come from manifest.json (written by probe.py)
+    if it exists, otherwise from the directory name (model__lang) and its parents (decoding configuration).
+    Ingestion is incremental: a relation is only re-evaluated when the hash of its file changes.
+    '''
+    METRICS = ['acc', 'acc_single', 'acc_multi', 'total', 'total_single', 'total_multi']
+    KEYS = ['model', 'lang', 'decode', 'eval', 'relation']  # fields to slice and aggregate by
+    DECODE_ARGS = ['init_method', 'iter_method', 'max_iter', 'beam_size', 'num_mask']
+
+
+    def __init__(self, filename: str):
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY, dir TEXT, model TEXT, lang TEXT, decode TEXT, eval TEXT, manifest TEXT,
+                UNIQUE (dir, eval));
+            CREATE INDEX IF NOT EXISTS runs_config ON runs (model, lang, decode, eval);
+            CREATE TABLE IF NOT EXISTS metrics (
+                run_id INTEGER, relation TEXT, hash TEXT, acc REAL, acc_single REAL, acc_multi REAL,
+                total INTEGER, total_single INTEGER, total_multi INTEGER,
+                PRIMARY KEY (run_id, relation));
+            CREATE INDEX IF NOT EXISTS metrics_relation ON metrics (relation);
+            CREATE TABLE IF NOT EXISTS facts (
+                run_id INTEGER, relation TEXT, sub_uri TEXT, obj_uri TEXT, correct INTEGER, is_single INTEGER);
+            CREATE INDEX IF NOT EXISTS facts_run ON facts (run_id, relation);
+            CREATE INDEX IF NOT EXISTS facts_fact ON facts (relation, sub_uri, obj_uri);
+        ''')
+
+
+    def close(self):
+        self.conn.close()
+
+
+    @classmethod
+    def parse_run_config(cls, run_dir: str, root: str) -> Tuple[str, str, str, Dict]:
+        manifest_file = os.path.join(run_dir, 'manifest.json')
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as fin:
+                manifest = json.load(fin)
+            decode = '_'.join('{}_{}'.format(k, manifest[k]) for k in cls.DECODE_ARGS if k in manifest)
+            if manifest.get('reprob'):
+                decode += '_reprob'
+            return manifest['model'], manifest['lang'], decode, manifest
+        rel_dir = os.path.relpath(os.path.abspath(run_dir), os.path.abspath(root))
+        parts = [p for p in rel_dir.split(os.sep) if p not in {'', '.'}]
+        model = lang = None
+        if len(parts) and '__' in parts[-1]:
+            model, lang = parts.pop().split('__', 1)
+        return model, lang, '/'.join(parts) or 'default', {}
+
+
+    def get_run(self, run_dir: str, eval: str, model: str, lang: str, decode: str, manifest: Dict) -> int:
+        run_dir = os.path.abspath(run_dir)
+        row = self.conn.execute('SELECT id FROM runs WHERE dir = ? AND eval = ?', (run_dir, eval)).fetchone()
+        if row is not None:
+            self.conn.execute('UPDATE runs SET model = ?, lang = ?, decode = ?, manifest = ? WHERE id = ?',
+                              (model, lang, decode, json.dumps(manifest), row[0]))
+            return row[0]
+        return self.conn.execute('INSERT INTO runs (dir, model, lang, decode, eval, manifest) VALUES (?, ?, ?, ?, ?, ?)',
+                                 (run_dir, model, lang, decode, eval, json.dumps(manifest))).lastrowid
+
+
+    def ingest(self, root: str, eval: EvalContext) -> Tuple[int, int]:
+        '''
+        Ingest all runs under root. Return the number of (re-)evaluated and skipped relation files.
+        '''
+        evals: Dict[Tuple[str, str], EvalContext] = {(eval.lm, eval.lang): eval}
+        num_eval = num_skip = 0
+        for run_dir, dirs, files in os.walk(root):
+            files = sorted(f for f in files if is_result_file(f, files))
+            if len(files) == 0:
+                continue
+            model, lang, decode, manifest = self.parse_run_config(run_dir, root)
+            model, lang = model or eval.lm, lang or eval.lang
+            run_eval = evals.get((LM_NAME.get(model, model), lang))
+            if run_eval is None:
+                run_eval = evals[(LM_NAME.get(model, model), lang)] = eval.derive(lang, model)
+            with self.conn:
+                run_id = self.get_run(run_dir, eval_config_name(eval), model, lang, decode, manifest)
+            rel2hash = dict(self.conn.execute('SELECT relation, hash FROM metrics WHERE run_id = ?', (run_id,)))
+            relations = set()
+            for file in files:
+                relation = file.rsplit('.', 1)[0]
+                relations.add(relation)
+                hash = file_hash(os.path.join(run_dir, file))
+                if rel2hash.get(relation) == hash:
+                    num_skip += 1
+                    continue
+                facts: List[Tuple[str, str, int, int]] = []
+                metric = compute_acc(os.path.join(run_dir, file), run_eval, fact_out=facts)
+                with self.conn:
+                    self.delete(run_id, relation)
+                    self.conn.execute('INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                      (run_id, relation, hash) + tuple(metric))
+                    self.conn.executemany('INSERT INTO facts VALUES (?, ?, ?, ?, ?, ?)',
+                                          [(run_id, relation) + f for f in facts])
+                num_eval += 1
+            with self.conn:  # relations whose files are removed
+                for relation in set(rel2hash) - relations:
+                    self.delete(run_id, relation)
+        return num_eval, num_skip
+
+
+    def delete(self, run_id: int, relation: str):
+        self.conn.execute('DELETE FROM metrics WHERE run_id = ? AND relation = ?', (run_id, relation))
+        self.conn.execute('DELETE FROM facts WHERE run_id = ? AND relation = ?', (run_id, relation))
+
+
+    def query(self, filters: Dict[str, str], group_by: List[str]=None, facts: bool=False) -> Tuple[List[str], List]:
+        '''
+        Slice by model, lang, decode, eval, and relation (values joined by ","), where `group_by` averages
+        accuracy over relations (as multi_eval does) and sums the numbers of facts.
+        '''
+        for k in group_by or []:
+            if k not in self.KEYS:
+                raise ValueError('unknown group_by field {}'.format(k))
+        where, params = [], []
+        for k, v in filters.items():
+            if k not in self.KEYS:
+                raise ValueError('unknown filter {}'.format(k))
+            v = v.split(',')
+            where.append('{} IN ({})'.format('m.relation' if k == 'relation' else 'r.' + k, ','.join('?' * len(v))))
+            params.extend(v)
+        where = ' WHERE ' + ' AND '.join(where) if len(where) else ''
+        keys = ['model', 'lang', 'decode', 'eval']
+        if facts:
+            headers = keys + ['relation', 'sub_uri', 'obj_uri', 'correct', 'is_single']
+            sql = 'SELECT {}, m.relation, m.sub_uri, m.obj_uri, m.correct, m.is_single ' \
+                  'FROM facts m JOIN runs r ON m.run_id = r.id'.format(', '.join('r.' + k for k in keys))
+        elif group_by:
+            headers = group_by + ['num_relation'] + self.METRICS
+            sql = 'SELECT {}, COUNT(*), {} FROM metrics m JOIN runs r ON m.run_id = r.id'.format(
+                ', '.join('m.relation' if k == 'relation' else 'r.' + k for k in group_by),
+                ', '.join(('AVG(m.{})' if k.startswith('acc') else 'SUM(m.{})').format(k) for k in self.METRICS))
+        else:
+            headers = keys + ['relation'] + self.METRICS
+            sql = 'SELECT {}, m.relation, {} FROM metrics m JOIN runs r ON m.run_id = r.id'.format(
+                ', '.join('r.' + k for k in keys), ', '.join('m.' + k for k in self.METRICS))
+        sql += where
+        if group_by and not facts:
+            by = ', '.join('m.relation' if k == 'relation' else 'r.' + k for k in group_by)
+            sql += ' GROUP BY {} ORDER BY {}'.format(by, by)
+        return headers, self.conn.execute(sql, params).fetchall()
+
+
+class EvalCache(object):
+    '''
+    Evaluation results of prediction files stored in a directory (one small json file per key, so that concurrent
+    runs can share it) and keyed by the hash of the file, the eval configuration, and the hashes of the data files
+    evaluation depends on (those golds are built from and categories), so that changes of any of them invalidate it.
+    The prettified output read by other tasks can be overwritten by other runs, so its hash is checked on hits.
+    '''
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.data_hash: Dict[str, str] = {}
+        self.num_hit = self.num_miss = 0
+
+
+    def get_data_hash(self, filename: str) -> str:
+        if filename not in self.data_hash:
+            self.data_hash[filename] = file_hash(filename) if os.path.exists(filename) else None
+        return self.data_hash[filename]
+
+
+    def get_key(self, in_file: str, eval: EvalContext, only_count: bool) -> str:
+        data_files = eval.data_files() + [eval.is_cate]
+        key = {
+            'file': file_hash(in_file),
+            'eval': [eval_config_name(eval), eval.probe, eval.lm, eval.lang, eval.uncase,
+                     eval.use_alias, eval.use_multi_rel, eval.use_period, only_count],
+            'data': [self.get_data_hash(f) for f in data_files],
+        }
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+    def compute_acc(self, in_file: str, eval: EvalContext, prettify_out_file: str=None, only_count: bool=False) \
+            -> Tuple[float, float, float, int, int, int]:
+        '''
+        `compute_acc` which is skipped if the result is cached (and the prettified output is the one it wrote).
+        '''
+        cache_file = os.path.join(self.directory, self.get_key(in_file, eval, only_count) + '.json')
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r') as fin:
+                cached = json.load(fin)
+            if prettify_out_file is None or (os.path.exists(prettify_out_file) and
+                                             cached.get('prettify_hash') == file_hash(prettify_out_file)):
+                eval.alias_manager.no_alias_count += cached['no_alias_count']
+                self.num_hit += 1
+                return tuple(cached['metric'])
+        no_alias_count = eval.alias_manager.no_alias_count
+        metric = compute_acc(in_file, eval, prettify_out_file=prettify_out_file, only_count=only_count)
+        temp_file = cache_file + '.{}.tmp'.format(os.getpid())
+        with open(temp_file, 'w') as fout:
+            json.dump({'metric': metric, 'no_alias_count': eval.alias_manager.no_alias_count - no_alias_count,
+                       'prettify_hash': file_hash(prettify_out_file) if prettify_out_file else None}, fout)
+        os.replace(temp_file, cache_file)
+        self.num_miss += 1
+        return metric
+
+
+_eval_contexts: Dict[Tuple[str, str], EvalContext] = {}  # loaded before forking so that workers share them
+_eval_cache: EvalCache = None
+
+
+def compute_acc_worker(task: Tuple[Tuple[str, str], str, str, bool]) -> Tuple[Tuple, int, Dict]:
+    '''
+    Also return the gold index entries built by this task, which are saved by the parent process.
+    '''
+    key, in_file, out_file, only_count = task
+    eval = _eval_contexts[key]
+    no_alias_count = eval.alias_manager.no_alias_count
+    if _eval_cache is not None:
+        result = _eval_cache.compute_acc(in_file, eval, prettify_out_file=out_file, only_count=only_count)
+    else:
+        result = compute_acc(in_file, eval, prettify_out_file=out_file, only_count=only_count)
+    built = eval.gold_index.pop_built() if eval.gold_index is not None else {}
+    return result, eval.alias_manager.no_alias_count - no_alias_count, built
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Analysis')
     parser.add_argument('--task', type=str,
-                        choices=['logprob', 'compare', 'multi_eval', 'reliability', 'rank', 'error', 'overlap', 'plot'],
+                        choices=['logprob', 'compare', 'multi_eval', 'multi_eval_grid', 'multi_config_eval',
+                                 'reliability', 'rank', 'error', 'overlap', 'plot', 'convert', 'multi_compare',
+                                 'catalog_ingest', 'catalog_query'],
                         default='multi_eval')
     parser.add_argument('--lang', type=str, help='language', default='en')
     parser.add_argument('--probe', type=str, help='probe dataset',
@@ -72,6 +404,21 @@ if __name__ == '__main__':
     parser.add_argument('--skip_cate', action='store_true')
     parser.add_argument('--gold_len', action='store_true', help='use the number of tokens in ground truth')
     parser.add_argument('--only_count', action='store_true')
+    parser.add_argument('--gold_index', type=str, help='directory of gold indices reused across runs', default=None)
+    parser.add_argument('--zip_pairs', action='store_true',
+                        help='pair models and languages one by one instead of using all combinations in multi_eval_grid')
+    parser.add_argument('--num_workers', type=int, help='number of processes', default=os.cpu_count())
+    parser.add_argument('--configs', type=str, default='default|norm',
+                        help='eval configurations for multi_config_eval separated by "|", where each one is '
+                             'a list of options (norm, gold_len, skip_cate, multi_lang=xx) joined by ","')
+    parser.add_argument('--eval_cache', type=str, default=None,
+                        help='directory of cached evaluation results of prediction files (multi_eval, multi_eval_grid)')
+    parser.add_argument('--catalog', type=str, help='SQLite file of the results catalog', default=None)
+    parser.add_argument('--filter', type=str, default='',
+                        help='slice the catalog like "model=xlmr_base,mbert_base;lang=el;relation=P19"')
+    parser.add_argument('--group_by', type=str, default=None,
+                        help='aggregate the catalog by fields (model, lang, decode, eval, relation) joined by ","')
+    parser.add_argument('--facts', action='store_true', help='query correctness of facts instead of metrics')
     parser.add_argument('--inp', type=str, help='input')
     parser.add_argument('--out', type=str, help='output')
     args = parser.parse_args()
@@ -98,14 +445,14 @@ if __name__ == '__main__':
         better2ns: List[float] = []
         for root, dirs, files in os.walk(sys1_dir):
             for file in files:
-                if not file.endswith('.jsonl'):
+                if not is_result_file(file, files):
                     continue
                 better1n: List[int] = []
                 better2n: List[int] = []
                 is_single: List[int] = []
                 rel = file.split('.', 1)[0]
                 result1: List[LamaPredictions] = load_result(os.path.join(root, file))
-                result2: List[LamaPredictions] = load_result(os.path.join(sys2_dir, file))
+                result2: List[LamaPredictions] = load_result(find_result_file(sys2_dir, rel))
                 rs: List[LamaPredictions] = []
                 single_count: int = 0
                 for r1, r2 in zip(result1, result2):
@@ -145,8 +492,60 @@ if __name__ == '__main__':
                             r.prettify(csv_file, eval)
         print('#1', np.mean(better1ns), '#2', np.mean(better2ns), sep='\t')
 
+    elif args.task == 'multi_compare':
+        # compare N systems (inp is dir1:dir2:...:dirN) by joining their predictions on facts
+        eval = EvalContext(args)
+        sys_dirs = args.inp.split(':')
+        num_sys = len(sys_dirs)
+        wins = np.zeros((num_sys, num_sys), dtype=np.int64)  # wins[i, j]: #facts system i gets right but j not
+        unique = np.zeros(num_sys, dtype=np.int64)  # #facts only one system gets right
+        correct = np.zeros(num_sys, dtype=np.int64)
+        num_fact = num_unjoined = 0
+        for i, d in enumerate(sys_dirs):
+            print('#{}\t{}'.format(i + 1, d))
+        print('\t'.join(['relation', 'number'] + ['unique#{}'.format(i + 1) for i in range(num_sys)]))
+        sys_files = os.listdir(sys_dirs[0])
+        for file in sorted(sys_files):
+            if not is_result_file(file, sys_files):
+                continue
+            rel = file.rsplit('.', 1)[0]
+            try:
+                files = [os.path.join(sys_dirs[0], file)] + [find_result_file(d, rel) for d in sys_dirs[1:]]
+            except FileNotFoundError as e:
+                print(e)
+                continue
+            # hash join on facts, one relation in memory at a time
+            fact2correct = eval_by_fact(files[0], eval)
+            fact2ind: Dict[Tuple[str, str, str], int] = {f: i for i, f in enumerate(fact2correct)}
+            rel_correct = np.zeros((len(fact2ind), num_sys), dtype=bool)
+            rel_correct[:, 0] = list(fact2correct.values())
+            joined = np.ones(len(fact2ind), dtype=bool)
+            for s, f in enumerate(files[1:], 1):
+                found = np.zeros(len(fact2ind), dtype=bool)
+                for fact, c in eval_by_fact(f, eval).items():
+                    if fact in fact2ind:
+                        found[fact2ind[fact]] = True
+                        rel_correct[fact2ind[fact], s] = c
+                    else:
+                        num_unjoined += 1
+                joined &= found
+            num_unjoined += (~joined).sum()
+            rel_correct = rel_correct[joined]
+            rel_unique = (rel_correct & (rel_correct.sum(1, keepdims=True) == 1)).sum(0)
+            wins += rel_correct.T.astype(np.int64) @ (~rel_correct).astype(np.int64)
+            unique += rel_unique
+            correct += rel_correct.sum(0)
+            num_fact += len(rel_correct)
+            print('\t'.join(map(str, [rel, len(rel_correct)] + rel_unique.tolist())))
+        print('joined facts {}, unjoined facts {}'.format(num_fact, num_unjoined))
+        print('\t'.join(['system', 'acc', 'unique'] + ['win#{}'.format(j + 1) for j in range(num_sys)]))
+        for i in range(num_sys):
+            print('\t'.join(['#{}'.format(i + 1), '{:.4f}'.format(correct[i] / (num_fact or 1)), str(unique[i])] +
+                            list(map(str, wins[i]))))
+
     elif args.task == 'multi_eval':
         eval = EvalContext(args)
+        eval_cache = EvalCache(args.eval_cache) if args.eval_cache else None
         acc_li: List[float] = []
         acc_single_li: List[float] = []
         acc_multi_li: List[float] = []
@@ -155,12 +554,13 @@ if __name__ == '__main__':
         total_multi_li: List[int] = []
         for root, dirs, files in os.walk(args.inp):
             for file in files:
-                if not file.endswith('.jsonl'):
+                if not is_result_file(file, files):
                     continue
                 in_file = os.path.join(root, file)
                 out_file = os.path.join(root, file.rsplit('.', 1)[0] + '.csv')
                 acc, acc_single, acc_multi, total, total_single, total_multi = \
-                    compute_acc(in_file, eval, prettify_out_file=out_file, only_count=args.only_count)
+                    (eval_cache.compute_acc if eval_cache else compute_acc)(
+                        in_file, eval, prettify_out_file=out_file, only_count=args.only_count)
                 acc_li.append(acc)
                 acc_single_li.append(acc_single)
                 acc_multi_li.append(acc_multi)
@@ -168,10 +568,120 @@ if __name__ == '__main__':
                 total_single_li.append(total_single)
                 total_multi_li.append(total_multi)
                 print(file.rsplit('.', 1)[0], acc, acc_single, acc_multi)
+        if eval.gold_index is not None:
+            eval.gold_index.save()
+        if eval_cache is not None:
+            print('eval cache: {} hit, {} miss'.format(eval_cache.num_hit, eval_cache.num_miss))
         print('no alias {}'.format(eval.alias_manager.no_alias_count))
         print('overall acc {}\t{}\t{}'.format(np.mean(acc_li), np.mean(acc_single_li), np.mean(acc_multi_li)))
         print('overall number {}\t{}\t{}'.format(np.sum(total_li), np.sum(total_single_li), np.sum(total_multi_li)))
 
+    elif args.task == 'multi_eval_grid':
+        # evaluate the predictions of all (model, lang) pairs in inp/model__lang/ with a pool of processes
+        models, langs = args.model.split(','), args.lang.split(',')
+        pairs = list(zip(models, langs)) if args.zip_pairs else [(m, l) for m in models for l in langs]
+        args.model, args.lang = pairs[0]
+        base_eval = EvalContext(args)
+        if args.eval_cache:
+            _eval_cache = EvalCache(args.eval_cache)
+        tasks: List[Tuple[Tuple[str, str], str, str, bool]] = []
+        for m, l in pairs:
+            eval = base_eval if (m, l) == pairs[0] else base_eval.derive(l, m)
+            for lang in {l, args.multi_lang} - {None}:
+                eval.alias_manager.load_alias(lang)
+            _eval_contexts[(m, l)] = eval
+            for root, dirs, files in os.walk(os.path.join(args.inp, '{}__{}'.format(m, l))):
+                for file in files:
+                    if not is_result_file(file, files):
+                        continue
+                    tasks.append(((m, l), os.path.join(root, file),
+                                  os.path.join(root, file.rsplit('.', 1)[0] + '.csv'), args.only_count))
+        with multiprocessing.get_context('fork').Pool(args.num_workers) as pool:
+            results = pool.map(compute_acc_worker, tasks, chunksize=1)
+
+        pair2results: Dict[Tuple[str, str], List] = defaultdict(list)
+        for (key, in_file, _, _), (metric, nac, built) in zip(tasks, results):
+            pair2results[key].append((in_file, (metric, nac)))
+            if _eval_contexts[key].gold_index is not None:
+                _eval_contexts[key].gold_index.update(built)
+        for eval in _eval_contexts.values():
+            if eval.gold_index is not None:
+                eval.gold_index.save()
+        for m, l in pairs:
+            print('==========', m, l, '==========')
+            metrics = []
+            no_alias_count = 0
+            for in_file, (metric, nac) in pair2results[(m, l)]:
+                print(os.path.basename(in_file).rsplit('.', 1)[0], *metric[:3])
+                metrics.append(metric)
+                no_alias_count += nac
+            acc_li, acc_single_li, acc_multi_li, total_li, total_single_li, total_multi_li = \
+                zip(*metrics) if len(metrics) else [[]] * 6
+            print('no alias {}'.format(no_alias_count))
+            print('overall acc {}\t{}\t{}'.format(np.mean(acc_li), np.mean(acc_single_li), np.mean(acc_multi_li)))
+            print('overall number {}\t{}\t{}'.format(np.sum(total_li), np.sum(total_single_li), np.sum(total_multi_li)))
+
+    elif args.task == 'multi_config_eval':
+        # parse each prediction file once and evaluate it under all configurations
+        configs = parse_eval_configs(args.configs, EvalContext(args))
+        config2metrics: List[List[Tuple]] = [[] for _ in configs]
+        for root, dirs, files in os.walk(args.inp):
+            for file in files:
+                if not is_result_file(file, files):
+                    continue
+                result: List[LamaPredictions] = load_result(os.path.join(root, file))
+                for metrics, (_, eval) in zip(config2metrics, configs):
+                    metrics.append(compute_acc_from_result(result, eval, only_count=args.only_count))
+        if configs[0][1].gold_index.filename is not None:
+            configs[0][1].gold_index.save()
+        print('\t'.join(['config', 'acc', 'acc_single', 'acc_multi', 'number', 'number_single', 'number_multi']))
+        for metrics, (config, _) in zip(config2metrics, configs):
+            acc_li, acc_single_li, acc_multi_li, total_li, total_single_li, total_multi_li = \
+                zip(*metrics) if len(metrics) else [[]] * 6
+            print('{}\t{:.4f}\t{:.4f}\t{:.4f}\t{}\t{}\t{}'.format(
+                config or 'default', np.mean(acc_li), np.mean(acc_single_li), np.mean(acc_multi_li),
+                np.sum(total_li), np.sum(total_single_li), np.sum(total_multi_li)))
+
+    elif args.task == 'convert':
+        # convert prediction files between jsonl and columnar npz (in both directions)
+        os.makedirs(args.out, exist_ok=True)
+        for file in sorted(os.listdir(args.inp)):
+            rel, ext = file.rsplit('.', 1) if '.' in file else (file, '')
+            if ext == 'jsonl':
+                jsonl_to_columnar(os.path.join(args.inp, file), os.path.join(args.out, rel + '.npz'))
+            elif ext == 'npz':
+                columnar_to_jsonl(os.path.join(args.inp, file), os.path.join(args.out, rel + '.jsonl'))
+            elif file == 'manifest.json':
+                shutil.copy(os.path.join(args.inp, file), os.path.join(args.out, file))
+
+    elif args.task == 'catalog_ingest':
+        # incrementally ingest all runs under the (comma-separated) input directories into the catalog
+        assert not args.only_count, 'the catalog stores accuracy and correctness, which only_count does not compute'
+        eval = EvalContext(args)
+        catalog = ResultCatalog(args.catalog)
+        for root in args.inp.split(','):
+            num_eval, num_skip = catalog.ingest(root, eval)
+            print('{}: {} evaluated, {} unchanged'.format(root, num_eval, num_skip))
+        if eval.gold_index is not None:
+            eval.gold_index.save()
+        catalog.close()
+
+    elif args.task == 'catalog_query':
+        catalog = ResultCatalog(args.catalog)
+        filters = dict(f.split('=', 1) for f in args.filter.split(';') if f.strip())
+        headers, rows = catalog.query(
+            filters, group_by=args.group_by.split(',') if args.group_by else None, facts=args.facts)
+        catalog.close()
+        if args.out:
+            with open(args.out, 'w') as fout:
+                csv_file = csv.writer(fout)
+                csv_file.writerow(headers)
+                csv_file.writerows(rows)
+        else:
+            print('\t'.join(headers))
+            for row in rows:
+                print('\t'.join(map(str, row)))
+
     elif args.task == 'reliability':
         csv_file_name = None
         headers = ['sentence', 'prediction', 'gold', 'is_same', 'confidence', 'is_single_word', 'sub_uri', 'obj_uri']
@@ -182,33 +692,32 @@ if __name__ == '__main__':
         acc_li: List[float] = []
         conf_li: List[float] = []
         num_token_li: List[int] = []
-        pred_li: List[LamaPredictions] = []
+        is_single_li: List[bool] = []  # only keep what is needed instead of all predictions
 
         with CsvLogFileContext(csv_file_name, headers=headers) as csv_file:
             for root, dirs, files in os.walk(args.inp):
                 for file in tqdm(files):
-                    if not file.endswith('.jsonl'):
+                    if not is_result_file(file, files):
                         continue
                     in_file = os.path.join(root, file)
-                    result: List[LamaPredictions] = load_result(in_file)
-                    for r in result:
+                    for r in iter_result(in_file):
                         right = int(r.eval(eval))
                         acc_li.append(right)
                         conf_li.append(r.confidence)
                         num_token_li.append(r.num_tokens)
-                        pred_li.append(r)
+                        is_single_li.append(r.is_single_word)
                         if csv_file:
                             r.prettify(csv_file, eval)
 
         bins = [[] for _ in range(num_bins)]
-        for acc, conf, nt, r in zip(acc_li, conf_li, num_token_li, pred_li):
+        for acc, conf, nt, is_single in zip(acc_li, conf_li, num_token_li, is_single_li):
             assert conf >= 0 and conf <= 1, 'confidence out of range'
             ind = min(int(conf / margin), num_bins - 1)
-            bins[ind].append((conf, acc, nt, r))
+            bins[ind].append((conf, acc, nt, is_single))
 
         all_bins = bins
-        single_bins = [list(filter(lambda x: x[-1].is_single_word, bin)) for bin in bins]
-        multi_bins = [list(filter(lambda x: not x[-1].is_single_word, bin)) for bin in bins]
+        single_bins = [list(filter(lambda x: x[-1], bin)) for bin in bins]
+        multi_bins = [list(filter(lambda x: not x[-1], bin)) for bin in bins]
         for bins, name in [(all_bins, 'all.png'), (single_bins, 'single.png'), (multi_bins, 'multi.png')]:
             eces = [(len(bin), np.mean(list(map(itemgetter(0), bin))), np.mean(list(map(itemgetter(1), bin)))) for bin in bins]
             print(eces)
@@ -295,44 +804,55 @@ if __name__ == '__main__':
 
     elif args.task == 'overlap':
         dirs = args.inp.split(':')
-        corrects: List[Set[Tuple[str, str, str]]] = []
-        alls: List[Set[Tuple[str, str, str]]] = []
-        fact2sent: Dict[Tuple[str, str, str], List[Tuple[str, str]]] = defaultdict(list)
-        for dir in dirs:
-            corrects.append(set())
-            alls.append(set())
+        dfs: List[pandas.DataFrame] = []
+        for i, dir in enumerate(dirs):
             for root, _, files in os.walk(dir):
                 for file in files:
                     if not file.endswith('.csv') or file.startswith('.'):
                         continue
-                    rel = file.split('.', 1)[0]
-                    df = pandas.read_csv(os.path.join(root, file))
-                    for r in df[df['is_same'] == True].iterrows():
-                        corrects[-1].add((r[1]['sub_uri'], rel, r[1]['obj_uri']))
-                        fact2sent[(r[1]['sub_uri'], rel, r[1]['obj_uri'])].append(
-                            (r[1]['sentence'], r[1]['prediction']))
-                        alls[-1].add((r[1]['sub_uri'], rel, r[1]['obj_uri']))
-                    for r in df[df['is_same'] == False].iterrows():
-                        alls[-1].add((r[1]['sub_uri'], rel, r[1]['obj_uri']))
+                    df = pandas.read_csv(os.path.join(root, file),
+                                         usecols=['sentence', 'prediction', 'is_same', 'sub_uri', 'obj_uri'])
+                    df['rel'] = file.split('.', 1)[0]
+                    df['dir'] = i
+                    dfs.append(df)
+        df = pandas.concat(dfs, ignore_index=True, sort=False)
+        # encode facts as integer ids and correctness as (#facts, #dirs) boolean matrices
+        fact_ids = df.groupby(['sub_uri', 'rel', 'obj_uri'], sort=False).ngroup().values
+        facts: List[Tuple[str, str, str]] = list(
+            df[['sub_uri', 'rel', 'obj_uri']].drop_duplicates().itertuples(index=False, name=None))
+        is_correct = (df['is_same'] == True).values
+        is_incorrect = (df['is_same'] == False).values
+        corrects = np.zeros((len(facts), len(dirs)), dtype=bool)
+        corrects[fact_ids[is_correct], df['dir'].values[is_correct]] = True
+        alls = corrects.copy()
+        alls[fact_ids[is_incorrect], df['dir'].values[is_incorrect]] = True
 
         print('pairwise correlation')
         sdirs = [dir.rsplit('/', 1)[1] for dir in dirs]
-        for i in range(len(corrects)):
+        c, a = corrects.astype(np.float64), alls.astype(np.float64)
+        join = c.T @ c  # correct in both
+        all = c.T @ a + a.T @ c - join  # correct in either (among facts in both)
+        crr = join / np.maximum(all, 1)
+        for i in range(len(dirs)):
             print(sdirs[i], end='')
             for j in range(i + 1):
                 print('\t{:.3f}'.format(0), end='')
-            for j in range(i + 1, len(corrects)):
-                com = alls[i] & alls[j]
-                join = corrects[i] & corrects[j] & com
-                all = (corrects[i] | corrects[j]) & com
-                crr = len(join) / (len(all) or 1)
-                print('\t{:.3f}'.format(crr), end='')
+            for j in range(i + 1, len(dirs)):
+                print('\t{:.3f}'.format(crr[i, j]), end='')
             print('\n')
 
         print('count histogram')
-        all_cs = list(set.union(*corrects))
-        all_cs_lang = [[sdirs[i] for i, correct in enumerate(corrects) if f in correct] for f in all_cs]
-        all_count = [len(langs) for langs in all_cs_lang]
+        all_cs_ind = np.where(corrects.any(1))[0]
+        all_cs = [facts[f] for f in all_cs_ind]
+        all_cs_lang = [[sdirs[i] for i in np.where(corrects[f])[0]] for f in all_cs_ind]
+        all_count = corrects[all_cs_ind].sum(1)
+        # the (sentence, prediction) of facts correct only once
+        correct_ids = fact_ids[is_correct]
+        num_sent = np.bincount(correct_ids, minlength=len(facts))
+        first_sent = np.zeros(len(facts), dtype=np.int64)
+        uniq_ids, first_ind = np.unique(correct_ids, return_index=True)
+        first_sent[uniq_ids] = np.where(is_correct)[0][first_ind]
+        fact2sent = lambda f: tuple(df[['sentence', 'prediction']].iloc[first_sent[f]]) if num_sent[f] == 1 else None
         print('#correct facts {}'.format(len(all_cs)))
         plt.rcParams.update({'font.size': 18, 'font.family': 'serif',
                              'font.weight': 'bold', 'axes.labelweight': 'bold'})
@@ -363,10 +883,10 @@ if __name__ == '__main__':
         with open(args.out, 'w') as fout:
             fout.write(','.join(['fact', 'label', 'sentence', 'langs', 'number of langs']) + '\n')
             csv_file = csv.writer(fout)
-            for i, (langs, f) in enumerate(sorted(zip(all_cs_lang, all_cs), key=lambda x: -len(x[0]))):
+            for i, (langs, f, fi) in enumerate(sorted(zip(all_cs_lang, all_cs, all_cs_ind), key=lambda x: -len(x[0]))):
                 csv_file.writerow([
                     f,
                     (get_label(f[0]), pid2prompt(f[1]), get_label(f[2])),
-                    fact2sent[f][0] if len(fact2sent[f]) == 1 else None,
+                    fact2sent(fi),
                     langs,
                     len(langs)])
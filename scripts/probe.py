@@ -2,7 +2,7 @@ import sys
 from os.path import dirname, abspath
 sys.path.insert(0, dirname(dirname(dirname(abspath(__file__)))))
 
-from typing import List, Dict, Tuple, Set, Union
+from typing import List, Dict, Tuple, Set, Union, Iterator
 import traceback
 import torch
 from transformers import *
@@ -18,6 +18,15 @@ import pandas
 import csv
 import time
 import re
+import queue
+import itertools
+import pickle
+import hashlib
+import copy
+from array import array
+from collections.abc import Mapping
+import threading
+from contextlib import ExitStack
 from prompt import Prompt
 from check_gender import load_entity_gender, Gender
 from check_instanceof import load_entity_instance, load_entity_is_cate
@@ -98,6 +107,83 @@ def get_tie_breaking(dim: int):
     return _tie_breaking[dim]
 
 
+_buffers: Dict[str, torch.Tensor] = {}
+def get_buffer(name: str, size: Tuple[int, ...], dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+    '''
+    Get a preallocated tensor that is reused across batches. It is only grown when the requested size is larger.
+    '''
+    numel = int(np.prod(size))
+    buf = _buffers.get(name)
+    if buf is None or buf.numel() < numel or buf.dtype != dtype or buf.device != device:
+        buf = _buffers[name] = torch.empty(numel, dtype=dtype, device=device)
+    return buf[:numel].view(*size)
+
+
+def chunked_logsumexp(logit: torch.Tensor, vocab_chunk: int) -> torch.Tensor:
+    '''
+    logsumexp over the last dim where at most `vocab_chunk` entries are exponentiated at a time.
+    '''
+    lses = [chunk.logsumexp(-1) for chunk in logit.split(vocab_chunk, dim=-1)]
+    return torch.stack(lses, -1).logsumexp(-1)
+
+
+def log_softmax_topk(logit: torch.Tensor,  # SHAPE: (..., vocab_size)
+                     k: int,
+                     vocab_chunk: int = None,
+                     out: Tuple[torch.Tensor, torch.LongTensor] = None,
+                     ) -> Tuple[torch.Tensor, torch.LongTensor]:  # SHAPE: (..., k)
+    '''
+    Top-k of log_softmax(logit). With `vocab_chunk`, the full log probs are never materialized
+    because log_softmax does not change the ranking, so the top-k logits are normalized afterwards.
+    '''
+    if vocab_chunk is None:
+        return torch.topk(logit.log_softmax(-1), k, dim=-1, out=out)
+    values, indices = torch.topk(logit, k, dim=-1, out=out)
+    lse = chunked_logsumexp(logit, vocab_chunk).unsqueeze(-1)
+    if out is not None:
+        return values.sub_(lse), indices
+    return values - lse, indices
+
+
+def is_oom(e: Exception) -> bool:
+    return isinstance(e, RuntimeError) and \
+           ('out of memory' in str(e) or "can't allocate memory" in str(e) or 'not enough memory' in str(e))
+
+
+def run_with_backoff(func, batch_tensors: List[torch.Tensor], on_split=None):
+    '''
+    Run `func(*batch_tensors)`. When running out of memory, the batch is recursively split into halves
+    and the results (tensors are concatenated along the first dim and lists are merged) are combined.
+    `on_split` is called with the size of the smaller batches.
+    '''
+    try:
+        return func(*batch_tensors)
+    except RuntimeError as e:
+        bs = batch_tensors[0].size(0)
+        if not is_oom(e) or bs <= 1:
+            raise e
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    half = (bs + 1) // 2
+    if on_split is not None:
+        on_split(half)
+    first = run_with_backoff(func, [t[:half] for t in batch_tensors], on_split=on_split)
+    # results might be stored in reused buffers
+    first = tuple(r.clone() if torch.is_tensor(r) else r for r in first) \
+        if type(first) is tuple else first.clone()
+    second = run_with_backoff(func, [t[half:] for t in batch_tensors], on_split=on_split)
+    if type(first) is not tuple:
+        return torch.cat([first, second], 0)
+    return tuple(torch.cat([r1, r2], 0) if torch.is_tensor(r1) else r1 + r2 for r1, r2 in zip(first, second))
+
+
+def get_peak_memory() -> str:
+    if torch.cuda.is_available():
+        return '{:.1f}MB (cuda)'.format(torch.cuda.max_memory_allocated() / 2 ** 20)
+    import resource
+    return '{:.1f}MB (rss)'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10)
+
+
 def get_tokenizer(lang: str, name: str):
     if lang == 'ko' and name in {'monologg/kobert-lm'}:
         return KoBertTokenizer.from_pretrained(name)
@@ -123,6 +209,208 @@ def model_prediction_wrap(model, inp_tensor, attention_mask):
     return logit
 
 
+def layer_prediction_wrap(model, hidden: torch.Tensor) -> torch.Tensor:
+    '''
+    Apply the LM head to the hidden states of any layer (requires models loaded with output_hidden_states).
+    '''
+    if hasattr(model, 'cls'):  # bert
+        logit = model.cls(hidden)
+    elif hasattr(model, 'lm_head'):  # roberta
+        logit = model.lm_head(hidden)
+    elif hasattr(model, 'pred_layer'):  # xlm
+        logit = model.pred_layer(hidden)[0]
+    else:
+        raise Exception('not sure how to apply the lm head')
+    if transformers.__version__ in {'2.4.1', '2.4.0'} and not hasattr(model, 'pred_layer'):
+        # the same bias correction as model_prediction_wrap
+        logit = logit - (model.cls.predictions.bias if hasattr(model, 'cls') else model.lm_head.bias)
+    return logit
+
+
+class PackedLM(object):
+    '''
+    Wrap a masked LM such that short sentences of a batch are packed into fewer rows.
+    Sentences in the same row cannot attend to each other (block-diagonal attention mask)
+    and their position ids are reset, so the outputs are the same as the unpacked ones.
+    '''
+    def __init__(self, model, max_len: int=512, check: bool=False, atol: float=1e-4):
+        if hasattr(model, 'transformer'):  # xlm only accepts 2-D attention masks
+            raise NotImplementedError('packing is not supported for {}'.format(type(model)))
+        self.model = model
+        self.max_len = max_len
+        self.check = check
+        self.atol = atol
+        self.position_offset = 0
+        if hasattr(model, 'roberta'):  # roberta positions start after the padding index
+            self.position_offset = model.roberta.embeddings.padding_idx + 1
+        self.num_row = self.num_packed_row = 0
+
+
+    def __getattr__(self, name):
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+
+    def pack(self,
+             inp_tensor: torch.LongTensor,  # SHAPE: (batch_size, seq_len)
+             attention_mask: torch.LongTensor,  # SHAPE: (batch_size, seq_len)
+             ) -> Tuple[torch.LongTensor, torch.LongTensor, torch.LongTensor, torch.LongTensor]:
+        '''
+        Assume sentences are padded on the right.
+        '''
+        bs, sl = inp_tensor.size(0), inp_tensor.size(1)
+        lengths: List[int] = attention_mask.sum(-1).tolist()
+        # first fit
+        row_lens: List[int] = []
+        locs: List[Tuple[int, int]] = []  # (row, offset) of each sentence
+        for l in lengths:
+            for r, rl in enumerate(row_lens):
+                if rl + l <= self.max_len:
+                    break
+            else:
+                r = len(row_lens)
+                row_lens.append(0)
+            locs.append((r, row_lens[r]))
+            row_lens[r] += l
+        pr, pl = len(row_lens), max(row_lens)
+
+        device = inp_tensor.device
+        # SHAPE: (num_packed_row, packed_len)
+        packed_inp = inp_tensor.new_zeros((pr, pl))
+        position_ids = inp_tensor.new_zeros((pr, pl))
+        # SHAPE: (num_packed_row, packed_len, packed_len)
+        packed_mask = attention_mask.new_zeros((pr, pl, pl))
+        # SHAPE: (batch_size, seq_len)
+        unpack_ind = inp_tensor.new_zeros((bs, sl))
+        for i, ((r, o), l) in enumerate(zip(locs, lengths)):
+            packed_inp[r, o:o + l] = inp_tensor[i, :l]
+            position_ids[r, o:o + l] = torch.arange(l).to(device) + self.position_offset
+            packed_mask[r, o:o + l, o:o + l] = 1
+            unpack_ind[i, :l] = torch.arange(l).to(device) + r * pl + o
+        return packed_inp, packed_mask, position_ids, unpack_ind
+
+
+    def __call__(self, inp_tensor: torch.LongTensor, attention_mask: torch.LongTensor=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(inp_tensor)
+        bs, sl = inp_tensor.size(0), inp_tensor.size(1)
+        packed_inp, packed_mask, position_ids, unpack_ind = self.pack(inp_tensor, attention_mask)
+        self.num_row += bs
+        self.num_packed_row += packed_inp.size(0)
+        # SHAPE: (num_packed_row, packed_len, vocab_size)
+        logit = self.model(packed_inp, attention_mask=packed_mask, position_ids=position_ids)[0]
+        # SHAPE: (batch_size, seq_len, vocab_size)
+        logit = logit.view(-1, logit.size(-1)).index_select(0, unpack_ind.view(-1)).view(bs, sl, -1)
+        if self.check:
+            ref_logit = self.model(inp_tensor, attention_mask=attention_mask)[0]
+            valid = attention_mask.unsqueeze(-1).float()
+            diff = ((logit - ref_logit) * valid).abs().max().item()
+            assert diff <= self.atol, 'packed outputs differ from unpacked ones by {}'.format(diff)
+        return (logit,)
+
+
+class CausalLMScorer(object):
+    '''
+    Score continuations (objects followed by the rest of the prompt) of contexts (the prompt before objects)
+    with a causal LM. A context is run only once and its past key/values are reused for all its continuations.
+    Models without past key/values (e.g., openai-gpt) run the full sequences instead.
+    '''
+    def __init__(self, model, batch_size: int, vocab_chunk: int=None, on_split=None):
+        self.model = model
+        self.batch_size = batch_size
+        self.vocab_chunk = vocab_chunk
+        self.on_split = on_split
+        self.use_past = isinstance(model, GPT2LMHeadModel)
+        self.num_context_token = 0  # number of tokens of contexts run by the model
+        self.num_cont_token = 0  # number of tokens of continuations run by the model
+
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+
+    def log_prob(self,
+                 logit: torch.Tensor,  # SHAPE: (..., vocab_size)
+                 target: torch.LongTensor,  # SHAPE: (...)
+                 ) -> torch.Tensor:  # SHAPE: (...)
+        lse = chunked_logsumexp(logit, self.vocab_chunk or logit.size(-1))
+        return torch.gather(logit, -1, target.unsqueeze(-1)).squeeze(-1) - lse
+
+
+    def encode_contexts(self, contexts: List[Tuple[int]]) -> Dict[Tuple[int], Tuple[List[torch.Tensor], torch.Tensor]]:
+        '''
+        Run contexts of the same length together. Return the past key/values and the logit of the last token.
+        '''
+        ctx2state: Dict[Tuple[int], Tuple[List[torch.Tensor], torch.Tensor]] = {}
+        if not self.use_past:
+            return ctx2state
+        len2ctxs: Dict[int, List[Tuple[int]]] = defaultdict(list)
+        for ctx in set(contexts):
+            len2ctxs[len(ctx)].append(ctx)
+        for ctxs in len2ctxs.values():
+            for b in range(0, len(ctxs), self.batch_size):
+                ctx_batch = ctxs[b:b + self.batch_size]
+                # SHAPE: (batch_size, context_len)
+                inp_tensor = torch.LongTensor(ctx_batch).to(self.device)
+                logit, past = self.model(inp_tensor)[:2]
+                self.num_context_token += inp_tensor.numel()
+                for i, ctx in enumerate(ctx_batch):
+                    ctx2state[ctx] = ([p[:, i:i + 1] for p in past], logit[i, -1])
+        return ctx2state
+
+
+    def continue_past(self,
+                      past: List[torch.Tensor],
+                      last_logit: torch.Tensor,  # SHAPE: (vocab_size,)
+                      inp_tensor: torch.LongTensor,  # SHAPE: (batch_size, cont_len)
+                      ) -> torch.Tensor:  # SHAPE: (batch_size, cont_len)
+        bs = inp_tensor.size(0)
+        logit = self.model(inp_tensor, past=[p.expand(-1, bs, -1, -1, -1) for p in past])[0]
+        # the first token is predicted by the last token of the context
+        logit = torch.cat([last_logit.view(1, 1, -1).expand(bs, -1, -1), logit[:, :-1]], 1)
+        return self.log_prob(logit, inp_tensor)
+
+
+    def continue_full(self,
+                      context: Tuple[int],
+                      inp_tensor: torch.LongTensor,  # SHAPE: (batch_size, context_len + cont_len)
+                      ) -> torch.Tensor:  # SHAPE: (batch_size, cont_len)
+        logit = self.model(inp_tensor)[0]
+        return self.log_prob(logit[:, :-1], inp_tensor[:, 1:])[:, len(context) - 1:]
+
+
+    def score(self,
+              context: Tuple[int],
+              conts: List[List[int]],
+              state: Tuple[List[torch.Tensor], torch.Tensor]=None) -> List[List[float]]:
+        '''
+        Log probs of the tokens of each continuation following the context.
+        '''
+        # sort by length to reduce padding
+        order = sorted(range(len(conts)), key=lambda i: len(conts[i]))
+        results: List[List[float]] = [None] * len(conts)
+        for b in range(0, len(order), self.batch_size):
+            cont_batch = [conts[i] for i in order[b:b + self.batch_size]]
+            # padding at the end does not affect previous tokens
+            if state is not None:
+                inp_tensor = torch.nn.utils.rnn.pad_sequence(
+                    [torch.tensor(cont) for cont in cont_batch], batch_first=True, padding_value=0).to(self.device)
+                lp = run_with_backoff(lambda inp: self.continue_past(state[0], state[1], inp),
+                                      [inp_tensor], on_split=self.on_split)
+            else:
+                inp_tensor = torch.nn.utils.rnn.pad_sequence(
+                    [torch.tensor(list(context) + cont) for cont in cont_batch],
+                    batch_first=True, padding_value=0).to(self.device)
+                lp = run_with_backoff(lambda inp: self.continue_full(context, inp),
+                                      [inp_tensor], on_split=self.on_split)
+            self.num_cont_token += inp_tensor.numel()
+            for j, (i, cont) in enumerate(zip(order[b:b + self.batch_size], cont_batch)):
+                results[i] = lp[j, :len(cont)].cpu().numpy().tolist()
+        return results
+
+
 def tokenizer_wrap(tokenizer, lang: str, encode: bool, *args, **kwargs):
     params = dict()
     if type(tokenizer) is transformers.tokenization_xlm.XLMTokenizer:
@@ -146,6 +434,7 @@ class EvalContext(object):
         self.skip_cate: bool = args.skip_cate
         self.lang: str = args.lang
         self.gold_len: bool = args.gold_len
+        self.probe: str = args.probe
 
         for k, v in DATASET[args.probe].items():
             setattr(self, k, v)
@@ -158,6 +447,33 @@ class EvalContext(object):
         self.tokenizer = get_tokenizer(self.lang, self.lm)
         self.alias_manager = Alias(self.alias_root)
         self.multi_rel_manager = MultiRel(self.multi_rel)
+        self.gold_index: GoldIndex = None
+        if getattr(args, 'gold_index', None):
+            self.gold_index = GoldIndex.from_eval(args.gold_index, self)
+
+
+    def derive(self, lang: str, model: str) -> 'EvalContext':
+        '''
+        A context for another language and model which shares the loaded entity files, managers, and prompt models.
+        '''
+        eval = copy.copy(self)
+        eval.lang = lang
+        eval.lm = LM_NAME[model] if model in LM_NAME else model
+        eval.tokenizer = get_tokenizer(lang, eval.lm)
+        eval.get_prompt_model(lang)
+        if self.gold_index is not None:
+            eval.gold_index = GoldIndex.from_eval(os.path.dirname(self.gold_index.filename), eval)
+        return eval
+
+
+    def data_files(self, langs: List[str]=None) -> List[str]:
+        '''
+        Data files golds are built from: aliases (of `langs`, by default the language and multi_lang),
+        objects of N-M relations, and the gender and instance-of used in inflection.
+        '''
+        langs = sorted(set(langs or [self.lang, self.multi_lang]) - {None})
+        data_files = [os.path.join(self.alias_root, l + '.txt') for l in langs]
+        return data_files + [self.multi_rel, self.entity_gender_path, self.entity_instance_path]
 
 
     def get_prompt_model(self, lang: str) -> Prompt:
@@ -166,6 +482,82 @@ class EvalContext(object):
         return self.prompt_model_dict[lang]
 
 
+def file_hash(filename: str) -> str:
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class GoldIndex(object):
+    '''
+    Golds used by `LamaPredictions.match_with_gold`, i.e., the (inflected) aliases of an object as tokens,
+    token ids, and normalized strings, indexed by (lang, obj_uri, prompt, inflect) so that they are built
+    only once and reused across facts (objects of N-M relations included), relation files, and runs.
+    A saved index is rebuilt when the hash of the data files golds are built from (`data_hash`) changes.
+    '''
+    def __init__(self, filename: str=None, data_hash: str=None):
+        self.filename = filename
+        self.data_hash = data_hash
+        self.key2golds: Dict[Tuple, Tuple[List[List[str]], List[Tuple[int]], List[str], int]] = {}
+        self.num_built = 0
+        self.built_keys: List[Tuple] = []  # keys built since the last `pop_built`
+        if filename is not None and os.path.exists(filename):
+            with open(filename, 'rb') as fin:
+                saved = pickle.load(fin)
+            if isinstance(saved, dict) and saved.get('data_hash') == data_hash and 'key2golds' in saved:
+                self.key2golds = saved['key2golds']
+            else:
+                print('rebuild gold index {} because data files changed'.format(filename))
+
+
+    @classmethod
+    def from_eval(cls, directory: str, eval: 'EvalContext', langs: List[str]=None):
+        '''
+        The saved index of `eval` with golds of the aliases of `langs` (by default the language and multi_lang).
+        '''
+        langs = sorted(set(langs or [eval.lang, eval.multi_lang]) - {None})
+        filename = 'gold_index.{}.{}.{}.{}.{}.pkl'.format(
+            eval.probe, os.path.basename(eval.lm.rstrip('/')), eval.lang, '-'.join(langs), eval.uncase)
+        os.makedirs(directory, exist_ok=True)
+        data_hash = ','.join(file_hash(f) if os.path.exists(f) else 'none' for f in eval.data_files(langs))
+        return cls(os.path.join(directory, filename), data_hash=data_hash)
+
+
+    def get(self, key: Tuple, build) -> Tuple[Tuple[List[List[str]], List[Tuple[int]], List[str], int], bool]:
+        if key in self.key2golds:
+            return self.key2golds[key], False
+        self.key2golds[key] = build()
+        self.num_built += 1
+        self.built_keys.append(key)
+        return self.key2golds[key], True
+
+
+    def pop_built(self) -> Dict[Tuple, Tuple[List[List[str]], List[Tuple[int]], List[str], int]]:
+        '''
+        Entries built since the last call, e.g., to send them from a worker process to the parent.
+        '''
+        built = {key: self.key2golds[key] for key in self.built_keys}
+        self.built_keys = []
+        return built
+
+
+    def update(self, key2golds: Dict[Tuple, Tuple[List[List[str]], List[Tuple[int]], List[str], int]]):
+        for key, golds in key2golds.items():
+            if key not in self.key2golds:
+                self.key2golds[key] = golds
+                self.num_built += 1
+
+
+    def save(self):
+        if self.filename is None or self.num_built <= 0:
+            return
+        with open(self.filename, 'wb') as fout:
+            pickle.dump({'data_hash': self.data_hash, 'key2golds': self.key2golds}, fout)
+        self.num_built = 0
+
+
 class CsvLogFileContext:
     def __init__(self, filename: str=None, headers: List[str]=None):
         self.filename = filename
@@ -186,8 +578,87 @@ class CsvLogFileContext:
             self.file.close()
 
 
+class TokenTable(object):
+    '''
+    Tokens (strings) interned as integer ids shared by all compact predictions of a process.
+    '''
+    token2id: Dict[str, int] = {}
+    id2token: List[str] = []
+
+
+    @classmethod
+    def encode(cls, tokens: List[str]) -> array:
+        ids = array('i')
+        for t in tokens:
+            if t not in cls.token2id:
+                cls.token2id[t] = len(cls.id2token)
+                cls.id2token.append(t)
+            ids.append(cls.token2id[t])
+        return ids
+
+
+    @classmethod
+    def decode(cls, ids: array) -> List[str]:
+        return [cls.id2token[i] for i in ids]
+
+
+class CompactResult(Mapping):
+    '''
+    A read-only prediction dict where token lists are stored as packed arrays of token ids, predictions and
+    their log probs of all numbers of masks are flattened into packed arrays, and fields are decoded on access.
+    '''
+    __slots__ = ('fields', 'token_fields', 'pred_ids', 'pred_offsets', 'pred_log_prob')
+    TOKEN_FIELDS = {'sentence', 'tokenized_obj_label_inflection', 'tokenized_obj_label'}
+
+
+    def __init__(self, result: Dict):
+        self.fields: Dict = {}
+        self.token_fields: Dict[str, array] = {}
+        self.pred_ids = self.pred_offsets = self.pred_log_prob = None
+        pred, pred_log_prob = result.get('pred'), result.get('pred_log_prob')
+        if pred is not None and pred_log_prob is not None and \
+                [len(p) for p in pred] == [len(p) for p in pred_log_prob]:
+            self.pred_offsets = array('i', [0])
+            for p in pred:
+                self.pred_offsets.append(self.pred_offsets[-1] + len(p))
+            self.pred_ids = TokenTable.encode([t for p in pred for t in p])
+            self.pred_log_prob = array('d', [lp for p in pred_log_prob for lp in p])
+        for k, v in result.items():
+            if k in self.TOKEN_FIELDS:
+                self.token_fields[k] = TokenTable.encode(v)
+            elif k not in {'pred', 'pred_log_prob'} or self.pred_ids is None:
+                self.fields[k] = v
+
+
+    def split_pred(self, values: array) -> List[List]:
+        return [values[s:e] for s, e in zip(self.pred_offsets, self.pred_offsets[1:])]
+
+
+    def __getitem__(self, key: str):
+        if key in self.token_fields:
+            return TokenTable.decode(self.token_fields[key])
+        if self.pred_ids is not None:
+            if key == 'pred':
+                return [TokenTable.decode(p) for p in self.split_pred(self.pred_ids)]
+            if key == 'pred_log_prob':
+                return [p.tolist() for p in self.split_pred(self.pred_log_prob)]
+        return self.fields[key]
+
+
+    def __iter__(self):
+        yield from self.fields
+        yield from self.token_fields
+        if self.pred_ids is not None:
+            yield from ['pred', 'pred_log_prob']
+
+
+    def __len__(self):
+        return len(self.fields) + len(self.token_fields) + (2 if self.pred_ids is not None else 0)
+
+
 class LamaPredictions(object):
     greek_unstress = str.maketrans('άόίέύώή', 'αοιευωη')
+    __slots__ = ('result', 'pid', 'pred', 'pred_log_prob', 'correct', 'golds', 'pred2', 'correct2', 'confidence2')
 
 
     def __init__(self, result: Dict, pid: str=None):
@@ -196,12 +667,13 @@ class LamaPredictions(object):
 
 
     def __str__(self):
-        return json.dumps(self.result)
+        return json.dumps(dict(self.result))
 
 
     @classmethod
-    def from_str(cls, str, pid: str=None):
-        return cls(json.loads(str), pid)
+    def from_str(cls, str, pid: str=None, compact: bool=False):
+        result = json.loads(str)
+        return cls(CompactResult(result) if compact else result, pid)
 
 
     @staticmethod
@@ -310,25 +782,53 @@ class LamaPredictions(object):
             langs = [lang]
 
         all_golds: List[List[str]] = []
+        gold_index: GoldIndex = eval.gold_index if eval is not None else None
         for lang in langs:
             casify = lambda x: x.lower() if uncase else x
             unstress = lambda x: x.translate(LamaPredictions.greek_unstress) if lang == 'el' else x
+            normalize = lambda tokens: unstress(casify(tokenizer.convert_tokens_to_string(tokens)))
+
+            def get_alias_golds(uri: str) -> Tuple[List[List[str]], List[Tuple[int]], List[str], int]:
+                inflect = lang == raw_lang  # only do inflection for the raw language
+
+                def build():
+                    tokens, ids, strs = [], [], []
+                    no_alias_count = alias_manager.no_alias_count
+                    for alias in alias_manager.get_alias(uri, langs=lang):
+                        if inflect:
+                            _, alias = eval.get_prompt_model(lang).fill_y(result['prompt'], uri, alias)
+                        alias_ids = tokenizer_wrap(tokenizer, lang, False, alias)
+                        tokens.append(tokenizer.convert_ids_to_tokens(alias_ids))
+                        ids.append(tuple(alias_ids))
+                        strs.append(normalize(tokens[-1]))
+                    return tokens, ids, strs, alias_manager.no_alias_count - no_alias_count
+
+                if gold_index is None:
+                    return build()
+                golds, built = gold_index.get((lang, uri, result['prompt'], inflect), build)
+                if not built:  # keep the statistics the same as without the index
+                    alias_manager.no_alias_count += golds[3]
+                return golds
+
             golds: List[List[str]] = [result['tokenized_obj_label_inflection']]
+            gold_strs: List[str] = [normalize(golds[0])]
             if use_alias:
-                for alias in alias_manager.get_alias(result['obj_uri'], langs=lang):
-                    if lang == raw_lang:  # only do inflection for the raw language
-                        _, alias = eval.get_prompt_model(lang).fill_y(result['prompt'], result['obj_uri'], alias)
-                    golds.append(tokenizer.convert_ids_to_tokens(tokenizer_wrap(tokenizer, lang, False, alias)))
+                uris = [result['obj_uri']]
                 if use_multi_rel:
-                    for obj in multi_rel_manager.get_objects(result['sub_uri'], pid):
-                        for alias in alias_manager.get_alias(obj, langs=lang):
-                            if lang == raw_lang:  # only do inflection for the raw language
-                                _, alias = eval.get_prompt_model(lang).fill_y(result['prompt'], obj, alias)
-                            golds.append(tokenizer.convert_ids_to_tokens(tokenizer_wrap(tokenizer, lang, False, alias)))
+                    uris.extend(multi_rel_manager.get_objects(result['sub_uri'], pid))
+                for uri in uris:
+                    alias_golds = get_alias_golds(uri)
+                    golds.extend(alias_golds[0])
+                    gold_strs.extend(alias_golds[2])
             all_golds.extend(golds)
 
-            for gold in golds:
-                _gold: str = unstress(casify(tokenizer.convert_tokens_to_string(gold)))
+            pred_strs: Dict[int, str] = {}
+            use_period_ = use_period and lang == 'en' and LamaPredictions.is_y_followed_by_at_end(result['prompt'], '.')
+            if not gold_len and not use_period_:  # hash lookup when the prediction does not depend on golds
+                if normalize(pred[best]) in set(gold_strs):
+                    return True, pred[best], result['pred_log_prob'][best], all_golds
+                continue
+            for gold, _gold in zip(golds, gold_strs):
                 if gold_len and len(gold) <= len(pred):
                     choices = [len(gold) - 1]
                     if lang == 'en' and len(gold) > 1:
@@ -336,15 +836,91 @@ class LamaPredictions(object):
                 else:
                     choices = [best]
                 for choice in choices:
-                    _pred: str = unstress(casify(tokenizer.convert_tokens_to_string(pred[choice])))
+                    if choice not in pred_strs:
+                        pred_strs[choice] = normalize(pred[choice])
+                    _pred: str = pred_strs[choice]
                     if _pred == _gold:
                         return True, pred[choice], result['pred_log_prob'][choice], all_golds
-                    if use_period and lang == 'en' and LamaPredictions.is_y_followed_by_at_end(result['prompt'], '.'):
+                    if use_period_:
                         if len(_gold) > 0 and _gold[-1] == '.' and _pred.rstrip() == _gold[:-1].rstrip():
                             return True, pred[choice], result['pred_log_prob'][choice], all_golds
         return False, pred[best], result['pred_log_prob'][best], all_golds
 
 
+FACT_COLUMNS = ['relation', 'sub_uri', 'obj_uri', 'sub_label', 'obj_label', 'prompt']
+TOKEN_COLUMNS = ['sentence', 'tokenized_obj_label_inflection', 'tokenized_obj_label']
+
+
+def save_columnar(results: Iterator[Dict], filename: str):
+    '''
+    Save predictions (fields of `LamaPredictions`) into a columnar npz file where tokens are ids
+    into a vocab stored in the same file, log probs are float16, and other fields are json strings.
+    '''
+    vocab: Dict[str, int] = {}
+    encode = lambda tokens: [vocab.setdefault(t, len(vocab)) for t in tokens]
+    columns: Dict[str, List] = defaultdict(list)
+    offsets: Dict[str, List[int]] = {k: [0] for k in TOKEN_COLUMNS + ['pred']}
+    for r in results:
+        for k in FACT_COLUMNS:
+            columns[k].append(r[k])
+        columns['num_mask'].append(r['num_mask'])
+        columns['num_pred'].append(len(r['pred']))
+        for k in TOKEN_COLUMNS:
+            columns[k].extend(encode(r[k]))
+            offsets[k].append(offsets[k][-1] + len(r[k]))
+        for p, lp in zip(r['pred'], r['pred_log_prob']):
+            assert len(p) == len(lp), 'predictions and log probs are not aligned'
+            columns['pred'].extend(encode(p))
+            columns['pred_log_prob'].extend(lp)
+            offsets['pred'].append(offsets['pred'][-1] + len(p))
+        columns['extra'].append(json.dumps({k: v for k, v in r.items()
+                                            if k not in set(FACT_COLUMNS + TOKEN_COLUMNS) | {'num_mask', 'pred', 'pred_log_prob'}}))
+    arrays: Dict[str, np.ndarray] = {k: np.array(columns[k], dtype=str) for k in FACT_COLUMNS + ['extra']}
+    arrays.update({k: np.array(columns[k], dtype=np.int32) for k in TOKEN_COLUMNS + ['pred']})
+    arrays.update({k + '_offset': np.array(v, dtype=np.int64) for k, v in offsets.items()})
+    arrays['num_mask'] = np.array(columns['num_mask'], dtype=np.int8)
+    arrays['num_pred'] = np.array(columns['num_pred'], dtype=np.int8)
+    arrays['pred_log_prob'] = np.array(columns['pred_log_prob'], dtype=np.float16)
+    arrays['vocab'] = np.array(sorted(vocab, key=vocab.get), dtype=str)
+    np.savez_compressed(filename, **arrays)
+
+
+def load_columnar(filename: str) -> Iterator[Dict]:
+    '''
+    Load predictions saved by `save_columnar` (log probs are float16).
+    '''
+    with np.load(filename) as data:
+        data = {k: data[k] for k in data.files}
+    vocab: List[str] = data['vocab'].tolist()
+    decode = lambda ids: [vocab[i] for i in ids]
+    columns = {k: data[k].tolist() for k in FACT_COLUMNS + ['extra', 'num_mask', 'num_pred']}
+    pred_start = 0
+    for i in range(len(columns['num_mask'])):
+        r = {k: columns[k][i] for k in FACT_COLUMNS}
+        r['num_mask'] = columns['num_mask'][i]
+        for k in TOKEN_COLUMNS:
+            r[k] = decode(data[k][data[k + '_offset'][i]:data[k + '_offset'][i + 1]].tolist())
+        r['pred'], r['pred_log_prob'] = [], []
+        for j in range(pred_start, pred_start + columns['num_pred'][i]):
+            s, e = data['pred_offset'][j], data['pred_offset'][j + 1]
+            r['pred'].append(decode(data['pred'][s:e].tolist()))
+            r['pred_log_prob'].append(data['pred_log_prob'][s:e].astype(np.float32).tolist())
+        pred_start += columns['num_pred'][i]
+        r.update(json.loads(columns['extra'][i]))
+        yield r
+
+
+def jsonl_to_columnar(in_file: str, out_file: str):
+    with open(in_file, 'r') as fin:
+        save_columnar((json.loads(l) for l in fin), out_file)
+
+
+def columnar_to_jsonl(in_file: str, out_file: str):
+    with open(out_file, 'w') as fout:
+        for r in load_columnar(in_file):
+            fout.write(json.dumps(r) + '\n')
+
+
 class JsonLogFileContext:
     def __init__(self, filename: str=None):
         self.filename = filename
@@ -362,6 +938,482 @@ class JsonLogFileContext:
             self.file.close()
 
 
+class LazyQueries(object):
+    '''
+    Queries of a fact file, which are read, filtered, and tokenized again in each pass
+    so that memory does not depend on the number of facts.
+    The counters of filtering and the number of queries are those of the latest pass
+    (use `count` for full counts after a pass stopped early).
+    '''
+    def __init__(self, probe_iter, fact_path: str):
+        self.probe_iter = probe_iter
+        self.fact_path = fact_path
+        self.counter: Dict[str, int] = defaultdict(lambda: 0)
+        self.num_query = 0
+
+
+    def __iter__(self) -> Iterator[Dict]:
+        self.counter = defaultdict(lambda: 0)
+        self.num_query = 0
+        for query in self.probe_iter.iter_queries(self.fact_path, self.counter):
+            self.num_query += 1
+            yield query
+
+
+    def __len__(self):
+        return self.num_query
+
+
+    def count(self):
+        '''
+        A full pass only to update the counters and the number of queries (e.g., after a truncated pass).
+        '''
+        for _ in self:
+            pass
+
+
+class LabelTrie(object):
+    '''
+    Prefix tries over token ids of candidate labels, one for each number of tokens
+    because the number of masks is fixed during decoding.
+    Outputs are only guaranteed to be labels when masks are filled left to right,
+    so that the prefix of the filled position is always known.
+    '''
+    def __init__(self):
+        self.len2trie: Dict[int, Dict] = defaultdict(dict)
+        self.len2depth2tokens: Dict[int, Dict[int, Set[int]]] = defaultdict(lambda: defaultdict(set))
+
+
+    def add(self, ids: List[int]):
+        node = self.len2trie[len(ids)]
+        for d, t in enumerate(ids):
+            self.len2depth2tokens[len(ids)][d].add(t)
+            node = node.setdefault(t, {})
+
+
+    def has_length(self, num_token: int) -> bool:
+        return num_token in self.len2trie
+
+
+    def allowed(self, num_token: int, depth: int, prefix: List[int]=None, suffix: List[int]=None) -> List[int]:
+        '''
+        Tokens allowed at `depth`. When the prefix is unknown (still masked), all tokens at `depth` are allowed.
+        When the suffix is known (e.g., during refinement), only tokens that complete a label are allowed.
+        '''
+        if prefix is None:
+            return list(self.len2depth2tokens[num_token][depth])
+        node = self.len2trie[num_token]
+        for t in prefix:
+            if t not in node:
+                return []
+            node = node[t]
+        if suffix is None:
+            return list(node.keys())
+        allowed: List[int] = []
+        for t, child in node.items():
+            for st in suffix:
+                if st not in child:
+                    break
+                child = child[st]
+            else:
+                allowed.append(t)
+        return allowed
+
+
+    def topk(self,
+             logit: torch.Tensor,  # SHAPE: (batch_size, seq_len, vocab_size)
+             inp_tensor: torch.LongTensor,  # SHAPE: (batch_size, seq_len)
+             init_mask: torch.LongTensor,  # SHAPE: (batch_size, seq_len)
+             mask_value: int,
+             k: int,
+             vocab_chunk: int=None,
+             ) -> Tuple[torch.LongTensor, torch.LongTensor, torch.Tensor, torch.LongTensor]:
+        '''
+        Top-k log probs among the allowed tokens for all mask positions, which are normalized over the whole vocab.
+        Return the positions (rows and columns) of masks and their top-k log probs and tokens.
+        '''
+        # SHAPE: (num_positions,)
+        rows, cols = inp_tensor.eq(mask_value).nonzero().t()
+        init_mask_np = init_mask.cpu().numpy()
+        inp_np = inp_tensor.cpu().numpy()
+        allowed: List[List[int]] = []
+        for r, c in zip(rows.tolist(), cols.tolist()):
+            span = np.where(init_mask_np[r])[0]
+            depth = c - span[0]
+            prefix = inp_np[r, span[0]:c].tolist()
+            suffix = inp_np[r, c + 1:span[-1] + 1].tolist()
+            a = self.allowed(len(span), depth,
+                             prefix=None if mask_value in prefix else prefix,
+                             suffix=None if mask_value in suffix else suffix)
+            # dead end (e.g., tokens predicted in parallel do not form a label)
+            allowed.append(a if len(a) > 0 else self.allowed(len(span), depth))
+        num_allowed = max([len(a) for a in allowed] + [1])
+        # SHAPE: (num_positions, num_allowed)
+        allowed_ind = inp_tensor.new_zeros((len(allowed), num_allowed))
+        allowed_valid = torch.zeros(len(allowed), num_allowed).to(logit.device)
+        for i, a in enumerate(allowed):
+            allowed_ind[i, :len(a)] = torch.LongTensor(a).to(inp_tensor.device)
+            allowed_valid[i, :len(a)] = 1
+        # SHAPE: (num_positions, num_allowed)
+        allowed_logit = logit[rows.unsqueeze(-1), cols.unsqueeze(-1), allowed_ind] + allowed_valid.log()
+        # SHAPE: (num_positions, 1)
+        lse = chunked_logsumexp(logit, vocab_chunk or logit.size(-1))[rows, cols].unsqueeze(-1)
+        # SHAPE: (num_positions, min(k, num_allowed))
+        values, ind = allowed_logit.topk(min(k, num_allowed), dim=-1)
+        # padded (and restricted) tokens are never returned: positions with less than k valid tokens
+        # repeat their best one, which is removed as a duplicate by beam search
+        # SHAPE: (num_positions,)
+        num_valid = values.gt(float('-inf')).long().sum(-1)
+        # SHAPE: (num_positions, k)
+        slot = torch.arange(k).to(logit.device).long().unsqueeze(0).repeat(len(allowed), 1)
+        slot = slot * slot.lt(num_valid.unsqueeze(-1)).long()
+        values, tokens = values.gather(1, slot), allowed_ind.gather(1, ind.gather(1, slot))
+        # positions without any valid token are not constrained
+        keep = num_valid.gt(0)
+        return rows[keep], cols[keep], (values - lse)[keep], tokens[keep]
+
+
+    def is_complete(self,
+                    out_tensor: torch.LongTensor,  # SHAPE: (batch_size, seq_len)
+                    init_mask: torch.LongTensor,  # SHAPE: (batch_size, seq_len)
+                    ) -> torch.LongTensor:  # SHAPE: (batch_size,)
+        '''
+        Whether the masks of each sample are filled with a label.
+        '''
+        out_np = out_tensor.cpu().numpy()
+        init_mask_np = init_mask.cpu().numpy()
+        complete: List[int] = []
+        for out, mask in zip(out_np, init_mask_np):
+            node = self.len2trie.get(int(mask.sum()), {})
+            for t in out[mask == 1].tolist():
+                if t not in node:
+                    complete.append(0)
+                    break
+                node = node[t]
+            else:
+                complete.append(1)
+        return torch.LongTensor(complete).to(out_tensor.device)
+
+
+class BeamSearchDecoder(object):
+    '''
+    Iterative (beam search) decoding where each call of `step` performs one iteration,
+    which allows callers to inspect intermediate results and drop samples between iterations.
+    '''
+    def __init__(self,
+                 model,
+                 inp_tensor: torch.LongTensor,  # SHAPE: (batch_size, seq_len)
+                 raw_mask: torch.LongTensor,  # SHAPE: (batch_size, seq_len)
+                 attention_mask: torch.LongTensor,  # SHAPE: (batch_size, seq_len)
+                 restrict_vocab: List[int] = None,
+                 mask_value: int = 0,  # indicate which value is used for mask
+                 max_iter: int = None,  # max number of iteration
+                 tokenizer = None,
+                 init_method: str='all',
+                 iter_method: str='none',
+                 reprob: bool = False,  # recompute the prob finally
+                 beam_size: int = 5,
+                 reuse_buffer: bool = False,  # write top-k candidates into preallocated buffers
+                 vocab_chunk: int = None,  # compute log probs in chunks of the vocab
+                 label_trie: LabelTrie = None):  # only generate tokens that form valid labels
+        assert init_method in {'all', 'left', 'confidence'}
+        assert iter_method in {'none', 'left', 'confidence', 'confidence-multi'}
+        self.model = model
+        self.reuse_buffer = reuse_buffer
+        self.vocab_chunk = vocab_chunk
+        self.label_trie = label_trie
+        self.restrict_vocab = restrict_vocab
+        self.mask_value = mask_value
+        self.max_iter = max_iter
+        self.tokenizer = tokenizer
+        self.init_method = init_method
+        self.iter_method = iter_method
+        self.reprob = reprob
+        self.beam_size = beam_size
+
+        self.inp_tensor = inp_tensor
+        self.attention_mask = attention_mask
+        self.bs, self.sl = inp_tensor.size(0), inp_tensor.size(1)
+        self.init_mask = inp_tensor.eq(mask_value).long()  # SHAPE: (batch_size, seq_len)
+        init_has_mask = self.init_mask.sum().item() > 0
+
+        if iter_method == 'confidence-multi':
+            number_to_mask = torch.unique(self.init_mask.sum(-1))
+            assert number_to_mask.size(0) == 1, 'this batch has different numbers of mask tokens'
+            self.number_to_mask = number_to_mask[0].item() - 1
+            assert max_iter == 0, 'do not need to set max_iter in confidence-multi setting'
+        elif iter_method == 'left':
+            self.leftmost_mask = self.init_mask * torch.cat(
+                [self.init_mask.new_ones((self.bs, 1)), 1 - self.init_mask], 1)[:, :-1]
+            number_to_mask = torch.unique(self.init_mask.sum(-1))
+            assert number_to_mask.size(0) == 1, 'this batch has different numbers of mask tokens'
+            self.number_to_mask: int = number_to_mask[0].item()
+            self.mask_offset: int = 0
+            self.has_modified: bool = False  # track wether modification happens during a left-to-right pass
+
+        # SHAPE: (<=beam_size, batch_size, seq_len)
+        self.out_tensors: torch.LongTensor = inp_tensor.unsqueeze(0)
+        # tokens not considered have log prob of zero
+        self.out_logprobs: torch.Tensor = torch.zeros_like(inp_tensor).float().unsqueeze(0)
+        self.iter: int = 0
+        self.stop: bool = not init_has_mask  # skip when there is not mask initially
+
+        # samples that are dropped keep their results at the time of dropping
+        # SHAPE: (batch_size,)
+        self.active: torch.LongTensor = torch.arange(self.bs).to(inp_tensor.device)
+        self.final_out_tensor: torch.LongTensor = inp_tensor.clone()
+        self.final_out_logprob: torch.Tensor = torch.zeros_like(inp_tensor).float()
+        # number of times each sample is fed into the model
+        # SHAPE: (batch_size,)
+        self.num_forward: torch.LongTensor = torch.zeros(self.bs).long().to(inp_tensor.device)
+
+
+    @property
+    def out_tensor(self) -> torch.LongTensor:  # SHAPE: (num_active, seq_len)
+        return self.out_tensors[0]
+
+
+    @property
+    def out_logprob(self) -> torch.Tensor:  # SHAPE: (num_active, seq_len)
+        return self.out_logprobs[0]
+
+
+    def select(self, keep: torch.Tensor):  # SHAPE: (num_active,)
+        '''
+        Only keep samples where `keep` is nonzero in the following iterations.
+        '''
+        if keep.ne(0).all().item():
+            return
+        drop_ind = keep.eq(0).nonzero().view(-1)
+        keep_ind = keep.ne(0).nonzero().view(-1)
+        self.final_out_tensor[self.active[drop_ind]] = self.out_tensor[drop_ind]
+        self.final_out_logprob[self.active[drop_ind]] = self.out_logprob[drop_ind]
+        self.active = self.active[keep_ind]
+        self.bs = keep_ind.size(0)
+        self.inp_tensor = self.inp_tensor[keep_ind]
+        self.attention_mask = self.attention_mask[keep_ind]
+        self.init_mask = self.init_mask[keep_ind]
+        if self.iter_method == 'left':
+            self.leftmost_mask = self.leftmost_mask[keep_ind]
+        self.out_tensors = self.out_tensors[:, keep_ind]
+        self.out_logprobs = self.out_logprobs[:, keep_ind]
+        if self.bs <= 0:
+            self.stop = True
+
+
+    def result(self) -> Tuple[torch.LongTensor, torch.Tensor, int]:  # SHAPE: (batch_size, seq_len)
+        self.final_out_tensor[self.active] = self.out_tensor
+        self.final_out_logprob[self.active] = self.out_logprob
+        return self.final_out_tensor, self.final_out_logprob, self.iter
+
+
+    def step(self):
+        '''
+        Perform one iteration of decoding.
+        '''
+        model, mask_value, beam_size = self.model, self.mask_value, self.beam_size
+        restrict_vocab, iter_method = self.restrict_vocab, self.iter_method
+        bs, sl, iter = self.bs, self.sl, self.iter
+        init_mask, attention_mask = self.init_mask, self.attention_mask
+        inp_tensor = self.inp_tensor
+        out_tensors, out_logprobs = self.out_tensors, self.out_logprobs
+        stop: bool = False
+
+        next_out_tensors = []
+        next_out_logprobs = []
+
+        # enumerate over all previous result
+        for out_tensor, out_logprob in zip(out_tensors, out_logprobs):
+            #print(tokenizer.convert_ids_to_tokens(out_tensor[0].cpu().numpy()))
+
+            # get input
+            if iter > 0:
+                if iter_method == 'none':
+                    inp_tensor = out_tensor
+                    if inp_tensor.eq(mask_value).long().sum().item() == 0:  # no mask
+                        stop = True
+                        break
+                elif iter_method == 'confidence':
+                    has_mask = out_tensor.eq(mask_value).any(-1).unsqueeze(-1).long()  # SHAPE: (batch_size, 1)
+                    inp_tensor = out_tensor.scatter(1, out_logprob.min(-1)[1].unsqueeze(-1), mask_value)
+                    # no need to insert mask when there are masks
+                    inp_tensor = out_tensor * has_mask + inp_tensor * (1 - has_mask)
+                elif iter_method == 'confidence-multi':
+                    has_mask = out_tensor.eq(mask_value).any(-1).unsqueeze(-1) # SHAPE: (batch_size, 1)
+                    all_has_mask = has_mask.all().item()
+                    assert all_has_mask == has_mask.any().item(), 'some samples have masks while the others do not'
+                    if not all_has_mask:
+                        if self.number_to_mask <= 0:
+                            stop = True
+                            break
+                        inp_tensor = out_tensor.scatter(
+                            1, (-out_logprob).topk(self.number_to_mask, dim=-1)[1], mask_value)
+                        self.init_method = 'all'
+                        self.number_to_mask -= 1
+                    else:
+                        inp_tensor = out_tensor
+                elif iter_method == 'left':
+                    has_mask = out_tensor.eq(mask_value).any(-1).unsqueeze(-1)  # SHAPE: (batch_size, 1)
+                    all_has_mask = has_mask.all().item()
+                    any_has_mask = has_mask.any().item()
+                    assert all_has_mask == any_has_mask, \
+                        'some samples have masks while the others do not'
+                    if not all_has_mask:  # no mask, should do refinement
+                        if self.mask_offset >= self.number_to_mask:
+                            self.mask_offset = 0
+                        if self.mask_offset == 0:  # restart when starting from the beginning
+                            self.has_modified = False
+                        cur_mask = torch.cat([self.leftmost_mask.new_zeros((bs, self.mask_offset)),
+                                              self.leftmost_mask], 1)[:, :sl]
+                        cur_mask = cur_mask * init_mask
+                        inp_tensor = out_tensor * (1 - cur_mask) + mask_value * cur_mask
+                        self.mask_offset += 1
+                    else:
+                        inp_tensor = out_tensor
+                else:
+                    raise NotImplementedError
+
+            init_method = self.init_method
+
+            # predict
+            # SHAPE: (batch_size, seq_len)
+            mask_mask = inp_tensor.eq(mask_value).long()
+            logit = model_prediction_wrap(model, inp_tensor, attention_mask)
+            self.num_forward[self.active] += 1
+            if restrict_vocab is not None:
+                logit[:, :, restrict_vocab] = float('-inf')
+            # SHAPE: (batch_size, seq_len, beam_size)
+            out = None
+            if self.reuse_buffer:
+                size = (logit.size(0), logit.size(1), beam_size)
+                out = (get_buffer('topk_logprob', size, logit.dtype, logit.device),
+                       get_buffer('topk_ind', size, torch.long, logit.device))
+            new_out_logprobs, new_out_tensors = log_softmax_topk(logit, beam_size, vocab_chunk=self.vocab_chunk, out=out)
+            if self.label_trie is not None:
+                rows, cols, values, tokens = self.label_trie.topk(
+                    logit, inp_tensor, init_mask, mask_value, beam_size, vocab_chunk=self.vocab_chunk)
+                new_out_logprobs[rows, cols] = values
+                new_out_tensors[rows, cols] = tokens
+
+            if init_method == 'confidence':
+                # mask out non-mask positions
+                new_out_logprobs = new_out_logprobs + mask_mask.unsqueeze(-1).float().log()
+                new_out_logprobs = new_out_logprobs.view(-1, sl * beam_size)
+                new_out_tensors = new_out_tensors.view(-1, sl * beam_size)
+
+            for b in range(beam_size):
+                if init_method == 'all':
+                    new_out_logprob = new_out_logprobs[:, :, b]
+                    new_out_tensor = new_out_tensors[:, :, b]
+                    # SHAPE: (batch_size, seq_len)
+                    changes = (out_tensor * mask_mask).ne(new_out_tensor * mask_mask)
+                elif init_method == 'left':  # only modify the left-most one.
+                    new_out_logprob = new_out_logprobs[:, :, b]
+                    new_out_tensor = new_out_tensors[:, :, b]
+                    # SHAPE: (batch_size, seq_len)
+                    changes = (out_tensor * mask_mask).ne(new_out_tensor * mask_mask)
+                    changes = changes & torch.cat([changes.new_ones((bs, 1)), ~changes], 1)[:, :-1]
+                elif init_method == 'confidence':  # only modify the most confident one.
+                    # SHAPE: (batch_size,)
+                    raw_lp, raw_ind = new_out_logprobs.max(-1)
+                    # SHAPE: (batch_size, 1)
+                    raw_lp, raw_ind = raw_lp.unsqueeze(-1), raw_ind.unsqueeze(-1)
+                    seq_ind = raw_ind // beam_size
+                    changes = mask_mask & torch.zeros_like(mask_mask).scatter(1, seq_ind, True)
+                    new_out_tensor = torch.zeros_like(out_tensor).scatter(1, seq_ind, new_out_tensors.gather(1, raw_ind))
+                    new_out_logprob = torch.zeros_like(out_logprob).scatter(1, seq_ind, raw_lp)
+                    changes = (out_tensor * changes.long()).ne(new_out_tensor * changes.long())
+                    # max for the next max in beam search
+                    new_out_logprobs = new_out_logprobs.scatter(1, raw_ind, float('-inf'))
+                else:
+                    raise NotImplementedError
+
+                # only modify tokens that have changes
+                changes = changes.long()
+                _out_tensor = out_tensor * (1 - changes) + new_out_tensor * changes
+                _out_logprob = out_logprob * (1 - changes.float()) + new_out_logprob.detach() * changes.float()
+
+                # involves heavy computation, where we re-compute probabilities for beam_size * beam_size samples
+                if self.reprob:
+                    self.num_forward[self.active] += int(init_mask.sum(-1).max().item())
+                    _out_logprob = compute_likelihood(
+                        model, _out_tensor, _out_logprob,
+                        init_mask, attention_mask, restrict_vocab, mask_value=mask_value, vocab_chunk=self.vocab_chunk)
+                    _out_logprob = _out_logprob * (1 - _out_tensor.eq(mask_value).float())  # skip mask tokens
+
+                next_out_tensors.append(_out_tensor)
+                next_out_logprobs.append(_out_logprob)
+
+                '''
+                for i in range(bs):
+                    print(tokenizer.convert_ids_to_tokens(inp_tensor[i].cpu().numpy()))
+                    print(tokenizer.convert_ids_to_tokens(_out_tensor[i].cpu().numpy()))
+                input()
+                '''
+
+        if stop:
+            self.stop = True
+            return
+
+        next_out_tensors = torch.stack(next_out_tensors, 0)
+        next_out_logprobs = torch.stack(next_out_logprobs, 0)
+        # tie breaking
+        next_out_logprobs = next_out_logprobs + \
+                            get_tie_breaking(int(next_out_logprobs.size(0))).view(-1, 1, 1).to(next_out_logprobs.device)
+
+        # dedup
+        not_dups = []
+        for i in range(bs):
+            abs = next_out_tensors.size(0)
+            # SHAPE: (all_beam_size, seq_len)
+            one_sample = next_out_tensors[:, i, :]
+            # SHAPE: (all_beam_size,)
+            inv = torch.unique(one_sample, dim=0, return_inverse=True)[1]
+            # SHAPE: (all_beam_size, all_beam_size)
+            not_dup = inv.unsqueeze(-1).ne(inv.unsqueeze(0)) | \
+                      (torch.arange(abs).unsqueeze(-1) <= torch.arange(abs).unsqueeze(0)).to(inv.device)
+            # SHAPE: (all_beam_size,)
+            not_dup = not_dup.all(-1)
+            not_dups.append(not_dup)
+        # SHAPE: (all_beam_size, batch_size)
+        not_dups = torch.stack(not_dups, -1)
+
+        # select top
+        # SHAPE: (all_beam_size, batch_size)
+        beam_score = (next_out_logprobs * init_mask.unsqueeze(0).float() +
+                      not_dups.unsqueeze(-1).float().log()).sum(-1)
+        # SHAPE: (beam_size, batch_size, seq_len)
+        beam_top = beam_score.topk(beam_size, dim=0)[1].view(-1, bs, 1).repeat(1, 1, sl)
+        next_out_logprobs = torch.gather(next_out_logprobs, 0, beam_top)
+        next_out_tensors = torch.gather(next_out_tensors, 0, beam_top)
+
+        # stop condition for other type of iter
+        if next_out_tensors.size(0) == out_tensors.size(0) and next_out_tensors.eq(out_tensors).all():
+            if iter_method != 'left':
+                stop = True
+        else:
+            if iter_method == 'left':
+                self.has_modified = True
+        # stop condition for 'left' iter
+        if iter_method == 'left' and not self.has_modified and self.mask_offset == self.number_to_mask:
+            # reach the last position and no modification happens during this iteration
+            stop = True
+
+        #print(next_out_tensors.ne(out_tensors).any(-1).any(0).nonzero())
+
+        self.out_tensors = next_out_tensors
+        self.out_logprobs = next_out_logprobs
+
+        self.iter += 1
+        if self.max_iter and self.iter >= self.max_iter:  # max_iter can be zero
+            stop = True
+        self.stop = stop
+
+        if self.label_trie is not None and not self.stop:
+            # refinement of samples that reach a complete label can only move to other labels, so stop early
+            self.select(1 - self.label_trie.is_complete(self.out_tensor, self.init_mask))
+
+
 class ProbeIterator(object):
     def __init__(self, args: argparse.Namespace, tokenizer):
         if args.use_gold:
@@ -417,165 +1469,1242 @@ class ProbeIterator(object):
             os.makedirs(args.log_dir)
         if args.pred_dir and not os.path.exists(args.pred_dir):
             os.makedirs(args.pred_dir)
+        if args.pred_dir:  # the run configuration read by the results catalog of ana.py
+            with open(os.path.join(args.pred_dir, 'manifest.json'), 'w') as fout:
+                json.dump(vars(args), fout, indent=2)
 
         # prompt model
         self.prompt_model = Prompt.from_lang(
             args.prompt_model_lang or args.lang, self.entity2gender, self.entity2instance,
             args.disable_inflection, args.disable_article)
 
+        # the number of tokens of gold objects used to prune the numbers of masks
+        self.lm = LM_NAME[args.model] if args.model in LM_NAME else args.model
+        self.load_num_mask_prior()
+        if args.num_mask_affected:  # facts affected by pruning are appended relation by relation
+            open(args.num_mask_affected, 'w').close()
+
+        # the cheap model of the cascade (set after loading models)
+        self.cascade_model = None
+        # the cheap model has the weights of the full model, so its outputs are reused in escalation
+        self.cascade_same_weights = False
+
+        # numbers of forwards of each row in decoding calls (in the order of rows), only collected when not None
+        self.row_forward_log: List[torch.LongTensor] = None
+
         # summary
         self.summary = {
             'num_max_mask': 0,  # number of facts where the object has more tokens than the max number of masks
             'numtoken2count': defaultdict(lambda: 0),  # number of token (gold) to count
+            'num_dedup': 0,  # number of facts whose inputs are identical to a previous fact (no forward needed)
+            'num_dedup_forward': 0,  # number of row forwards the duplicate facts would have needed
+            'num_prior_pruned': 0,  # number of facts whose gold number of tokens is pruned by the prior
+            'num_pruned_forward': 0,  # number of (fact, number of masks) pairs not decoded because of the prior
+            'num_margin_pruned': 0,  # number of (fact, number of masks) pairs dropped during iterative decoding
+            'reciprocal_ranks': [],  # reciprocal rank of the gold object of each fact in ranking
+            'num_cascade': 0,  # number of inputs decoded by the cheap model of the cascade
+            'num_escalated': 0,  # number of inputs re-decoded by the full model because of low confidence
+            'num_cascade_sample': 0,  # number of sampled inputs decoded by both models
+            'num_cascade_agree': 0,  # number of sampled inputs where both models predict the same
+            'num_oom': 0,  # number of times a batch is split because of out of memory
+            'oom_batch_size': None,  # the smallest batch size used after splitting
         }
 
 
-    def relation_iter(self, pids: Set[str]=None) -> Tuple[Dict, str]:
-        for pattern in self.patterns:
+    def relation_iter(self, pids: Set[str]=None) -> Tuple[Dict, str]:
+        for pattern in self.patterns:
+            relation = pattern['relation']
+            if pids is not None and relation not in pids:
+                continue
+            fact_path = self.entity_path.format(relation)
+            if not os.path.exists(fact_path):
+                continue
+            yield pattern, fact_path
+
+
+    def get_queries(self, fact_path: str) -> Tuple[List[Dict], List[Union[int, float]]]:
+        counter: Dict[str, int] = defaultdict(lambda: 0)
+        queries: List[Dict] = list(self.iter_queries(fact_path, counter))
+        return queries, [counter['num_skip'], counter['not_exist'], counter['num_multi_word'], counter['num_single_word']]
+
+
+    def iter_queries(self, fact_path: str, counter: Dict[str, int]) -> Iterator[Dict]:
+        with open(fact_path) as fin:
+            for l in fin:
+                l = json.loads(l)
+                if self.filter_query(l, counter):
+                    yield l
+
+
+    def filter_query(self, l: Dict, counter: Dict[str, int]) -> bool:
+        '''
+        Fill in the labels of the subject and the object of a fact and decide whether it is used for probing.
+        '''
+        LANG = self.args.lang
+        sub_exist = LANG in self.entity2lang[l['sub_uri']]
+        obj_exist = LANG in self.entity2lang[l['obj_uri']]
+        if self.restricted_facts is not None and \
+                (l['sub_uri'], l['obj_uri']) not in self.restricted_facts:
+            return False
+        exist = sub_exist and obj_exist
+        if self.args.portion == 'trans' and not exist:
+            counter['num_skip'] += 1
+            return False
+        elif self.args.portion == 'non' and exist:
+            counter['num_skip'] += 1
+            return False
+        # resort to English label
+        if self.args.sub_obj_same_lang:
+            l['sub_label'] = self.entity2lang[l['sub_uri']][LANG if exist else 'en']
+            l['obj_label'] = self.entity2lang[l['obj_uri']][LANG if exist else 'en']
+        else:
+            l['sub_label'] = self.entity2lang[l['sub_uri']][LANG if sub_exist else 'en']
+            l['obj_label'] = self.entity2lang[l['obj_uri']][LANG if obj_exist else 'en']
+        sub_label_t = tokenizer_wrap(self.tokenizer, LANG, False, l['sub_label'])
+        obj_label_t = tokenizer_wrap(self.tokenizer, LANG, False, l['obj_label'])
+        if self.unk in sub_label_t or self.unk in obj_label_t:
+            counter['not_exist'] += 1
+            return False
+        if len(obj_label_t) <= 1:
+            counter['num_single_word'] += 1
+            if self.args.skip_single_word:
+                return False
+        if len(obj_label_t) > 1:
+            counter['num_multi_word'] += 1
+            if self.args.skip_multi_word:
+                return False
+        return True
+
+
+    def fill_instance(self, query: Dict, prompt: str) -> Tuple[List[str], List[str], str]:
+        LANG = self.args.lang
+        NUM_MASK = self.args.num_mask
+
+        # fill in subjects
+        instance_x, _ = self.prompt_model.fill_x(
+            prompt, query['sub_uri'], query['sub_label'])
+
+        # fill in objects
+        instance_xys: List[str] = []
+        gold_with_masks: List[str] = []
+        if self.args.use_gold:
+            instance_xy, obj_label = self.prompt_model.fill_y(
+                instance_x, query['obj_uri'], query['obj_label'])
+            if self.args.dry_run and self.args.dry_run <= 50:
+                print(instance_xy)
+            instance_xys.append(instance_xy)
+            nt_obj = len(tokenizer_wrap(self.tokenizer, LANG, False, obj_label))
+            instance_xy_, _ = self.prompt_model.fill_y(
+                instance_x, query['obj_uri'], query['obj_label'],
+                num_mask=nt_obj, mask_sym=self.mask_label)
+            gold_with_masks.append(instance_xy_)
+        else:
+            for nm in range(NUM_MASK):
+                if self.args.sent:
+                    instance_x = self.args.sent
+                instance_xy, obj_label = self.prompt_model.fill_y(
+                    instance_x, query['obj_uri'], query['obj_label'],
+                    num_mask=nm + 1, mask_sym=self.mask_label)
+                instance_xys.append(instance_xy)
+
+        return instance_xys, gold_with_masks, obj_label
+
+
+    def group_duplicates(self, queries: List[Dict], prompt: str) -> List[List[Tuple[Dict, Tuple]]]:
+        '''
+        Group queries that result in exactly the same model inputs (e.g., N-M relations
+        where the same subject appears with different objects) so that they share a forward.
+        '''
+        key2group: Dict[Tuple, List[Tuple[Dict, Tuple]]] = {}
+        for query in queries:
+            instance = self.fill_instance(query, prompt)
+            key = (tuple(instance[0]), tuple(instance[1]))
+            if key not in key2group:
+                key2group[key] = []
+            key2group[key].append((query, instance))
+        return list(key2group.values())
+
+
+    def get_num_mask_prior(self, relation: str, queries: List[Dict], prompt: str) -> Dict[int, int]:
+        '''
+        Distribution (counts) of the number of tokens of the (inflected) gold objects,
+        which only depends on the facts, the prompt, and the tokenizer (no model is needed).
+        '''
+        if relation in self.num_mask_prior and self.num_mask_prior_prompt.get(relation) == prompt:
+            return self.num_mask_prior[relation]
+        numtoken2count: Dict[int, int] = defaultdict(lambda: 0)
+        for query in queries:
+            _, _, obj_label = self.fill_instance(query, prompt)
+            numtoken2count[len(tokenizer_wrap(self.tokenizer, self.args.lang, False, obj_label))] += 1
+        self.num_mask_prior[relation] = dict(numtoken2count)
+        self.num_mask_prior_prompt[relation] = prompt
+        return self.num_mask_prior[relation]
+
+
+    def select_num_masks(self, prior: Dict[int, int], mass: float=None) -> List[int]:
+        '''
+        Select the most frequent numbers of masks that cover at least `mass` (`num_mask_mass` by default)
+        of the facts that can be decoded. Return the 0-based indices of the numbers of masks used in decoding.
+        '''
+        NUM_MASK = self.args.num_mask
+        mass = self.args.num_mask_mass if mass is None else mass
+        if mass is None or self.args.use_gold:
+            return list(range(NUM_MASK))
+        counts = [(nt, c) for nt, c in prior.items() if 1 <= nt <= NUM_MASK]
+        total = sum(c for _, c in counts)
+        if total <= 0:
+            return list(range(NUM_MASK))
+        selected: List[int] = []
+        covered = 0
+        for nt, c in sorted(counts, key=lambda x: (-x[1], x[0])):
+            if covered >= mass * total:
+                break
+            selected.append(nt - 1)
+            covered += c
+        return sorted(selected)
+
+
+    def log_affected_facts(self, relation: str, queries: List[Dict], prompt: str, nms: List[int]):
+        '''
+        Write the facts whose gold objects have numbers of tokens not in `nms` (i.e., might be affected by pruning)
+        to `num_mask_affected` as json lines.
+        '''
+        if not self.args.num_mask_affected:
+            return
+        with open(self.args.num_mask_affected, 'a') as fout:
+            for query in queries:
+                _, _, obj_label = self.fill_instance(query, prompt)
+                num_token = len(tokenizer_wrap(self.tokenizer, self.args.lang, False, obj_label))
+                if num_token - 1 not in nms:
+                    fout.write(json.dumps({'relation': relation, 'sub_uri': query['sub_uri'],
+                                           'obj_uri': query['obj_uri'], 'num_token': num_token}) + '\n')
+
+
+    def num_mask_prior_config(self) -> Dict:
+        '''
+        Everything the prior depends on except for the prompt, which is stored for each relation.
+        '''
+        args = self.args
+        facts_hash = file_hash(args.facts.split(':')[0]) if args.facts is not None else None
+        return {'lm': self.lm, 'lang': args.lang, 'probe': args.probe, 'portion': args.portion,
+                'facts': args.facts, 'facts_hash': facts_hash, 'sub_obj_same_lang': args.sub_obj_same_lang,
+                'skip_single_word': args.skip_single_word, 'skip_multi_word': args.skip_multi_word,
+                'prompt_model_lang': args.prompt_model_lang, 'disable_inflection': args.disable_inflection,
+                'disable_article': args.disable_article}
+
+
+    def load_num_mask_prior(self):
+        self.num_mask_prior: Dict[str, Dict[int, int]] = {}
+        self.num_mask_prior_prompt: Dict[str, str] = {}  # the prompt the prior of each relation is computed with
+        if self.args.num_mask_prior is None or not os.path.exists(self.args.num_mask_prior):
+            return
+        with open(self.args.num_mask_prior, 'r') as fin:
+            prior = json.load(fin)
+        config = self.num_mask_prior_config()
+        if prior.get('config') != config:
+            diff = sorted(k for k in config if prior.get('config', {}).get(k) != config[k])
+            raise Exception('prior {} is computed with different {}'.format(self.args.num_mask_prior, diff))
+        for relation, numtoken2count in prior['prior'].items():
+            self.num_mask_prior[relation] = dict((int(nt), c) for nt, c in numtoken2count.items())
+        self.num_mask_prior_prompt = prior['prompt']
+
+
+    def save_num_mask_prior(self):
+        if self.args.num_mask_prior is None:
+            return
+        with open(self.args.num_mask_prior, 'w') as fout:
+            json.dump({'config': self.num_mask_prior_config(), 'prior': self.num_mask_prior,
+                       'prompt': self.num_mask_prior_prompt}, fout)
+
+
+    def num_mask_prior_iter(self, pids: Set[str]=None):
+        '''
+        Compute the prior of each relation and show which numbers of masks will be decoded
+        and how many facts might be affected by pruning.
+        '''
+        LANG = self.args.lang
+        num_fact = num_affected = 0
+        for pattern, fact_path in self.relation_iter(pids=pids):
+            relation = pattern['relation']
+            queries, _ = self.get_queries(fact_path)
+            prompt = self.prompt_lang[self.prompt_lang['pid'] == relation][LANG].iloc[0]
+            prior = self.get_num_mask_prior(relation, queries, prompt)
+            nms = self.select_num_masks(prior)
+            affected = sum(c for nt, c in prior.items() if nt - 1 not in nms)
+            num_fact += len(queries)
+            num_affected += affected
+            self.log_affected_facts(relation, queries, prompt, nms)
+            print('pid {}\tprior {}\tnum_mask {}\t#affected {}/{}'.format(
+                relation, sorted(prior.items()), [nm + 1 for nm in nms], affected, len(queries)))
+        print('#affected {}/{}={:.4f}'.format(num_affected, num_fact, num_affected / (num_fact + 1e-10)))
+        self.save_num_mask_prior()
+
+
+    def batcher(self, queries: List[Dict], prompt: str) -> Tuple[List, Tuple, Tuple, torch.LongTensor]:
+        LANG = self.args.lang
+        NUM_MASK = self.args.num_mask
+
+        if self.args.dry_run and self.args.dry_run <= 50:
+            queries = itertools.islice(queries, self.args.dry_run)
+            print('')
+
+        # queries are consumed in chunks (a multiple of the batch size) so that lazily loaded queries
+        # are never fully in memory, and duplicates are only grouped within a chunk
+        queries = iter(queries)
+        chunk_size = None
+        if self.args.query_chunk is not None:
+            chunk_size = max(self.args.query_chunk // self.args.batch_size, 1) * self.args.batch_size
+        for query_chunk in iter(lambda: list(itertools.islice(queries, chunk_size)), []):
+            yield from self.batcher_chunk(query_chunk, prompt)
+
+        if self.args.dry_run and self.args.dry_run <= 50:
+            print('')
+
+
+    def batcher_chunk(self, queries: List[Dict], prompt: str) -> Tuple[List, Tuple, Tuple, torch.LongTensor]:
+        LANG = self.args.lang
+        NUM_MASK = self.args.num_mask
+
+        if self.args.dedup:
+            query_groups = self.group_duplicates(queries, prompt)
+        else:
+            query_groups = [[(query, None)] for query in queries]
+
+        for b in tqdm(range(0, len(query_groups), self.args.batch_size), disable=True):
+            group_batch = query_groups[b:b + self.args.batch_size]
+
+            query_batch: List[Dict] = []
+            row_ind: List[int] = []  # the row (among unique inputs) used by each query
+            obj_li: List[np.ndarray] = []
+            obj_ori_li: List[np.ndarray] = []
+            inp_tensor: List[torch.Tensor] = []
+            gold_with_mask_tensor: List[torch.Tensor] = []
+
+            for gi, group in enumerate(group_batch):
+                for qi, (query, instance) in enumerate(group):
+                    instance_xys, gold_with_masks, obj_label = instance or self.fill_instance(query, prompt)
+
+                    if qi == 0:  # only the first query of each group is fed into the model
+                        for instance_xy_ in gold_with_masks:
+                            gold_with_mask_tensor.append(
+                                torch.tensor(tokenizer_wrap(self.tokenizer, LANG, True, instance_xy_)))
+
+                        # tokenize sentences
+                        for instance_xy in instance_xys:
+                            # TODO: greek BERT does not seem to need this
+                            '''
+                            if self.args.model == 'el_bert_base':
+                                instance_xy = self.prompt_model.normalize(instance_xy, mask_sym=self.mask_label)
+                                obj_label = self.prompt_model.normalize(obj_label)
+                            '''
+                            if re.match('\[.*X.*\]', instance_xy) or re.match('\[.*Y.*\]', instance_xy):
+                                raise Exception('inflection missing from "{}"'.format(instance_xy))
+                            if not self.args.use_gold and instance_xy.find(self.mask_label) == -1:
+                                raise Exception('not contain mask tokens "{}"'.format(instance_xy))
+                            inp_tensor.append(torch.tensor(tokenizer_wrap(self.tokenizer, LANG, True, instance_xy)))
+                    else:
+                        self.summary['num_dedup'] += 1
+
+                    query_batch.append(query)
+                    row_ind.append(gi)
+
+                    # tokenize gold object
+                    obj = np.array(tokenizer_wrap(self.tokenizer, LANG, False, obj_label)).reshape(-1)
+                    obj_li.append(obj)
+
+                    # tokenize gold object (before inflection)
+                    obj_ori = np.array(tokenizer_wrap(self.tokenizer, LANG, False, query['obj_label'])).reshape(-1)
+                    obj_ori_li.append(obj_ori)
+
+                    self.summary['numtoken2count'][len(obj)] += 1
+                    if len(obj) > NUM_MASK or len(obj_ori) > NUM_MASK:
+                        self.summary['num_max_mask'] += 1
+                        logger.warning('{} is splitted into {}/{} tokens'.format(obj_label, len(obj), len(obj_ori)))
+
+            # SHAPE: (num_unique * num_mask, seq_len)
+            inp_tensor: torch.Tensor = torch.nn.utils.rnn.pad_sequence(
+                inp_tensor, batch_first=True, padding_value=self.pad)
+            attention_mask: torch.Tensor = inp_tensor.ne(self.pad).long()
+            if self.args.use_gold:
+                mask_ind: torch.Tensor = torch.nn.utils.rnn.pad_sequence(
+                    gold_with_mask_tensor, batch_first=True, padding_value=self.pad).eq(self.mask).long()
+            else:
+                mask_ind: torch.Tensor = inp_tensor.eq(self.mask).long()
+            # SHAPE: (batch_size,)
+            row_ind: torch.LongTensor = torch.LongTensor(row_ind)
+
+            if torch.cuda.is_available() and not self.args.no_cuda:
+                inp_tensor = inp_tensor.cuda()
+                attention_mask = attention_mask.cuda()
+                mask_ind = mask_ind.cuda()
+                row_ind = row_ind.cuda()
+
+            yield query_batch, (inp_tensor, attention_mask, mask_ind), (obj_li, obj_ori_li), row_ind
+
+
+    def cascade_decode(self,
+                       model,
+                       inp_tensor: torch.LongTensor,  # SHAPE: (batch_size, num_mask, seq_len)
+                       attention_mask: torch.LongTensor,  # SHAPE: (batch_size, num_mask, seq_len)
+                       mask_ind: torch.LongTensor,  # SHAPE: (batch_size, num_mask, seq_len)
+                       nms: List[int],  # numbers of masks (0-based) to decode
+                       cheap_nms: List[int],  # numbers of masks (0-based) decoded by the cheap model
+                       label_trie: LabelTrie = None,
+                       ) -> Tuple[torch.LongTensor, torch.Tensor, List[int]]:  # SHAPE: (batch_size, num_mask, seq_len)
+        '''
+        Decode with the cheap model (`cascade_model`) and numbers of masks first, and only re-decode
+        with the full model the inputs whose best length-normalized log prob falls within `cascade_band`.
+        A random sample (`cascade_sample`) of the other inputs is also re-decoded to measure the agreement,
+        but the predictions of the cheap model are kept for them.
+        When the cheap model is the full model, only numbers of masks not in `cheap_nms` are re-decoded.
+        '''
+        NUM_MASK = self.args.num_mask
+        cheap_nms = [nm for nm in cheap_nms if nm in nms] or nms
+        out_tensor, logprob, iters = self.decode(
+            self.cascade_model, inp_tensor, attention_mask, mask_ind, cheap_nms, label_trie=label_trie)
+        num_forward = self.row_forward_log.pop() if self.row_forward_log is not None else None
+
+        def best(out_tensor, logprob, mask_ind, nms) -> Tuple[torch.Tensor, List[List[int]]]:
+            mask_ind = mask_ind.float()
+            mask_len_norm = 1.0 if self.args.no_len_norm else mask_ind.sum(-1)
+            used = torch.zeros(NUM_MASK).to(logprob.device)
+            used[nms] = 1
+            # SHAPE: (batch_size, num_mask)
+            avg_logs = (logprob * mask_ind).sum(-1) / mask_len_norm + used.log().unsqueeze(0)
+            best_logs, best_nms = avg_logs.max(1)
+            preds = [out_tensor[i, nm].masked_select(mask_ind[i, nm].eq(1)).tolist()
+                     for i, nm in enumerate(best_nms.tolist())]
+            return best_logs, preds
+
+        # outputs might be stored in reused buffers which are overwritten by the next decoding
+        out_tensor, logprob = out_tensor.clone(), logprob.clone()
+
+        # inputs in the uncertainty band and a sample of the others
+        low, high = map(float, self.args.cascade_band.split(','))
+        best_logs, cheap_preds = best(out_tensor, logprob, mask_ind, cheap_nms)
+        escalate = best_logs.ge(low) * best_logs.le(high)
+        sample = torch.rand(best_logs.size(0)).to(best_logs.device).lt(self.args.cascade_sample) * escalate.eq(0)
+        rows = (escalate + sample).nonzero().view(-1)
+
+        full_nms = [nm for nm in nms if nm not in cheap_nms] if self.cascade_same_weights else nms
+        if len(rows) > 0 and len(full_nms) > 0:
+            full_out, full_logprob, full_iters = self.decode(
+                model, inp_tensor[rows], attention_mask[rows], mask_ind[rows], full_nms, label_trie=label_trie)
+            iters.extend(full_iters)
+            if num_forward is not None:
+                num_forward[rows] += self.row_forward_log.pop()
+            if self.cascade_same_weights:  # the same weights produce the same outputs
+                full_out[:, cheap_nms] = out_tensor[rows][:, cheap_nms]
+                full_logprob[:, cheap_nms] = logprob[rows][:, cheap_nms]
+                # reused numbers of masks are not pruned by the prior
+                self.summary['num_pruned_forward'] -= len(rows) * len(cheap_nms)
+            _, full_preds = best(full_out, full_logprob, mask_ind[rows], nms)
+            for j, i in enumerate(rows.tolist()):
+                if escalate[i]:
+                    out_tensor[i] = full_out[j]
+                    logprob[i] = full_logprob[j]
+                else:
+                    self.summary['num_cascade_sample'] += 1
+                    self.summary['num_cascade_agree'] += int(cheap_preds[i] == full_preds[j])
+        # only count after all decoding succeeds because batches running out of memory are retried
+        self.summary['num_cascade'] += best_logs.size(0)
+        self.summary['num_escalated'] += escalate.sum().item()
+        if num_forward is not None:
+            self.row_forward_log.append(num_forward)
+
+        # numbers of masks not decoded by the cheap model are never selected for the other inputs
+        for nm in set(nms) - set(cheap_nms):
+            not_escalated = escalate.eq(0).float().view(-1, 1) * mask_ind[:, nm].float()
+            logprob[:, nm] = logprob[:, nm] + (not_escalated * float('-inf')).masked_fill(not_escalated.eq(0), 0)
+        return out_tensor, logprob, iters
+
+
+    def decode(self,
+               model,
+               inp_tensor: torch.LongTensor,  # SHAPE: (batch_size, num_mask, seq_len)
+               attention_mask: torch.LongTensor,  # SHAPE: (batch_size, num_mask, seq_len)
+               mask_ind: torch.LongTensor,  # SHAPE: (batch_size, num_mask, seq_len)
+               nms: List[int],  # numbers of masks (0-based) to decode
+               label_trie: LabelTrie = None,
+               ) -> Tuple[torch.LongTensor, torch.Tensor, List[int]]:  # SHAPE: (batch_size, num_mask, seq_len)
+        '''
+        Decode all numbers of masks in `nms` while the others are left untouched.
+        With `prune_margin`, all numbers of masks are decoded simultaneously and those with
+        length-normalized scores lower than the best one by more than the margin are dropped
+        after each iteration. Only hypotheses with all masks filled are scored and dropped.
+        '''
+        NUM_MASK = self.args.num_mask
+        batch_size = inp_tensor.size(0)
+
+        decoders: Dict[int, BeamSearchDecoder] = {}
+        for nm in nms:
+            decoders[nm] = BeamSearchDecoder(
+                model, inp_tensor[:, nm, :], mask_ind[:, nm, :], attention_mask[:, nm, :],
+                restrict_vocab=self.restrict_vocab, mask_value=self.mask,
+                max_iter=self.args.max_iter, tokenizer=self.tokenizer,
+                init_method=self.args.init_method, iter_method=self.args.iter_method,
+                reprob=self.args.reprob, beam_size=self.args.beam_size, reuse_buffer=self.args.reuse_buffer,
+                vocab_chunk=self.args.vocab_chunk, label_trie=label_trie)
+
+        num_margin_pruned = 0
+        if self.args.prune_margin is None:
+            for nm in nms:
+                while not decoders[nm].stop:
+                    decoders[nm].step()
+        else:
+            # SHAPE: (batch_size, num_mask)
+            scores = torch.zeros(batch_size, NUM_MASK).to(inp_tensor.device) + float('-inf')
+            # SHAPE: (batch_size, num_mask)
+            filled = torch.zeros(batch_size, NUM_MASK).to(inp_tensor.device).long()
+            while not all(decoder.stop for decoder in decoders.values()):
+                for nm, decoder in decoders.items():
+                    if decoder.stop:
+                        continue
+                    decoder.step()
+                    # current outputs of all samples including those dropped during the step
+                    out_tensor, out_logprob, _ = decoder.result()
+                    init_mask = inp_tensor[:, nm, :].eq(self.mask).float()
+                    filled[:, nm] = (out_tensor.eq(self.mask).float() * init_mask).sum(-1).eq(0).long()
+                    score = (out_logprob * init_mask).sum(-1) / init_mask.sum(-1)
+                    scores[:, nm] = score.masked_fill(filled[:, nm].eq(0), float('-inf'))
+                # SHAPE: (batch_size,)
+                best = scores.max(-1)[0]
+                for nm, decoder in decoders.items():
+                    if decoder.stop:
+                        continue
+                    # hypotheses with unfilled masks are kept because their scores are not comparable yet
+                    keep = (scores[decoder.active, nm] >= best[decoder.active] - self.args.prune_margin) | \
+                           filled[decoder.active, nm].eq(0)
+                    num_margin_pruned += int(keep.eq(0).sum().item())
+                    decoder.select(keep)
+        self.summary['num_margin_pruned'] += num_margin_pruned
+
+        out_tensors: List[torch.LongTensor] = []
+        logprobs: List[torch.Tensor] = []
+        iters: List[int] = []
+        for nm in range(NUM_MASK):
+            if nm not in decoders:  # pruned by the prior
+                out_tensors.append(inp_tensor[:, nm, :])
+                logprobs.append(torch.zeros_like(inp_tensor[:, nm, :]).float())
+                self.summary['num_pruned_forward'] += batch_size
+                continue
+            out_tensor, logprob, iter = decoders[nm].result()
+            out_tensors.append(out_tensor)
+            logprobs.append(logprob)
+            iters.append(iter)
+        if self.args.reuse_buffer:
+            size = (batch_size, NUM_MASK, inp_tensor.size(-1))
+            result = torch.stack(out_tensors, 1, out=get_buffer('out_tensor', size, torch.long, inp_tensor.device)), \
+                     torch.stack(logprobs, 1, out=get_buffer('out_logprob', size, torch.float, inp_tensor.device)), \
+                     iters
+        else:
+            result = torch.stack(out_tensors, 1), torch.stack(logprobs, 1), iters
+        if self.row_forward_log is not None:
+            # SHAPE: (batch_size,)
+            self.row_forward_log.append(sum(decoder.num_forward for decoder in decoders.values()) if len(decoders)
+                                        else torch.zeros(batch_size).long().to(inp_tensor.device))
+        return result
+
+
+    def get_gold_candidates(self, query: Dict, prompt: str, relation: str) -> List[Tuple[List[int], List[int]]]:
+        '''
+        Sentences filled with the gold object, its aliases, and the aliases of other objects of N-M relations
+        (all inflected by the prompt model). Return the token ids of sentences and the positions of objects.
+        '''
+        LANG = self.args.lang
+        instance_x, _ = self.prompt_model.fill_x(prompt, query['sub_uri'], query['sub_label'])
+        uri_labels: List[Tuple[str, str]] = [(query['obj_uri'], query['obj_label'])]
+        uri_labels.extend([(query['obj_uri'], alias)
+                           for alias in self.alias_manager.get_alias(query['obj_uri'], langs=LANG)])
+        for obj in self.multi_rel_manager.get_objects(query['sub_uri'], relation):
+            uri_labels.extend([(obj, alias) for alias in self.alias_manager.get_alias(obj, langs=LANG)])
+
+        candidates: List[Tuple[List[int], List[int]]] = []
+        seen: Set[Tuple[int]] = set()
+        for uri, label in uri_labels:
+            candidate = self.fill_candidate(instance_x, uri, label)
+            if candidate is None or tuple(candidate[2]) in seen:
+                continue
+            seen.add(tuple(candidate[2]))
+            candidates.append(candidate[:2])
+        return candidates
+
+
+    def fill_candidate(self, instance_x: str, uri: str, label: str) -> Tuple[List[int], List[int], List[int]]:
+        '''
+        Fill the prompt (with the subject) with the inflected label.
+        Return the token ids of the sentence, the positions of the label, and the token ids of the label.
+        '''
+        LANG = self.args.lang
+        _, label_inflected = self.prompt_model.fill_y(instance_x, uri, label)
+        label_ids: List[int] = tokenizer_wrap(self.tokenizer, LANG, False, label_inflected)
+        if len(label_ids) <= 0 or self.unk in label_ids:
+            return None
+        instance_xy, _ = self.prompt_model.fill_y(
+            instance_x, uri, label, num_mask=len(label_ids), mask_sym=self.mask_label)
+        ids: List[int] = tokenizer_wrap(self.tokenizer, LANG, True, instance_xy)
+        positions: List[int] = [i for i, t in enumerate(ids) if t == self.mask]
+        if len(positions) != len(label_ids):
+            return None
+        for i, t in zip(positions, label_ids):
+            ids[i] = t
+        return ids, positions, label_ids
+
+
+    def build_rank_candidates(self, queries: List[Dict], prompt: str) -> Tuple[List[str], List[str], List[List[int]]]:
+        '''
+        The object set of the relation used in ranking. Return uris, labels, and token ids of (inflected) labels.
+        Objects with more tokens than the max number of masks are excluded.
+        '''
+        LANG = self.args.lang
+        uri2label: Dict[str, str] = {}
+        for query in queries:
+            uri2label[query['obj_uri']] = query['obj_label']
+        uris, labels, label_ids = [], [], []
+        for uri, label in uri2label.items():
+            _, label_inflected = self.prompt_model.fill_y(prompt, uri, label)
+            ids = tokenizer_wrap(self.tokenizer, LANG, False, label_inflected)
+            if len(ids) <= 0 or len(ids) > self.args.num_mask or self.unk in ids:
+                continue
+            uris.append(uri)
+            labels.append(label)
+            label_ids.append(ids)
+        return uris, labels, label_ids
+
+
+    def rank(self,
+             model,
+             inp_tensor: torch.LongTensor,  # SHAPE: (num_unique, num_mask, seq_len)
+             attention_mask: torch.LongTensor,  # SHAPE: (num_unique, num_mask, seq_len)
+             mask_ind: torch.LongTensor,  # SHAPE: (num_unique, num_mask, seq_len)
+             row_ind: torch.LongTensor,  # SHAPE: (batch_size,)
+             query_batch: List[Dict],
+             relation: str,
+             prompt: str,
+             candidates: Tuple[List[str], List[str], List[List[int]]],
+             ) -> List[Dict]:
+        '''
+        Rank all candidate objects for each fact. Candidates with the same number of tokens share one forward
+        of the masked sentence, and are scored by the (independent) log probs at mask positions.
+        The top candidates are rescored by the exact pseudo log-likelihood of their own sentences.
+        '''
+        NUM_MASK = self.args.num_mask
+        uris, labels, label_ids = candidates
+        num_unique, sl = inp_tensor.size(0), inp_tensor.size(-1)
+        device = inp_tensor.device
+
+        # approximate scores
+        # SHAPE: (num_unique, num_candidate)
+        scores = torch.zeros(num_unique, len(uris)).to(device) + float('-inf')
+        len2cands: Dict[int, List[int]] = defaultdict(list)
+        for ci, ids in enumerate(label_ids):
+            len2cands[len(ids)].append(ci)
+        for nt, cis in len2cands.items():
+            nm = nt - 1
+            # SHAPE: (num_unique, seq_len, vocab_size)
+            logit = run_with_backoff(
+                lambda inp, att: model_prediction_wrap(model, inp, att),
+                [inp_tensor[:, nm], attention_mask[:, nm]], on_split=self.record_split)
+            # SHAPE: (num_unique, nt)
+            pos = mask_ind[:, nm].nonzero()[:, 1].view(num_unique, nt)
+            # SHAPE: (num_unique, nt, vocab_size)
+            logit = torch.gather(logit, 1, pos.unsqueeze(-1).repeat(1, 1, logit.size(-1)))
+            if self.restrict_vocab is not None:
+                logit[:, :, self.restrict_vocab] = float('-inf')
+            lse = chunked_logsumexp(logit, self.args.vocab_chunk or logit.size(-1))
+            # SHAPE: (nt, num_cand)
+            cand = torch.LongTensor([label_ids[ci] for ci in cis]).to(device).t()
+            # SHAPE: (num_unique, nt, num_cand)
+            lp = torch.gather(logit, 2, cand.unsqueeze(0).repeat(num_unique, 1, 1)) - lse.unsqueeze(-1)
+            lp = lp.sum(1) if self.args.no_len_norm else lp.mean(1)
+            scores[:, torch.LongTensor(cis).to(device)] = lp
+        # SHAPE: (batch_size, num_candidate)
+        scores = scores.index_select(0, row_ind).cpu().numpy()
+
+        # exact scores of top candidates
+        topn = min(self.args.rank_topn, len(uris))
+        rescore: List[Tuple[int, int, List[int], List[int]]] = []
+        for i, query in enumerate(query_batch):
+            instance_x, _ = self.prompt_model.fill_x(prompt, query['sub_uri'], query['sub_label'])
+            for ci in np.argsort(-scores[i])[:topn]:
+                candidate = self.fill_candidate(instance_x, uris[ci], labels[ci])
+                if candidate is not None:
+                    rescore.append((i, ci, candidate[0], candidate[1]))
+        max_rows = self.args.batch_size * NUM_MASK
+        exact_scores = np.zeros_like(scores) - np.inf
+        for b in range(0, len(rescore), max_rows):
+            cand_batch = rescore[b:b + max_rows]
+            inp = torch.nn.utils.rnn.pad_sequence(
+                [torch.tensor(ids) for _, _, ids, _ in cand_batch], batch_first=True, padding_value=self.pad)
+            mt = torch.zeros_like(inp)
+            for j, (_, _, _, pos) in enumerate(cand_batch):
+                mt[j, pos] = 1
+            att = inp.ne(self.pad).long()
+            inp, mt, att = inp.to(device), mt.to(device), att.to(device)
+            lp = run_with_backoff(
+                lambda inp, mt, att: compute_likelihood(
+                    model, inp, torch.zeros_like(inp).float(), mt, att,
+                    self.restrict_vocab, mask_value=self.mask, vocab_chunk=self.args.vocab_chunk),
+                [inp, mt, att], on_split=lambda size: self.record_split(size // NUM_MASK))
+            lp = (lp.sum(-1) / (1.0 if self.args.no_len_norm else mt.sum(-1).float())).cpu().numpy()
+            for j, (i, ci, _, _) in enumerate(cand_batch):
+                exact_scores[i, ci] = lp[j]
+
+        results: List[Dict] = []
+        hits = [int(k) for k in self.args.rank_hits.split(',')]
+        for i, query in enumerate(query_batch):
+            # rescored candidates are ranked before the others
+            order = sorted(range(len(uris)), key=lambda ci: (-exact_scores[i, ci], -scores[i, ci]))
+            golds = set(self.multi_rel_manager.get_objects(query['sub_uri'], relation)) | {query['obj_uri']}
+            rank = None
+            num_other = 0  # filtered setting: other correct objects do not count
+            for ci in order:
+                if uris[ci] == query['obj_uri']:
+                    rank = num_other + 1
+                    break
+                if uris[ci] not in golds:
+                    num_other += 1
+            result = {
+                'rank_pred': [[uris[ci], float(exact_scores[i, ci]) if np.isfinite(exact_scores[i, ci])
+                               else float(scores[i, ci])] for ci in order[:topn]],
+                'rank': rank,
+                'reciprocal_rank': 1 / rank if rank else 0.0,
+            }
+            for k in hits:
+                result['hits@{}'.format(k)] = int(rank is not None and rank <= k)
+            results.append(result)
+        return results
+
+
+    def load_gold_managers(self):
+        if not hasattr(self, 'alias_manager'):
+            self.alias_manager = Alias(self.alias_root)
+            self.multi_rel_manager = MultiRel(self.multi_rel)
+
+
+    def build_label_trie(self, relation: str, queries: List[Dict], prompt: str) -> LabelTrie:
+        '''
+        Trie over the (inflected) labels and aliases of all objects of the relation.
+        '''
+        LANG = self.args.lang
+        self.load_gold_managers()
+        uri2labels: Dict[str, Set[str]] = defaultdict(set)
+        for query in queries:
+            uri2labels[query['obj_uri']].add(query['obj_label'])
+            for obj in self.multi_rel_manager.get_objects(query['sub_uri'], relation):
+                if LANG in self.entity2lang[obj]:
+                    uri2labels[obj].add(self.entity2lang[obj][LANG])
+        for uri in list(uri2labels.keys()):
+            uri2labels[uri].update(self.alias_manager.get_alias(uri, langs=LANG))
+        label_trie = LabelTrie()
+        for uri, labels in uri2labels.items():
+            for label in labels:
+                _, label = self.prompt_model.fill_y(prompt, uri, label)
+                ids = tokenizer_wrap(self.tokenizer, LANG, False, label)
+                if len(ids) > 0 and self.unk not in ids:
+                    label_trie.add(ids)
+        return label_trie
+
+
+    def score_gold_iter(self, model, pids: Set[str]=None):
+        '''
+        Compute the pseudo log-likelihood (one token masked at a time) of all gold objects (including aliases and
+        objects of N-M relations) of each fact, where candidates of a batch of facts are stacked together
+        so that the number of forwards only depends on the maximum number of tokens.
+        '''
+        LANG = self.args.lang
+        max_rows = self.args.batch_size * self.args.num_mask
+        self.load_gold_managers()
+
+        all_best_scores: List[float] = []
+        num_forward = num_candidate = 0
+        for pattern, fact_path in self.relation_iter(pids=pids):
             relation = pattern['relation']
-            if pids is not None and relation not in pids:
-                continue
-            fact_path = self.entity_path.format(relation)
-            if not os.path.exists(fact_path):
-                continue
-            yield pattern, fact_path
-
+            start_time = time.time()
+            queries, _ = self.get_queries(fact_path)
+            prompt = self.prompt_lang[self.prompt_lang['pid'] == relation][LANG].iloc[0]
+            json_log_filename = os.path.join(self.args.pred_dir, relation + '.jsonl') if self.args.pred_dir else None
+            best_scores: List[float] = []
+            with JsonLogFileContext(json_log_filename) as json_file:
+                for b in range(0, len(queries), self.args.batch_size):
+                    query_batch = queries[b:b + self.args.batch_size]
+                    # SHAPE: (num_candidate,)
+                    candidates: List[Tuple[int, List[int], List[int]]] = []
+                    for qi, query in enumerate(query_batch):
+                        candidates.extend([(qi, ids, pos) for ids, pos in self.get_gold_candidates(query, prompt, relation)])
+                    # sort by the number of tokens to minimize the number of forwards
+                    candidates = sorted(candidates, key=lambda x: len(x[2]))
+                    cand_lps: List[List[float]] = []
+                    for cb in range(0, len(candidates), max_rows):
+                        cand_batch = candidates[cb:cb + max_rows]
+                        inp_tensor = torch.nn.utils.rnn.pad_sequence(
+                            [torch.tensor(ids) for _, ids, _ in cand_batch], batch_first=True, padding_value=self.pad)
+                        mask_tensor = torch.zeros_like(inp_tensor)
+                        for i, (_, _, pos) in enumerate(cand_batch):
+                            mask_tensor[i, pos] = 1
+                        attention_mask = inp_tensor.ne(self.pad).long()
+                        if torch.cuda.is_available() and not self.args.no_cuda:
+                            inp_tensor = inp_tensor.cuda()
+                            mask_tensor = mask_tensor.cuda()
+                            attention_mask = attention_mask.cuda()
+                        # SHAPE: (num_candidate, seq_len)
+                        lp = run_with_backoff(
+                            lambda inp, mt, att: compute_likelihood(
+                                model, inp, torch.zeros_like(inp).float(), mt, att,
+                                self.restrict_vocab, mask_value=self.mask, vocab_chunk=self.args.vocab_chunk),
+                            [inp_tensor, mask_tensor, attention_mask],
+                            on_split=lambda size: self.record_split(size // self.args.num_mask))
+                        num_forward += mask_tensor.sum(-1).max().item()
+                        for i, (_, _, pos) in enumerate(cand_batch):
+                            cand_lps.append(lp[i, pos].cpu().numpy().tolist())
+                    num_candidate += len(candidates)
+
+                    # collect results for each fact
+                    fact2cands: Dict[int, List[Tuple[List[int], List[float]]]] = defaultdict(list)
+                    for (qi, ids, pos), lps in zip(candidates, cand_lps):
+                        fact2cands[qi].append(([ids[i] for i in pos], lps))
+                    for qi, query in enumerate(query_batch):
+                        cands = fact2cands[qi]
+                        if len(cands) <= 0:
+                            continue
+                        scores = [np.sum(lps) if self.args.no_len_norm else np.mean(lps) for _, lps in cands]
+                        best = int(np.argmax(scores))
+                        best_scores.append(scores[best])
+                        if self.args.pred_dir:
+                            json_file.write(json.dumps({
+                                'relation': relation,
+                                'sub_uri': query['sub_uri'],
+                                'obj_uri': query['obj_uri'],
+                                'sub_label': query['sub_label'],
+                                'obj_label': query['obj_label'],
+                                'prompt': prompt,
+                                'golds': [merge_subwords(ids, self.tokenizer, merge=False) for ids, _ in cands],
+                                'gold_log_prob': [lps for _, lps in cands],
+                                'best_gold': best,
+                                'best_gold_log_prob': scores[best],
+                            }) + '\n')
+            all_best_scores.extend(best_scores)
+            print('pid {}\t#fact {}\tavg best gold log prob {:.4f}\ttime {:.1f}'.format(
+                relation, len(best_scores), np.mean(best_scores) if len(best_scores) else 0, time.time() - start_time))
+        print('avg best gold log prob {:.4f}\t#fact {}\t#candidate {}\t#forward {}'.format(
+            np.mean(all_best_scores) if len(all_best_scores) else 0, len(all_best_scores), num_candidate, num_forward))
+        self.print_oom_summary()
+
+
+    def split_causal(self, instance_x: str, uri: str, label: str, bos: List[int]) -> Tuple[Tuple[int], List[int]]:
+        '''
+        Split the prompt (with the subject) filled with the inflected label into the context before the label
+        and the continuation (the label and the rest of the prompt) in token ids.
+        '''
+        LANG = self.args.lang
+        sentence, _ = self.prompt_model.fill_y(instance_x, uri, label)
+        # keep the placeholder so that inflected words around the object stay in the context
+        prefix, _ = self.prompt_model.fill_y(instance_x, uri, label, num_mask=1, mask_sym='[Y]')
+        prefix = re.split(r'\[Y[^\]]*\]', prefix if '[Y' in prefix else instance_x)[0].rstrip()
+        sent_ids: List[int] = tokenizer_wrap(self.tokenizer, LANG, False, sentence)
+        prefix_ids: List[int] = tokenizer_wrap(self.tokenizer, LANG, False, prefix) if prefix else []
+        # use the tokenization of the whole sentence in case tokens cross the boundary
+        k = 0
+        while k < min(len(sent_ids), len(prefix_ids)) and sent_ids[k] == prefix_ids[k]:
+            k += 1
+        context, cont = bos + sent_ids[:k], sent_ids[k:]
+        if len(context) <= 0:  # the first token is not scored without bos
+            context, cont = sent_ids[:1], sent_ids[1:]
+        if len(cont) <= 0:
+            return None
+        return tuple(context), cont
+
+
+    def causal_iter(self, model, pids: Set[str]=None):
+        '''
+        Probe causal LMs (e.g., GPT-2) by scoring all objects of the relation (and aliases of gold objects)
+        after the prompt before [Y], together with the rest of the prompt after [Y].
+        The prediction is the object with the highest score.
+        '''
+        LANG = self.args.lang
+        self.load_gold_managers()
+        scorer = CausalLMScorer(model, self.args.batch_size * self.args.num_mask, vocab_chunk=self.args.vocab_chunk,
+                                on_split=lambda size: self.record_split(size // self.args.num_mask))
+        bos = [self.tokenizer.convert_tokens_to_ids(self.tokenizer.bos_token)] \
+            if self.tokenizer.bos_token is not None else []
 
-    def get_queries(self, fact_path: str) -> Tuple[List[Dict], List[Union[int, float]]]:
+        all_acc: List[int] = []
+        for pattern, fact_path in self.relation_iter(pids=pids):
+            relation = pattern['relation']
+            start_time = time.time()
+            queries, _ = self.get_queries(fact_path)
+            prompt = self.prompt_lang[self.prompt_lang['pid'] == relation][LANG].iloc[0]
+            uri2label: Dict[str, str] = {query['obj_uri']: query['obj_label'] for query in queries}
+            json_log_filename = os.path.join(self.args.pred_dir, relation + '.jsonl') if self.args.pred_dir else None
+            acc: List[int] = []
+            with JsonLogFileContext(json_log_filename) as json_file:
+                for b in range(0, len(queries), self.args.batch_size):
+                    query_batch = queries[b:b + self.args.batch_size]
+                    # SHAPE: (num_candidate,)
+                    candidates: List[Tuple[int, str, str, Tuple[int], List[int]]] = []
+                    for qi, query in enumerate(query_batch):
+                        instance_x, _ = self.prompt_model.fill_x(prompt, query['sub_uri'], query['sub_label'])
+                        uri_labels: List[Tuple[str, str]] = list(uri2label.items())
+                        uri_labels.extend([(query['obj_uri'], alias)
+                                           for alias in self.alias_manager.get_alias(query['obj_uri'], langs=LANG)])
+                        for obj in self.multi_rel_manager.get_objects(query['sub_uri'], relation):
+                            uri_labels.extend([(obj, alias) for alias in self.alias_manager.get_alias(obj, langs=LANG)])
+                        seen: Set[Tuple[str, Tuple[int], Tuple[int]]] = set()
+                        for uri, label in uri_labels:
+                            split = self.split_causal(instance_x, uri, label, bos)
+                            if split is None or (uri, split[0], tuple(split[1])) in seen:
+                                continue
+                            seen.add((uri, split[0], tuple(split[1])))
+                            candidates.append((qi, uri, label) + split)
+
+                    # contexts are shared by the candidates of a fact (unless inflected differently)
+                    ctx2state = scorer.encode_contexts([ctx for _, _, _, ctx, _ in candidates])
+                    ctx2cands: Dict[Tuple[int], List[int]] = defaultdict(list)
+                    for ci, (_, _, _, ctx, _) in enumerate(candidates):
+                        ctx2cands[ctx].append(ci)
+                    cand_lps: List[List[float]] = [None] * len(candidates)
+                    for ctx, cis in ctx2cands.items():
+                        lps = scorer.score(ctx, [candidates[ci][4] for ci in cis], state=ctx2state.get(ctx))
+                        for ci, lp in zip(cis, lps):
+                            cand_lps[ci] = lp
+                    del ctx2state
+
+                    # collect results for each fact
+                    fact2cands: Dict[int, List[Tuple[str, str, float]]] = defaultdict(list)
+                    for (qi, uri, label, _, _), lps in zip(candidates, cand_lps):
+                        fact2cands[qi].append((uri, label, np.sum(lps) if self.args.no_len_norm else np.mean(lps)))
+                    for qi, query in enumerate(query_batch):
+                        cands = fact2cands[qi]
+                        if len(cands) <= 0:
+                            continue
+                        golds = set(self.multi_rel_manager.get_objects(query['sub_uri'], relation)) | {query['obj_uri']}
+                        pred_uri, pred_label, pred_score = max(cands, key=lambda x: x[2])
+                        gold_scores = [score for uri, _, score in cands if uri in golds]
+                        is_correct = int(pred_uri in golds)
+                        acc.append(is_correct)
+                        if self.args.pred_dir:
+                            json_file.write(json.dumps({
+                                'relation': relation,
+                                'sub_uri': query['sub_uri'],
+                                'obj_uri': query['obj_uri'],
+                                'sub_label': query['sub_label'],
+                                'obj_label': query['obj_label'],
+                                'prompt': prompt,
+                                'pred_uri': pred_uri,
+                                'pred_label': pred_label,
+                                'pred_log_prob': float(pred_score),
+                                'gold_log_prob': float(max(gold_scores)) if len(gold_scores) else None,
+                                'correct': is_correct,
+                            }) + '\n')
+            all_acc.extend(acc)
+            print('pid {}\tacc {:.4f}\t#fact {}\ttime {:.1f}'.format(
+                relation, np.mean(acc) if len(acc) else 0, len(acc), time.time() - start_time))
+        print('acc {:.4f}\t#fact {}\t#context token {}\t#continuation token {}'.format(
+            np.mean(all_acc) if len(all_acc) else 0, len(all_acc), scorer.num_context_token, scorer.num_cont_token))
+        self.print_oom_summary()
+
+
+    def layer_iter(self, model, pids: Set[str]=None):
+        '''
+        Probe all layers with a single forward. The LM head is applied to the hidden states of each layer
+        (0 is the embedding layer) at mask positions and all masks are predicted at once for each layer.
+        Predictions of layer l are written to pred_dir/layer{l}.
+        '''
         LANG = self.args.lang
+        NUM_MASK = self.args.num_mask
 
-        queries: List[Dict] = []
-        num_skip = not_exist = num_multi_word = num_single_word = 0
-        with open(fact_path) as fin:
-            for l in fin:
-                l = json.loads(l)
-                sub_exist = LANG in self.entity2lang[l['sub_uri']]
-                obj_exist = LANG in self.entity2lang[l['obj_uri']]
-                if self.restricted_facts is not None and \
-                        (l['sub_uri'], l['obj_uri']) not in self.restricted_facts:
-                    continue
-                exist = sub_exist and obj_exist
-                if self.args.portion == 'trans' and not exist:
-                    num_skip += 1
-                    continue
-                elif self.args.portion == 'non' and exist:
-                    num_skip += 1
-                    continue
-                # resort to English label
-                if self.args.sub_obj_same_lang:
-                    l['sub_label'] = self.entity2lang[l['sub_uri']][LANG if exist else 'en']
-                    l['obj_label'] = self.entity2lang[l['obj_uri']][LANG if exist else 'en']
-                else:
-                    l['sub_label'] = self.entity2lang[l['sub_uri']][LANG if sub_exist else 'en']
-                    l['obj_label'] = self.entity2lang[l['obj_uri']][LANG if obj_exist else 'en']
-                sub_label_t = tokenizer_wrap(self.tokenizer, LANG, False, l['sub_label'])
-                obj_label_t = tokenizer_wrap(self.tokenizer, LANG, False, l['obj_label'])
-                if self.unk in sub_label_t or self.unk in obj_label_t:
-                    not_exist += 1
-                    continue
-                if len(obj_label_t) <= 1:
-                    num_single_word += 1
-                    if self.args.skip_single_word:
-                        continue
-                if len(obj_label_t) > 1:
-                    num_multi_word += 1
-                    if self.args.skip_multi_word:
+        layer2acc: Dict[int, List[float]] = defaultdict(list)  # acc per relation
+        layer2correct: Dict[int, int] = defaultdict(lambda: 0)
+        num_fact = 0
+        for pattern, fact_path in self.relation_iter(pids=pids):
+            relation = pattern['relation']
+            start_time = time.time()
+            queries, _ = self.get_queries(fact_path)
+            prompt = self.prompt_lang[self.prompt_lang['pid'] == relation][LANG].iloc[0]
+            layer2rel_acc: Dict[int, List[int]] = defaultdict(list)
+            with ExitStack() as stack:
+                json_files: Dict[int, JsonLogFileContext] = {}
+                for query_batch, (inp_tensor, attention_mask, mask_ind), (obj_li, obj_ori_li), row_ind \
+                        in self.batcher(queries, prompt):
+                    if self.args.dry_run:
                         continue
-                queries.append(l)
-
-        return queries, [num_skip, not_exist, num_multi_word, num_single_word]
-
-
-    def batcher(self, queries: List[Dict], prompt: str) -> Tuple[List, Tuple, Tuple]:
+                    # SHAPE: num_layer * (batch_size * num_mask, seq_len, hidden_size)
+                    hiddens = run_with_backoff(
+                        lambda inp, att: tuple(model(inp, attention_mask=att)[-1]),
+                        [inp_tensor, attention_mask], on_split=lambda size: self.record_split(size // NUM_MASK))
+                    is_mask = mask_ind.eq(1)
+                    batch_size = inp_tensor.size(0) // NUM_MASK
+                    for layer, hidden in enumerate(hiddens):
+                        if self.args.pred_dir and layer not in json_files:
+                            layer_dir = os.path.join(self.args.pred_dir, 'layer{}'.format(layer))
+                            os.makedirs(layer_dir, exist_ok=True)
+                            json_files[layer] = stack.enter_context(
+                                JsonLogFileContext(os.path.join(layer_dir, relation + '.jsonl')))
+                        # SHAPE: (num_mask_token, vocab_size)
+                        logit = layer_prediction_wrap(model, hidden[is_mask])
+                        if self.restrict_vocab is not None:
+                            logit[:, self.restrict_vocab] = float('-inf')
+                        lp, pred_ind = log_softmax_topk(logit, 1, vocab_chunk=self.args.vocab_chunk)
+                        out_tensor = inp_tensor.masked_scatter(is_mask, pred_ind.view(-1))
+                        logprob = torch.zeros_like(inp_tensor).float().masked_scatter(is_mask, lp.view(-1))
+
+                        # SHAPE: (len(query_batch), num_mask, seq_len)
+                        out_tensor = out_tensor.view(batch_size, NUM_MASK, -1).index_select(0, row_ind)
+                        logprob = logprob.view(batch_size, NUM_MASK, -1).index_select(0, row_ind)
+                        layer_mask = mask_ind.view(batch_size, NUM_MASK, -1).index_select(0, row_ind).float()
+                        layer_inp = inp_tensor.view(batch_size, NUM_MASK, -1).index_select(0, row_ind)
+                        mask_len_norm = 1.0 if self.args.no_len_norm else layer_mask.sum(-1)
+                        avg_logs = (logprob * layer_mask).sum(-1) / mask_len_norm
+
+                        for i, avg_log in enumerate(avg_logs):
+                            _, best_num_mask = avg_log.max(0)
+                            pred: np.ndarray = out_tensor[i, best_num_mask].masked_select(
+                                layer_mask[i, best_num_mask].eq(1)).cpu().numpy().reshape(-1)
+                            obj = obj_li[i]
+                            layer2rel_acc[layer].append(int((len(pred) == len(obj)) and (pred == obj).all()))
+                            if self.args.pred_dir:
+                                json_files[layer].write(str(LamaPredictions({
+                                    'relation': relation,
+                                    'sub_uri': query_batch[i]['sub_uri'],
+                                    'obj_uri': query_batch[i]['obj_uri'],
+                                    'sub_label': query_batch[i]['sub_label'],
+                                    'obj_label': query_batch[i]['obj_label'],
+                                    'prompt': prompt,
+                                    'num_mask': best_num_mask.item() + 1,
+                                    'sentence': merge_subwords(
+                                        layer_inp[i, best_num_mask].cpu().numpy(), self.tokenizer, merge=False),
+                                    'tokenized_obj_label_inflection': merge_subwords(obj, self.tokenizer, merge=False),
+                                    'tokenized_obj_label': merge_subwords(obj_ori_li[i], self.tokenizer, merge=False),
+                                    'pred': [merge_subwords(out_tensor[i, nm].masked_select(
+                                        layer_mask[i, nm].eq(1)).cpu().numpy(), self.tokenizer, merge=False)
+                                        for nm in range(NUM_MASK)],
+                                    'pred_log_prob': [logprob[i, nm].masked_select(
+                                        layer_mask[i, nm].eq(1)).cpu().numpy().tolist() for nm in range(NUM_MASK)],
+                                })) + '\n')
+            if len(layer2rel_acc) <= 0:
+                continue
+            num_fact += len(layer2rel_acc[0])
+            for layer, rel_acc in sorted(layer2rel_acc.items()):
+                layer2acc[layer].append(np.mean(rel_acc))
+                layer2correct[layer] += np.sum(rel_acc)
+            print('pid {}\t#fact {}\tacc per layer {}\ttime {:.1f}'.format(
+                relation, len(layer2rel_acc[0]),
+                ' '.join('{:.4f}'.format(np.mean(layer2rel_acc[l])) for l in sorted(layer2rel_acc)),
+                time.time() - start_time))
+        for layer in sorted(layer2acc):
+            print('layer {}\tacc per fact {}/{}={:.4f}\tacc per relation {:.4f}'.format(
+                layer, layer2correct[layer], num_fact, layer2correct[layer] / (num_fact + 1e-10),
+                np.mean(layer2acc[layer])))
+        self.print_oom_summary()
+
+
+    def export_iter(self, model, pids: Set[str]=None):
+        '''
+        Export the hidden states (of layer `export_layer`) at mask positions and at the subject span of all inputs
+        into a float16 memmap per relation (export_dir/model/lang/relation.f16) with an index from
+        (sub_uri, obj_uri, num_mask) to row offsets (relation.index.npz). Use `load_hidden_export` to read.
+        '''
         LANG = self.args.lang
         NUM_MASK = self.args.num_mask
+        export_dir = os.path.join(self.args.export_dir, os.path.basename(self.args.model.rstrip('/')), LANG)
+        os.makedirs(export_dir, exist_ok=True)
 
-        if self.args.dry_run and self.args.dry_run <= 50:
-            queries = queries[:self.args.dry_run]
-            print('')
+        for pattern, fact_path in self.relation_iter(pids=pids):
+            relation = pattern['relation']
+            start_time = time.time()
+            queries, _ = self.get_queries(fact_path)
+            prompt = self.prompt_lang[self.prompt_lang['pid'] == relation][LANG].iloc[0]
+
+            # token ids of (inflected) subjects used to locate subject spans
+            sub2ids: Dict[Tuple[str, str], List[List[int]]] = {}
+            max_rows = len(queries) * NUM_MASK * (NUM_MASK + 1) // 2
+            for query in queries:
+                _, sub_label = self.prompt_model.fill_x(prompt, query['sub_uri'], query['sub_label'])
+                sub_ids = [tokenizer_wrap(self.tokenizer, LANG, False, label) for label in [sub_label, ' ' + sub_label]]
+                sub2ids[(query['sub_uri'], query['sub_label'])] = sub_ids
+                max_rows += max(map(len, sub_ids)) * NUM_MASK
+
+            data_filename = os.path.join(export_dir, relation + '.f16')
+            hidden_size = model.config.emb_dim if hasattr(model.config, 'emb_dim') else model.config.hidden_size
+            data = np.memmap(data_filename, dtype=np.float16, mode='w+', shape=(max(max_rows, 1), hidden_size))
+            index: Dict[str, List] = defaultdict(list)
+            num_row = 0
+            for query_batch, (inp_tensor, attention_mask, mask_ind), _, row_ind in self.batcher(queries, prompt):
+                # SHAPE: (batch_size * num_mask, seq_len, hidden_size)
+                hidden = run_with_backoff(
+                    lambda inp, att: model(inp, attention_mask=att)[-1][self.args.export_layer],
+                    [inp_tensor, attention_mask], on_split=lambda size: self.record_split(size // NUM_MASK))
+                inp_np = inp_tensor.cpu().numpy()
+
+                # locate subject spans of unique inputs
+                # SHAPE: (num_unique * num_mask, seq_len)
+                is_sub = torch.zeros_like(mask_ind)
+                row2sub: Dict[int, Tuple[int, int]] = {}
+                for i, gi in enumerate(row_ind.tolist()):
+                    for nm in range(NUM_MASK):
+                        row = gi * NUM_MASK + nm
+                        if row in row2sub:
+                            continue
+                        row2sub[row] = (0, 0)
+                        for sub_ids in sub2ids[(query_batch[i]['sub_uri'], query_batch[i]['sub_label'])]:
+                            start = next((j for j in range(len(inp_np[row]) - len(sub_ids) + 1)
+                                          if len(sub_ids) and inp_np[row, j:j + len(sub_ids)].tolist() == sub_ids), None)
+                            if start is not None:
+                                is_sub[row, start:start + len(sub_ids)] = 1
+                                row2sub[row] = (start, len(sub_ids))
+                                break
 
-        for b in tqdm(range(0, len(queries), self.args.batch_size), disable=True):
-            query_batch = queries[b:b + self.args.batch_size]
+                # write all vectors of the batch at once (mask positions first, then subject spans)
+                is_mask = mask_ind.eq(1)
+                num_mask_row, num_sub_row = is_mask.sum().item(), is_sub.sum().item()
+                vectors = torch.cat([hidden[is_mask], hidden[is_sub.eq(1)]], 0).half().cpu().numpy()
+                data[num_row:num_row + len(vectors)] = vectors
+                # SHAPE: (num_unique * num_mask,)
+                mask_cnt = is_mask.long().sum(-1).cpu().numpy()
+                mask_off = num_row + np.cumsum(mask_cnt) - mask_cnt
+                sub_cnt = is_sub.long().sum(-1).cpu().numpy()
+                sub_off = num_row + num_mask_row + np.cumsum(sub_cnt) - sub_cnt
+                num_row += num_mask_row + num_sub_row
+
+                for i, gi in enumerate(row_ind.tolist()):
+                    for nm in range(NUM_MASK):
+                        row = gi * NUM_MASK + nm
+                        index['sub_uri'].append(query_batch[i]['sub_uri'])
+                        index['obj_uri'].append(query_batch[i]['obj_uri'])
+                        index['num_mask'].append(nm + 1)
+                        index['mask_offset'].append(mask_off[row])
+                        index['mask_len'].append(mask_cnt[row])
+                        index['sub_offset'].append(sub_off[row])
+                        index['sub_len'].append(sub_cnt[row])
+            data.flush()
+            del data
+            # drop unused rows
+            os.truncate(data_filename, num_row * hidden_size * np.dtype(np.float16).itemsize)
+            np.savez(os.path.join(export_dir, relation + '.index.npz'),
+                     shape=np.array([num_row, hidden_size]),
+                     sub_uri=np.array(index['sub_uri']),
+                     obj_uri=np.array(index['obj_uri']),
+                     num_mask=np.array(index['num_mask'], dtype=np.int8),
+                     **{k: np.array(index[k], dtype=np.int64)
+                        for k in ['mask_offset', 'mask_len', 'sub_offset', 'sub_len']})
+            print('pid {}\t#fact {}\t#vector {}\ttime {:.1f}'.format(
+                relation, len(queries), num_row, time.time() - start_time))
+        self.print_oom_summary()
+
+
+    def predict_iter(self, model, relation: str, queries: List[Dict], prompt: str) -> Dict:
+        '''
+        Decode a list of queries of a relation and yield predictions (the fields of `LamaPredictions`).
+        '''
+        NUM_MASK = self.args.num_mask
+        nms: List[int] = list(range(NUM_MASK))
+        for query_batch, (inp_tensor, attention_mask, mask_ind), (obj_li, obj_ori_li), row_ind \
+                in self.batcher(queries, prompt):
+            batch_size = inp_tensor.size(0) // NUM_MASK
+            inp_tensor = inp_tensor.view(batch_size, NUM_MASK, -1)
+            attention_mask = attention_mask.view(batch_size, NUM_MASK, -1)
+            mask_ind = mask_ind.view(batch_size, NUM_MASK, -1)
+            # SHAPE: (batch_size, num_mask, seq_len)
+            out_tensor, logprob, _ = run_with_backoff(
+                lambda inp, att, mi: self.decode(model, inp, att, mi, nms),
+                [inp_tensor, attention_mask, mask_ind], on_split=self.record_split)
+            # SHAPE: (len(query_batch), num_mask, seq_len)
+            mask_ind = mask_ind.float().index_select(0, row_ind)
+            logprob = logprob.index_select(0, row_ind)
+            out_tensor = out_tensor.index_select(0, row_ind)
+            inp_tensor = inp_tensor.index_select(0, row_ind)
+            mask_len_norm = 1.0 if self.args.no_len_norm else mask_ind.sum(-1)
+            avg_logs = (logprob * mask_ind).sum(-1) / mask_len_norm
+            for i, avg_log in enumerate(avg_logs):
+                _, best_num_mask = avg_log.max(0)
+                yield {
+                    'relation': relation,
+                    'sub_uri': query_batch[i]['sub_uri'],
+                    'obj_uri': query_batch[i]['obj_uri'],
+                    'sub_label': query_batch[i]['sub_label'],
+                    'obj_label': query_batch[i]['obj_label'],
+                    'prompt': prompt,
+                    'num_mask': best_num_mask.item() + 1,
+                    'sentence': merge_subwords(inp_tensor[i, best_num_mask].cpu().numpy(), self.tokenizer, merge=False),
+                    'tokenized_obj_label_inflection': merge_subwords(obj_li[i], self.tokenizer, merge=False),
+                    'tokenized_obj_label': merge_subwords(obj_ori_li[i], self.tokenizer, merge=False),
+                    'pred': [merge_subwords(out_tensor[i, nm].masked_select(mask_ind[i, nm].eq(1)).cpu().numpy(),
+                                            self.tokenizer, merge=False) for nm in range(NUM_MASK)],
+                    'pred_log_prob': [logprob[i, nm].masked_select(mask_ind[i, nm].eq(1)).cpu().numpy().tolist()
+                                      for nm in range(NUM_MASK)],
+                }
+
+
+    def stream_iter(self, model, fin, fout):
+        '''
+        Probe facts (JSON lines with "sub_uri", "relation" or "predicate_id", and "obj_uri") read from `fin`
+        (stdin or a FIFO). Facts are flushed to the model when `batch_size` facts are collected or `stream_latency`
+        ms have passed since the first fact of the batch, and the predictions are written to `fout` right after.
+        Only a bounded number of lines is read ahead so memory does not grow with the stream.
+        '''
+        LANG = self.args.lang
+        lines = queue.Queue(maxsize=self.args.batch_size * 4)
 
-            obj_li: List[np.ndarray] = []
-            obj_ori_li: List[np.ndarray] = []
-            inp_tensor: List[torch.Tensor] = []
-            gold_with_mask_tensor: List[torch.Tensor] = []
+        def read():
+            for l in fin:
+                if l.strip():
+                    lines.put(l)
+            lines.put(None)
+        threading.Thread(target=read, daemon=True).start()
+
+        rel2prompt: Dict[str, str] = dict(zip(self.prompt_lang['pid'], self.prompt_lang[LANG]))
+        counter: Dict[str, int] = defaultdict(lambda: 0)
+        num_fact = num_batch = 0
+        eof = False
+        while not eof:
+            batch: List[Dict] = []
+            deadline = None
+            while len(batch) < self.args.batch_size:
+                try:
+                    l = lines.get(timeout=None if deadline is None else max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if l is None:
+                    eof = True
+                    break
+                if deadline is None:
+                    deadline = time.time() + self.args.stream_latency / 1000
+                batch.append(json.loads(l))
+
+            rel2queries: Dict[str, List[Dict]] = defaultdict(list)
+            for l in batch:
+                relation = l.get('relation', l.get('predicate_id'))
+                if relation not in rel2prompt or type(rel2prompt[relation]) is not str:
+                    counter['no_prompt'] += 1
+                    continue
+                if len(self.entity2lang.get(l['sub_uri'], {})) <= 0 or len(self.entity2lang.get(l['obj_uri'], {})) <= 0:
+                    counter['no_label'] += 1
+                    continue
+                if self.filter_query(l, counter):
+                    rel2queries[relation].append(l)
+            for relation, queries in rel2queries.items():
+                for result in self.predict_iter(model, relation, queries, rel2prompt[relation]):
+                    fout.write(str(LamaPredictions(result)) + '\n')
+                    num_fact += 1
+            fout.flush()
+            num_batch += len(batch) > 0
 
-            for query in query_batch:
-                # fill in subjects
-                instance_x, _ = self.prompt_model.fill_x(
-                    prompt, query['sub_uri'], query['sub_label'])
+        print('#fact {}\t#batch {}\t{}'.format(
+            num_fact, num_batch, '\t'.join('{} {}'.format(k, v) for k, v in sorted(counter.items()))))
+        self.print_oom_summary()
 
-                # fill in objects
-                instance_xys: List[str] = []
-                if self.args.use_gold:
-                    instance_xy, obj_label = self.prompt_model.fill_y(
-                        instance_x, query['obj_uri'], query['obj_label'])
-                    if self.args.dry_run and self.args.dry_run <= 50:
-                        print(instance_xy)
-                    instance_xys.append(instance_xy)
-                    nt_obj = len(tokenizer_wrap(self.tokenizer, LANG, False, obj_label))
-                    instance_xy_, _ = self.prompt_model.fill_y(
-                        instance_x, query['obj_uri'], query['obj_label'],
-                        num_mask=nt_obj, mask_sym=self.mask_label)
-                    gold_with_mask_tensor.append(
-                        torch.tensor(tokenizer_wrap(self.tokenizer, LANG, True, instance_xy_)))
-                else:
-                    for nm in range(NUM_MASK):
-                        if self.args.sent:
-                            instance_x = self.args.sent
-                        instance_xy, obj_label = self.prompt_model.fill_y(
-                            instance_x, query['obj_uri'], query['obj_label'],
-                            num_mask=nm + 1, mask_sym=self.mask_label)
-                        instance_xys.append(instance_xy)
-
-                # tokenize sentences
-                for instance_xy in instance_xys:
-                    # TODO: greek BERT does not seem to need this
-                    '''
-                    if self.args.model == 'el_bert_base':
-                        instance_xy = self.prompt_model.normalize(instance_xy, mask_sym=self.mask_label)
-                        obj_label = self.prompt_model.normalize(obj_label)
-                    '''
-                    if re.match('\[.*X.*\]', instance_xy) or re.match('\[.*Y.*\]', instance_xy):
-                        raise Exception('inflection missing from "{}"'.format(instance_xy))
-                    if not self.args.use_gold and instance_xy.find(self.mask_label) == -1:
-                        raise Exception('not contain mask tokens "{}"'.format(instance_xy))
-                    inp_tensor.append(torch.tensor(tokenizer_wrap(self.tokenizer, LANG, True, instance_xy)))
-
-                # tokenize gold object
-                obj = np.array(tokenizer_wrap(self.tokenizer, LANG, False, obj_label)).reshape(-1)
-                obj_li.append(obj)
-
-                # tokenize gold object (before inflection)
-                obj_ori = np.array(tokenizer_wrap(self.tokenizer, LANG, False, query['obj_label'])).reshape(-1)
-                obj_ori_li.append(obj_ori)
-
-                self.summary['numtoken2count'][len(obj)] += 1
-                if len(obj) > NUM_MASK or len(obj_ori) > NUM_MASK:
-                    self.summary['num_max_mask'] += 1
-                    logger.warning('{} is splitted into {}/{} tokens'.format(obj_label, len(obj), len(obj_ori)))
-
-            # SHAPE: (batch_size * num_mask, seq_len)
-            inp_tensor: torch.Tensor = torch.nn.utils.rnn.pad_sequence(
-                inp_tensor, batch_first=True, padding_value=self.pad)
-            attention_mask: torch.Tensor = inp_tensor.ne(self.pad).long()
-            if self.args.use_gold:
-                mask_ind: torch.Tensor = torch.nn.utils.rnn.pad_sequence(
-                    gold_with_mask_tensor, batch_first=True, padding_value=self.pad).eq(self.mask).long()
-            else:
-                mask_ind: torch.Tensor = inp_tensor.eq(self.mask).long()
 
-            if torch.cuda.is_available() and not self.args.no_cuda:
-                inp_tensor = inp_tensor.cuda()
-                attention_mask = attention_mask.cuda()
-                mask_ind = mask_ind.cuda()
+    def record_split(self, batch_size: int):
+        if self.summary['oom_batch_size'] is None or batch_size < self.summary['oom_batch_size']:
+            print('out of memory, split into batches of {} facts'.format(batch_size))
+            self.summary['oom_batch_size'] = batch_size
+        self.summary['num_oom'] += 1
 
-            yield query_batch, (inp_tensor, attention_mask, mask_ind), (obj_li, obj_ori_li)
 
-        if self.args.dry_run and self.args.dry_run <= 50:
-            print('')
+    def print_oom_summary(self):
+        if self.summary['num_oom'] > 0:
+            print('#out of memory {}\tsafe batch_size {}'.format(
+                self.summary['num_oom'], max(self.summary['oom_batch_size'], 1)))
 
 
     def iter(self, pids: Set[str]=None):
@@ -603,8 +2732,8 @@ class ProbeIterator(object):
                         JsonLogFileContext(json_log_filename) as json_file:
                     start_time = time.time()
 
-                    # get queries
-                    queries, (num_skip, not_exist, num_multi_word, num_single_word) = self.get_queries(fact_path)
+                    # get queries (loaded lazily in each pass)
+                    queries = LazyQueries(self, fact_path)
 
                     # get prompt
                     if self.args.prompts:
@@ -615,54 +2744,112 @@ class ProbeIterator(object):
 
                     correct_facts: Set[Tuple[str, str]] = set()
 
+                    # numbers of masks to decode
+                    nms: List[int] = list(range(NUM_MASK))
+                    if self.args.num_mask_mass is not None:
+                        prior = self.get_num_mask_prior(relation, queries, prompts[0])
+                        nms = self.select_num_masks(prior)
+                    if len(nms) < NUM_MASK:
+                        affected = sum(c for nt, c in prior.items() if nt - 1 not in nms)
+                        self.summary['num_prior_pruned'] += affected
+                        print('pid {}\tnum_mask {}\t#affected {}'.format(relation, [nm + 1 for nm in nms], affected))
+                        self.log_affected_facts(relation, queries, prompts[0], nms)
+
+                    # numbers of masks decoded by the cheap model of the cascade
+                    cheap_nms: List[int] = nms
+                    if self.args.cascade_mass is not None:
+                        cheap_nms = self.select_num_masks(
+                            self.get_num_mask_prior(relation, queries, prompts[0]), mass=self.args.cascade_mass)
+
+                    # candidates for ranking
+                    rank_candidates = None
+                    rank_results: List[Dict] = []
+                    if self.args.rank:
+                        self.load_gold_managers()
+                        rank_candidates = self.build_rank_candidates(queries, prompts[0])
+
+                    # constrain decoding to labels of objects
+                    label_trie: LabelTrie = None
+                    if self.args.constrain:
+                        label_trie = self.build_label_trie(relation, queries, prompts[0])
+                        # no need to decode numbers of masks without any label
+                        constrained_nms = [nm for nm in nms if label_trie.has_length(nm + 1)]
+                        if len(constrained_nms) > 0:
+                            nms = constrained_nms
+                        else:
+                            label_trie = None
+
                     for prompt in prompts:
                         acc, len_acc, acc_ori, len_acc_ori = [], [], [], []
                         for qbi, \
                             (query_batch,
                              (inp_tensor, attention_mask, mask_ind),
-                             (obj_li, obj_ori_li)) in tqdm(enumerate(self.batcher(queries, prompt)), disable=True):
+                             (obj_li, obj_ori_li),
+                             row_ind) in tqdm(enumerate(self.batcher(queries, prompt)), disable=True):
 
                             if self.args.dry_run:
                                 continue
 
-                            batch_size = len(query_batch)
+                            # duplicate queries share the same row
+                            batch_size = inp_tensor.size(0) // NUM_MASK
                             inp_tensor = inp_tensor.view(batch_size, NUM_MASK, -1)
                             attention_mask = attention_mask.view(batch_size, NUM_MASK, -1)
                             mask_ind = mask_ind.view(batch_size, NUM_MASK, -1)
 
-                            out_tensors: List[torch.LongTensor] = []
-                            logprobs: List[torch.Tensor] = []
-                            for nm in range(NUM_MASK):
-                                # decoding
-                                # SHAPE: (batch_size * num_mask, seq_len)
-                                out_tensor, logprob, iter = iter_decode_beam_search(
-                                    model, inp_tensor[:, nm, :], mask_ind[:, nm, :], attention_mask[:, nm, :],
-                                    restrict_vocab=self.restrict_vocab, mask_value=self.mask,
-                                    max_iter=self.args.max_iter, tokenizer=self.tokenizer,
-                                    init_method=self.args.init_method, iter_method=self.args.iter_method,
-                                    reprob=self.args.reprob, beam_size=args.beam_size)
-                                out_tensors.append(out_tensor)
-                                logprobs.append(logprob)
-                                iters.append(iter)
-                                if self.args.sent:
-                                    print('=== #mask {} ==='.format(nm + 1))
-                                    print(self.tokenizer.convert_ids_to_tokens(out_tensor[0].cpu().numpy()))
-                                    print((logprob[0] * mask_ind[0, nm].float()).sum().cpu().numpy())
-
+                            # decoding
+                            # SHAPE: (batch_size, num_mask, seq_len)
+                            self.row_forward_log = []
+                            if self.cascade_model is not None:
+                                out_tensor, logprob, iters_ = run_with_backoff(
+                                    lambda inp, att, mi: self.cascade_decode(
+                                        model, inp, att, mi, nms, cheap_nms, label_trie=label_trie),
+                                    [inp_tensor, attention_mask, mask_ind], on_split=self.record_split)
+                            else:
+                                out_tensor, logprob, iters_ = run_with_backoff(
+                                    lambda inp, att, mi: self.decode(model, inp, att, mi, nms, label_trie=label_trie),
+                                    [inp_tensor, attention_mask, mask_ind], on_split=self.record_split)
+                            iters.extend(iters_)
+                            if batch_size != len(query_batch):
+                                # identical inputs are decoded identically, so each extra fact sharing a row
+                                # saves all forwards of the row
+                                fanout = torch.zeros(batch_size).long().to(row_ind.device)
+                                fanout.index_add_(0, row_ind, torch.ones_like(row_ind))
+                                self.summary['num_dedup_forward'] += \
+                                    ((fanout - 1) * torch.cat(self.row_forward_log).to(fanout.device)).sum().item()
+                            self.row_forward_log = None
                             if self.args.sent:
+                                for nm in range(NUM_MASK):
+                                    print('=== #mask {} ==='.format(nm + 1))
+                                    print(self.tokenizer.convert_ids_to_tokens(out_tensor[0, nm].cpu().numpy()))
+                                    print((logprob[0, nm] * mask_ind[0, nm].float()).sum().cpu().numpy())
                                 break
 
-                            # SHAPE: (batch_size, num_mask, seq_len)
+                            if self.args.rank:
+                                rank_batch = self.rank(model, inp_tensor, attention_mask, mask_ind, row_ind,
+                                                       query_batch, relation, prompt, rank_candidates)
+                                rank_results.extend(rank_batch)
+
                             mask_ind = mask_ind.float()
-                            logprob = torch.stack(logprobs, 1)
-                            out_tensor = torch.stack(out_tensors, 1)
+
+                            # fan out predictions of unique inputs to all queries
+                            # SHAPE: (len(query_batch), num_mask, seq_len)
+                            if batch_size != len(query_batch):
+                                mask_ind = mask_ind.index_select(0, row_ind)
+                                logprob = logprob.index_select(0, row_ind)
+                                out_tensor = out_tensor.index_select(0, row_ind)
+                                inp_tensor = inp_tensor.index_select(0, row_ind)
 
                             # mask len norm
                             mask_len = mask_ind.sum(-1)
                             mask_len_norm = 1.0 if self.args.no_len_norm else mask_len
 
                             # find the best setting
-                            for i, avg_log in enumerate((logprob * mask_ind).sum(-1) / mask_len_norm):
+                            avg_logs = (logprob * mask_ind).sum(-1) / mask_len_norm
+                            if len(nms) < NUM_MASK:
+                                not_pruned = torch.zeros(NUM_MASK).to(avg_logs.device)
+                                not_pruned[nms] = 1
+                                avg_logs = avg_logs + not_pruned.log().unsqueeze(0)
+                            for i, avg_log in enumerate(avg_logs):
                                 lp, best_num_mask = avg_log.max(0)
                                 pred: np.ndarray = out_tensor[i, best_num_mask].masked_select(
                                     mask_ind[i, best_num_mask].eq(1)).detach().cpu().numpy().reshape(-1)
@@ -705,6 +2892,8 @@ class ProbeIterator(object):
                                     for nm in range(NUM_MASK):
                                         pred = logprob[i, nm].masked_select(
                                             mask_ind[i, nm].eq(1)).detach().cpu().numpy().reshape(-1)
+                                        if nm not in nms:  # pruned by the prior
+                                            pred = np.full_like(pred, float('-inf'))
                                         results.append(pred.tolist())
                                     return results
 
@@ -717,7 +2906,7 @@ class ProbeIterator(object):
                                     return results
 
                                 if self.args.pred_dir:
-                                    json_file.write(str(LamaPredictions({
+                                    json_file.write(str(LamaPredictions(dict({
                                         # raw data
                                         'relation': relation,
                                         'sub_uri': query_batch[i]['sub_uri'],
@@ -733,7 +2922,7 @@ class ProbeIterator(object):
                                         # predictions
                                         'pred': get_all_pred(),
                                         'pred_log_prob': get_all_pred_score(),
-                                    })) + '\n')
+                                    }, **(rank_batch[i] if self.args.rank else {})))) + '\n')
 
                                 '''
                                 if len(pred) == len(obj):
@@ -744,7 +2933,19 @@ class ProbeIterator(object):
 
                         print('pid {}\tacc {:.4f}/{:.4f}\tlen_acc {:.4f}/{:.4f}\tprompt {}'.format(
                             relation, np.mean(acc), np.mean(acc_ori), np.mean(len_acc), np.mean(len_acc_ori), prompt))
+                        if self.args.rank:
+                            print('pid {}\tmrr {:.4f}\t{}'.format(
+                                relation, np.mean([r['reciprocal_rank'] for r in rank_results]),
+                                '\t'.join('{} {:.4f}'.format(k, np.mean([r[k] for r in rank_results]))
+                                          for k in rank_results[0] if k.startswith('hits@'))
+                                if len(rank_results) else ''))
+                            self.summary['reciprocal_ranks'].extend([r['reciprocal_rank'] for r in rank_results])
+                            rank_results = []
 
+                    if self.args.dry_run and self.args.dry_run <= 50:
+                        queries.count()  # the batcher only consumed the first queries
+                    num_skip, not_exist, num_multi_word, num_single_word = [queries.counter[k] for k in [
+                        'num_skip', 'not_exist', 'num_multi_word', 'num_single_word']]
                     num_fact += len(queries)
                     num_correct_fact += len(correct_facts)
                     acc_for_rel = len(correct_facts) / (len(queries) + 1e-10)
@@ -758,6 +2959,10 @@ class ProbeIterator(object):
                         num_single_word, self.args.skip_single_word,
                         acc_for_rel, time.time() - start_time))
 
+                if self.args.pred_dir and self.args.pred_format == 'npz':
+                    jsonl_to_columnar(json_log_filename, os.path.join(self.args.pred_dir, relation + '.npz'))
+                    os.remove(json_log_filename)
+
             except Exception as e:
                 print('bug for pid {}'.format(relation))
                 print(e)
@@ -767,6 +2972,24 @@ class ProbeIterator(object):
         print('acc per fact {}/{}={:.4f}\tacc per relation {}\tavg iter {}\tnum_max_mask {}'.format(
             num_correct_fact, num_fact, num_correct_fact / (num_fact + 1e-10),
             np.mean(acc_li), np.mean(iters), self.summary['num_max_mask']))
+        if self.args.num_mask_mass is not None:
+            print('#facts affected by num_mask prior {}\t#pruned inputs {}'.format(
+                self.summary['num_prior_pruned'], self.summary['num_pruned_forward']))
+            self.save_num_mask_prior()
+        self.print_oom_summary()
+        if self.args.rank:
+            print('mrr {:.4f}'.format(np.mean(self.summary['reciprocal_ranks'])))
+        if self.args.prune_margin is not None:
+            print('#numbers of masks dropped by margin {}'.format(self.summary['num_margin_pruned']))
+        if self.cascade_model is not None:
+            print('#escalated {}/{}={:.4f}\tagreement {}/{}={:.4f}'.format(
+                self.summary['num_escalated'], self.summary['num_cascade'],
+                self.summary['num_escalated'] / (self.summary['num_cascade'] + 1e-10),
+                self.summary['num_cascade_agree'], self.summary['num_cascade_sample'],
+                self.summary['num_cascade_agree'] / (self.summary['num_cascade_sample'] + 1e-10)))
+        if self.args.dedup:
+            print('#dedup facts {}\t#saved row forwards {}'.format(
+                self.summary['num_dedup'], self.summary['num_dedup_forward']))
         if args.dry_run:
             for nt in range(1, np.max(list(self.summary['numtoken2count'].keys())) + 1):
                 _ = self.summary['numtoken2count'][nt]
@@ -787,6 +3010,23 @@ def load_entity_lang(filename: str) -> Dict[str, Dict[str, str]]:
     return entity2lang
 
 
+def load_hidden_export(export_dir: str, model: str, lang: str, relation: str) \
+        -> Tuple[np.memmap, Dict[Tuple[str, str, int], Tuple[int, int, int, int]]]:
+    '''
+    Load (without copying) the hidden states exported by `--export_dir` and the index from
+    (sub_uri, obj_uri, num_mask) to (mask_offset, mask_len, sub_offset, sub_len).
+    '''
+    prefix = os.path.join(export_dir, os.path.basename(model.rstrip('/')), lang, relation)
+    index = np.load(prefix + '.index.npz')
+    data = np.memmap(prefix + '.f16', dtype=np.float16, mode='r', shape=tuple(index['shape']))
+    key2offset: Dict[Tuple[str, str, int], Tuple[int, int, int, int]] = {}
+    for sub_uri, obj_uri, num_mask, mo, ml, so, sl in zip(
+            index['sub_uri'], index['obj_uri'], index['num_mask'],
+            index['mask_offset'], index['mask_len'], index['sub_offset'], index['sub_len']):
+        key2offset[(str(sub_uri), str(obj_uri), int(num_mask))] = (int(mo), int(ml), int(so), int(sl))
+    return data, key2offset
+
+
 def load_word_ids(ids: Union[np.ndarray, List[int]], tokenizer, pad_label: str) -> str:
     tokens: List[Tuple[str, int]] = []
     for t in tokenizer.convert_ids_to_tokens(ids):
@@ -822,210 +3062,13 @@ def iter_decode_beam_search(model,
     '''
     Masks must be consecutive.
     '''
-    assert init_method in {'all', 'left', 'confidence'}
-    assert iter_method in {'none', 'left', 'confidence', 'confidence-multi'}
-    bs, sl = inp_tensor.size(0), inp_tensor.size(1)
-    init_mask = inp_tensor.eq(mask_value).long()  # SHAPE: (batch_size, seq_len)
-    init_has_mask = init_mask.sum().item() > 0
-
-    if iter_method == 'confidence-multi':
-        number_to_mask = torch.unique(init_mask.sum(-1))
-        assert number_to_mask.size(0) == 1, 'this batch has different numbers of mask tokens'
-        number_to_mask = number_to_mask[0].item() - 1
-        assert max_iter == 0, 'do not need to set max_iter in confidence-multi setting'
-    elif iter_method == 'left':
-        leftmost_mask = init_mask * torch.cat([init_mask.new_ones((bs, 1)), 1 - init_mask], 1)[:, :-1]
-        number_to_mask = torch.unique(init_mask.sum(-1))
-        assert number_to_mask.size(0) == 1, 'this batch has different numbers of mask tokens'
-        number_to_mask: int = number_to_mask[0].item()
-        mask_offset: int = 0
-        has_modified: bool = False  # track wether modification happens during a left-to-right pass
-
-    # SHAPE: (<=beam_size, batch_size, seq_len)
-    out_tensors: List[torch.LongTensor] = inp_tensor.unsqueeze(0)
-    # tokens not considered have log prob of zero
-    out_logprobs: List[torch.Tensor] = torch.zeros_like(inp_tensor).float().unsqueeze(0)
-    iter: int = 0
-    stop: bool = False
-    while True and init_has_mask:  # skip when there is not mask initially
-        next_out_tensors = []
-        next_out_logprobs = []
-
-        # enumerate over all previous result
-        for out_tensor, out_logprob in zip(out_tensors, out_logprobs):
-            #print(tokenizer.convert_ids_to_tokens(out_tensor[0].cpu().numpy()))
-
-            # get input
-            if iter > 0:
-                if iter_method == 'none':
-                    inp_tensor = out_tensor
-                    if inp_tensor.eq(mask_value).long().sum().item() == 0:  # no mask
-                        stop = True
-                        break
-                elif iter_method == 'confidence':
-                    has_mask = out_tensor.eq(mask_value).any(-1).unsqueeze(-1).long()  # SHAPE: (batch_size, 1)
-                    inp_tensor = out_tensor.scatter(1, out_logprob.min(-1)[1].unsqueeze(-1), mask_value)
-                    # no need to insert mask when there are masks
-                    inp_tensor = out_tensor * has_mask + inp_tensor * (1 - has_mask)
-                elif iter_method == 'confidence-multi':
-                    has_mask = out_tensor.eq(mask_value).any(-1).unsqueeze(-1) # SHAPE: (batch_size, 1)
-                    all_has_mask = has_mask.all().item()
-                    assert all_has_mask == has_mask.any().item(), 'some samples have masks while the others do not'
-                    if not all_has_mask:
-                        if number_to_mask <= 0:
-                            stop = True
-                            break
-                        inp_tensor = out_tensor.scatter(1, (-out_logprob).topk(number_to_mask, dim=-1)[1], mask_value)
-                        init_method = 'all'
-                        number_to_mask -= 1
-                    else:
-                        inp_tensor = out_tensor
-                elif iter_method == 'left':
-                    has_mask = out_tensor.eq(mask_value).any(-1).unsqueeze(-1)  # SHAPE: (batch_size, 1)
-                    all_has_mask = has_mask.all().item()
-                    any_has_mask = has_mask.any().item()
-                    assert all_has_mask == any_has_mask, \
-                        'some samples have masks while the others do not'
-                    if not all_has_mask:  # no mask, should do refinement
-                        if mask_offset >= number_to_mask:
-                            mask_offset = 0
-                        if mask_offset == 0:  # restart when starting from the beginning
-                            has_modified = False
-                        cur_mask = torch.cat([leftmost_mask.new_zeros((bs, mask_offset)), leftmost_mask], 1)[:, :sl]
-                        cur_mask = cur_mask * init_mask
-                        inp_tensor = out_tensor * (1 - cur_mask) + mask_value * cur_mask
-                        mask_offset += 1
-                    else:
-                        inp_tensor = out_tensor
-                else:
-                    raise NotImplementedError
-
-            # predict
-            # SHAPE: (batch_size, seq_len)
-            mask_mask = inp_tensor.eq(mask_value).long()
-            logit = model_prediction_wrap(model, inp_tensor, attention_mask)
-            if restrict_vocab is not None:
-                logit[:, :, restrict_vocab] = float('-inf')
-            # SHAPE: (batch_size, seq_len, beam_size)
-            new_out_logprobs, new_out_tensors = logit.log_softmax(-1).topk(beam_size, dim=-1)
-
-            if init_method == 'confidence':
-                # mask out non-mask positions
-                new_out_logprobs = new_out_logprobs + mask_mask.unsqueeze(-1).float().log()
-                new_out_logprobs = new_out_logprobs.view(-1, sl * beam_size)
-                new_out_tensors = new_out_tensors.view(-1, sl * beam_size)
-
-            for b in range(beam_size):
-                if init_method == 'all':
-                    new_out_logprob = new_out_logprobs[:, :, b]
-                    new_out_tensor = new_out_tensors[:, :, b]
-                    # SHAPE: (batch_size, seq_len)
-                    changes = (out_tensor * mask_mask).ne(new_out_tensor * mask_mask)
-                elif init_method == 'left':  # only modify the left-most one.
-                    new_out_logprob = new_out_logprobs[:, :, b]
-                    new_out_tensor = new_out_tensors[:, :, b]
-                    # SHAPE: (batch_size, seq_len)
-                    changes = (out_tensor * mask_mask).ne(new_out_tensor * mask_mask)
-                    changes = changes & torch.cat([changes.new_ones((bs, 1)), ~changes], 1)[:, :-1]
-                elif init_method == 'confidence':  # only modify the most confident one.
-                    # SHAPE: (batch_size,)
-                    raw_lp, raw_ind = new_out_logprobs.max(-1)
-                    # SHAPE: (batch_size, 1)
-                    raw_lp, raw_ind = raw_lp.unsqueeze(-1), raw_ind.unsqueeze(-1)
-                    seq_ind = raw_ind // beam_size
-                    changes = mask_mask & torch.zeros_like(mask_mask).scatter(1, seq_ind, True)
-                    new_out_tensor = torch.zeros_like(out_tensor).scatter(1, seq_ind, new_out_tensors.gather(1, raw_ind))
-                    new_out_logprob = torch.zeros_like(out_logprob).scatter(1, seq_ind, raw_lp)
-                    changes = (out_tensor * changes.long()).ne(new_out_tensor * changes.long())
-                    # max for the next max in beam search
-                    new_out_logprobs = new_out_logprobs.scatter(1, raw_ind, float('-inf'))
-                else:
-                    raise NotImplementedError
-
-                # only modify tokens that have changes
-                changes = changes.long()
-                _out_tensor = out_tensor * (1 - changes) + new_out_tensor * changes
-                _out_logprob = out_logprob * (1 - changes.float()) + new_out_logprob.detach() * changes.float()
-
-                # involves heavy computation, where we re-compute probabilities for beam_size * beam_size samples
-                if reprob:
-                    _out_logprob = compute_likelihood(
-                        model, _out_tensor, _out_logprob,
-                        init_mask, attention_mask, restrict_vocab, mask_value=mask_value)
-                    _out_logprob = _out_logprob * (1 - _out_tensor.eq(mask_value).float())  # skip mask tokens
-
-                next_out_tensors.append(_out_tensor)
-                next_out_logprobs.append(_out_logprob)
-
-                '''
-                for i in range(bs):
-                    print(tokenizer.convert_ids_to_tokens(inp_tensor[i].cpu().numpy()))
-                    print(tokenizer.convert_ids_to_tokens(_out_tensor[i].cpu().numpy()))
-                input()
-                '''
-
-        if stop:
-            break
-
-        next_out_tensors = torch.stack(next_out_tensors, 0)
-        next_out_logprobs = torch.stack(next_out_logprobs, 0)
-        # tie breaking
-        next_out_logprobs = next_out_logprobs + \
-                            get_tie_breaking(int(next_out_logprobs.size(0))).view(-1, 1, 1).to(next_out_logprobs.device)
-
-        # dedup
-        not_dups = []
-        for i in range(bs):
-            abs = next_out_tensors.size(0)
-            # SHAPE: (all_beam_size, seq_len)
-            one_sample = next_out_tensors[:, i, :]
-            # SHAPE: (all_beam_size,)
-            inv = torch.unique(one_sample, dim=0, return_inverse=True)[1]
-            # SHAPE: (all_beam_size, all_beam_size)
-            not_dup = inv.unsqueeze(-1).ne(inv.unsqueeze(0)) | \
-                      (torch.arange(abs).unsqueeze(-1) <= torch.arange(abs).unsqueeze(0)).to(inv.device)
-            # SHAPE: (all_beam_size,)
-            not_dup = not_dup.all(-1)
-            not_dups.append(not_dup)
-        # SHAPE: (all_beam_size, batch_size)
-        not_dups = torch.stack(not_dups, -1)
-
-        # select top
-        # SHAPE: (all_beam_size, batch_size)
-        beam_score = (next_out_logprobs * init_mask.unsqueeze(0).float() +
-                      not_dups.unsqueeze(-1).float().log()).sum(-1)
-        # SHAPE: (beam_size, batch_size, seq_len)
-        beam_top = beam_score.topk(beam_size, dim=0)[1].view(-1, bs, 1).repeat(1, 1, sl)
-        next_out_logprobs = torch.gather(next_out_logprobs, 0, beam_top)
-        next_out_tensors = torch.gather(next_out_tensors, 0, beam_top)
-
-        # stop condition for other type of iter
-        if next_out_tensors.size(0) == out_tensors.size(0) and next_out_tensors.eq(out_tensors).all():
-            if iter_method != 'left':
-                stop = True
-        else:
-            if iter_method == 'left':
-                has_modified = True
-        # stop condition for 'left' iter
-        if iter_method == 'left' and not has_modified and mask_offset == number_to_mask:
-            # reach the last position and no modification happens during this iteration
-            stop = True
-
-        #print(next_out_tensors.ne(out_tensors).any(-1).any(0).nonzero())
-
-        out_tensors = next_out_tensors
-        out_logprobs = next_out_logprobs
-
-        iter += 1
-        if max_iter and iter >= max_iter:  # max_iter can be zero
-            stop = True
-        if stop:
-            break
-
-    out_tensor = out_tensors[0]
-    final_out_logprob = out_logprobs[0]
-
-    return out_tensor, final_out_logprob, iter
+    decoder = BeamSearchDecoder(
+        model, inp_tensor, raw_mask, attention_mask, restrict_vocab=restrict_vocab, mask_value=mask_value,
+        max_iter=max_iter, tokenizer=tokenizer, init_method=init_method, iter_method=iter_method,
+        reprob=reprob, beam_size=beam_size)
+    while not decoder.stop:
+        decoder.step()
+    return decoder.result()
 
 
 def compute_likelihood(model,
@@ -1035,6 +3078,7 @@ def compute_likelihood(model,
                        attention_mask: torch.LongTensor,  # SHAPE: (batch_size, seq_len))
                        restrict_vocab: List[int] = None,
                        mask_value: int=0,  # indicate which value is used for mask
+                       vocab_chunk: int = None,  # compute log probs in chunks of the vocab
                        ) -> torch.Tensor:  # SHAPE: (batch_size, seq_len)
     '''
     Masks must be consecutive.
@@ -1043,20 +3087,31 @@ def compute_likelihood(model,
     max_num_masks = mask_tensor.sum(-1).max().item()
     leftmost_mask = mask_tensor * torch.cat([mask_tensor.new_ones((bs, 1)), 1 - mask_tensor], 1)[:, :-1]
     logits = None
+    lp = None
     for i in range(max_num_masks):
         # SHAPE: (batch_size, seq_len)
         cur_mask = torch.cat([leftmost_mask.new_zeros((bs, i)), leftmost_mask], 1)[:, :seq_len] * mask_tensor
         inp_tensor_ = (1 - cur_mask) * inp_tensor + cur_mask * mask_value
         logit = model_prediction_wrap(model, inp_tensor_, attention_mask)
+        if vocab_chunk is not None:
+            # only keep the log probs of the target tokens instead of all logits
+            if restrict_vocab is not None:
+                logit[:, :, restrict_vocab] = float('-inf')
+            # SHAPE: (batch_size, seq_len)
+            lp_ = torch.gather(logit, 2, inp_tensor.unsqueeze(-1)).squeeze(-1) - chunked_logsumexp(logit, vocab_chunk)
+            lp_ = lp_.masked_fill(cur_mask.eq(0), 0)
+            lp = lp_ if lp is None else lp.masked_fill(cur_mask.ne(0), 0) + lp_
+            continue
         cur_mask = cur_mask.unsqueeze(-1).float()
         if logits is None:
             logits = (logit * cur_mask).detach()
         else:
             logits = (logits * (1 - cur_mask) + logit * cur_mask).detach()
-    if restrict_vocab is not None:
-        logits[:, :, restrict_vocab] = float('-inf')
-    lp = logits.log_softmax(-1)
-    lp = torch.gather(lp.view(-1, lp.size(-1)), 1, inp_tensor.view(-1).unsqueeze(-1)).view(bs, seq_len)
+    if vocab_chunk is None:
+        if restrict_vocab is not None:
+            logits[:, :, restrict_vocab] = float('-inf')
+        lp = logits.log_softmax(-1)
+        lp = torch.gather(lp.view(-1, lp.size(-1)), 1, inp_tensor.view(-1).unsqueeze(-1)).view(bs, seq_len)
     lp_tensor = (1 - mask_tensor).float() * lp_tensor + mask_tensor.float() * lp
     return lp_tensor.detach()
 
@@ -1064,6 +3119,27 @@ def compute_likelihood(model,
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='probe LMs with multilingual LAMA')
     parser.add_argument('--model', type=str, help='LM to probe file', default='mbert_base')
+    parser.add_argument('--all_layers', action='store_true',
+                        help='probe all layers with a single forward (predictions of each layer are stored separately)')
+    parser.add_argument('--export_dir', type=str, default=None,
+                        help='directory to export hidden states at mask positions and subject spans (float16 memmap)')
+    parser.add_argument('--export_layer', type=int, default=-1, help='the layer whose hidden states are exported')
+    parser.add_argument('--stream', type=str, default=None,
+                        help='read facts from stdin ("-") or a FIFO and write predictions to stdout')
+    parser.add_argument('--stream_latency', type=int, default=100,
+                        help='max ms to wait for a batch to fill up in streaming mode')
+    parser.add_argument('--cascade_model', type=str, default=None,
+                        help='a cheaper model to decode first in the cascade (the cascade uses the same model if only '
+                             'cascade_mass or cascade_quantize is specified)')
+    parser.add_argument('--cascade_mass', type=float, default=None,
+                        help='the cheap pass of the cascade only decodes the top numbers of masks covering this mass')
+    parser.add_argument('--cascade_quantize', action='store_true',
+                        help='quantize linear layers of the cheap model of the cascade (cpu only, torch>=1.3)')
+    parser.add_argument('--cascade_band', type=str, default='-3,-0.5',
+                        help='facts whose best length-normalized log prob is within "low,high" are re-decoded '
+                             'by the full model')
+    parser.add_argument('--cascade_sample', type=float, default=0.05,
+                        help='portion of the other facts also re-decoded to measure the agreement')
     parser.add_argument('--lm_layer_model', type=str,
                         help='LM from which the final lm layer is used', default=None)
     parser.add_argument('--lang', type=str, help='language to probe',
@@ -1104,18 +3180,61 @@ if __name__ == '__main__':
     parser.add_argument('--no_len_norm', action='store_true', help='not use length normalization')
     parser.add_argument('--reprob', action='store_true', help='recompute the prob finally')
     parser.add_argument('--beam_size', type=int, help='beam search size', default=1)
+    parser.add_argument('--rank', action='store_true',
+                        help='rank all objects of the relation for each fact (mrr and hits@k)')
+    parser.add_argument('--rank_topn', type=int, default=10,
+                        help='number of top candidates rescored by exact pseudo log-likelihood in ranking')
+    parser.add_argument('--rank_hits', type=str, default='1,10', help='hits@k to compute joined by ","')
+    parser.add_argument('--constrain', action='store_true',
+                        help='only generate labels (and aliases) of objects of the relation '
+                             '(masks are filled left to right, i.e., --init_method left)')
+    parser.add_argument('--prune_margin', type=float, default=None,
+                        help='drop numbers of masks whose avg log prob is lower than the best by this margin '
+                             'between iterations')
+    parser.add_argument('--num_mask_mass', type=float, default=None,
+                        help='only decode the most frequent numbers of masks (of gold objects) covering this mass')
+    parser.add_argument('--num_mask_prior', type=str, default=None,
+                        help='file to load/save the distribution of the number of tokens of gold objects')
+    parser.add_argument('--num_mask_affected', type=str, default=None,
+                        help='jsonl file to write the facts (sub_uri, obj_uri) that might be affected by '
+                             'num_mask_mass pruning')
+    parser.add_argument('--only_prior', action='store_true',
+                        help='compute the num_mask prior without loading the model')
 
     # others
     parser.add_argument('--use_gold', action='store_true', help='use gold objects')
+    parser.add_argument('--score_gold', action='store_true',
+                        help='compute the pseudo log-likelihood of gold objects and their aliases instead of decoding')
     parser.add_argument('--dry_run', type=int, help='dry run the probe to show inflection results', default=None)
     parser.add_argument('--log_dir', type=str, help='directory to vis prediction results', default=None)
     parser.add_argument('--pred_dir', type=str, help='directory to store prediction results', default=None)
+    parser.add_argument('--pred_format', type=str, choices=['jsonl', 'npz'], default='jsonl',
+                        help='format of prediction results (npz is columnar with float16 log probs)')
     parser.add_argument('--batch_size', type=int, help='the real batch size is this times num_mask', default=20)
+    parser.add_argument('--query_chunk', type=int, default=10000,
+                        help='number of facts loaded into memory at a time (duplicates are grouped within it)')
+    parser.add_argument('--dedup', action='store_true',
+                        help='run the model once for facts with identical inputs (e.g., N-M relations)')
     parser.add_argument('--no_cuda', action='store_true', help='not use cuda')
+    parser.add_argument('--vocab_chunk', type=int, default=None,
+                        help='compute log_softmax in chunks of the vocab to avoid full log prob tensors')
+    parser.add_argument('--reuse_buffer', action='store_true',
+                        help='reuse preallocated buffers for decoding outputs across batches')
+    parser.add_argument('--pack_len', type=int, default=None,
+                        help='pack multiple sentences into a row of at most this length')
+    parser.add_argument('--pack_check', action='store_true',
+                        help='check that the packed outputs match the unpacked ones')
     args = parser.parse_args()
 
+    pred_out = sys.stdout
+    if args.stream is not None:  # keep stdout only for predictions
+        sys.stdout = sys.stderr
+
     if (args.init_method != 'all' or args.iter_method != 'none') and args.max_iter:
         assert args.max_iter >= args.num_mask, 'the results will contain mask'
+    if args.constrain:  # positions filled in parallel or out of order can combine tokens of different labels
+        assert args.init_method == 'left' and args.iter_method in {'none', 'left', 'confidence'}, \
+            'constrained decoding needs --init_method left and --iter_method none/left/confidence'
     if args.sent:
         args.batch_size = 1
         args.pids = 'P19'
@@ -1127,9 +3246,16 @@ if __name__ == '__main__':
     tokenizer = get_tokenizer(args.lang, LM)
     probe_iter = ProbeIterator(args, tokenizer)
 
+    pids = set(args.pids.strip().split(',')) if args.pids is not None else None
+    if args.only_prior:
+        probe_iter.num_mask_prior_iter(pids=pids)
+        exit()
+
     # load model
     print('load model')
-    model = AutoModelWithLMHead.from_pretrained(LM)
+    # hidden states of all layers are only needed when probing all layers
+    model = AutoModelWithLMHead.from_pretrained(
+        LM, output_hidden_states=args.all_layers or args.export_dir is not None)
     if args.lm_layer_model is not None:
         llm = LM_NAME[args.lm_layer_model] if args.lm_layer_model in LM_NAME else args.lm_layer_model
         llm = AutoModelWithLMHead.from_pretrained(llm)
@@ -1137,5 +3263,56 @@ if __name__ == '__main__':
     model.eval()
     if torch.cuda.is_available() and not args.no_cuda:
         model.to('cuda')
-
-    probe_iter.iter(pids=set(args.pids.strip().split(',')) if args.pids is not None else None)
+    is_causal = isinstance(model, (GPT2LMHeadModel, OpenAIGPTLMHeadModel))
+    if args.cascade_model is not None or args.cascade_mass is not None or args.cascade_quantize:
+        # the cheap model of the cascade is a smaller checkpoint, a quantized copy, or the same model
+        if args.cascade_model is not None:
+            cheap = LM_NAME[args.cascade_model] if args.cascade_model in LM_NAME else args.cascade_model
+            cheap_tokenizer = get_tokenizer(args.lang, cheap)
+            cheap = AutoModelWithLMHead.from_pretrained(cheap)
+            cheap.eval()
+            # predictions of both models are compared as token ids
+            if type(cheap_tokenizer) != type(tokenizer) or cheap.config.vocab_size != model.config.vocab_size or \
+                    cheap_tokenizer.vocab_size != tokenizer.vocab_size or \
+                    cheap_tokenizer.convert_ids_to_tokens(list(range(tokenizer.vocab_size))) != \
+                    tokenizer.convert_ids_to_tokens(list(range(tokenizer.vocab_size))):
+                raise Exception('the cascade model {} does not share the tokenizer and vocab of {}'.format(
+                    args.cascade_model, args.model))
+        else:
+            cheap = model
+        if args.cascade_quantize:
+            if not hasattr(torch, 'quantization') or not hasattr(torch.quantization, 'quantize_dynamic'):
+                raise Exception('--cascade_quantize needs dynamic quantization (torch>=1.3), '
+                                'but torch {} is installed'.format(torch.__version__))
+            assert args.no_cuda or not torch.cuda.is_available(), 'quantized models only run on cpu'
+            cheap = torch.quantization.quantize_dynamic(copy.deepcopy(cheap), {torch.nn.Linear}, dtype=torch.qint8)
+        if torch.cuda.is_available() and not args.no_cuda:
+            cheap.to('cuda')
+        probe_iter.cascade_model = cheap
+        probe_iter.cascade_same_weights = args.cascade_model is None and not args.cascade_quantize
+    if args.pack_len:
+        assert not is_causal, 'packing is only for masked LMs'
+        assert not args.all_layers and args.export_dir is None, 'packing does not output hidden states'
+        model = PackedLM(model, max_len=args.pack_len, check=args.pack_check)
+
+    print('peak memory before probing {}'.format(get_peak_memory()))
+    with torch.no_grad():  # no autograd graph is needed during probing
+        if args.stream is not None:
+            if args.stream == '-':
+                probe_iter.stream_iter(model, sys.stdin, pred_out)
+            else:
+                with open(args.stream) as fin:
+                    probe_iter.stream_iter(model, fin, pred_out)
+        elif is_causal:
+            probe_iter.causal_iter(model, pids=pids)
+        elif args.all_layers:
+            probe_iter.layer_iter(model, pids=pids)
+        elif args.export_dir is not None:
+            probe_iter.export_iter(model, pids=pids)
+        elif args.score_gold:
+            probe_iter.score_gold_iter(model, pids=pids)
+        else:
+            probe_iter.iter(pids=pids)
+    print('peak memory after probing {}'.format(get_peak_memory()))
+    if args.pack_len:
+        print('#rows {}\t#packed rows {}'.format(model.num_row, model.num_packed_row))
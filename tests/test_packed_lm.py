@@ -0,0 +1,90 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+import pytest
+import torch
+import probe
+from probe import PackedLM, BeamSearchDecoder
+
+
+class ToyMaskedLM(torch.nn.Module):
+    '''
+    A one-layer attention LM which accepts 2-D or 3-D attention masks and position ids like BERT.
+    '''
+    def __init__(self, vocab_size: int=30, dim: int=16, max_len: int=64, seed: int=0):
+        super().__init__()
+        g = torch.Generator().manual_seed(seed)
+        self.emb = torch.nn.Parameter(torch.randn(vocab_size, dim, generator=g))
+        self.pos = torch.nn.Parameter(torch.randn(max_len, dim, generator=g))
+        self.att = torch.nn.Parameter(torch.randn(dim, dim, generator=g) / dim)
+        self.out = torch.nn.Parameter(torch.randn(dim, vocab_size, generator=g))
+        # bias removed by model_prediction_wrap for transformers 2.4
+        self.cls = torch.nn.Module()
+        self.cls.predictions = torch.nn.Module()
+        self.cls.predictions.bias = torch.nn.Parameter(torch.zeros(vocab_size))
+
+    def forward(self, inp, attention_mask=None, position_ids=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(inp)
+        if position_ids is None:
+            position_ids = torch.arange(inp.size(1)).unsqueeze(0).expand_as(inp)
+        if attention_mask.dim() == 2:
+            attention_mask = attention_mask.unsqueeze(1).expand(-1, inp.size(1), -1)
+        h = self.emb[inp] + self.pos[position_ids]
+        score = (h @ self.att @ h.transpose(1, 2)).masked_fill(attention_mask.eq(0), -1e9)
+        h = torch.tanh(score.softmax(-1) @ h) + h
+        return (h @ self.out,)
+
+
+MASK = 1
+
+
+def make_batch(seed: int=0, batch_size: int=12, max_len: int=10):
+    g = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(5, max_len + 1, (batch_size,), generator=g).tolist()
+    inp = torch.zeros(batch_size, max_len).long()
+    attention_mask = torch.zeros(batch_size, max_len).long()
+    for i, l in enumerate(lengths):
+        inp[i, :l] = torch.randint(2, 30, (l,), generator=g)
+        inp[i, 1:4] = MASK
+        attention_mask[i, :l] = 1
+    return inp, attention_mask
+
+
+@pytest.fixture(autouse=True)
+def transformers_version(monkeypatch):
+    monkeypatch.setattr(probe.transformers, '__version__', '2.4.1')
+
+
+@pytest.mark.parametrize('max_len', [10, 24, 64])
+def test_packed_logits_match_unpacked(max_len):
+    model = ToyMaskedLM()
+    packed = PackedLM(model, max_len=max_len)
+    inp, attention_mask = make_batch()
+    with torch.no_grad():
+        ref = model(inp, attention_mask=attention_mask)[0]
+        out = packed(inp, attention_mask=attention_mask)[0]
+    valid = attention_mask.unsqueeze(-1).float()
+    assert ((out - ref) * valid).abs().max().item() <= 1e-5
+    assert packed.num_packed_row <= packed.num_row
+
+
+@pytest.mark.parametrize('init_method,iter_method,beam_size', [
+    ('all', 'none', 1), ('left', 'left', 3), ('confidence', 'confidence', 2)])
+def test_packed_decoding_matches_unpacked(init_method, iter_method, beam_size):
+    model = ToyMaskedLM()
+    inp, attention_mask = make_batch(seed=1)
+    results = []
+    for m in [model, PackedLM(model, max_len=32)]:
+        with torch.no_grad():
+            decoder = BeamSearchDecoder(
+                m, inp, inp.eq(MASK).long(), attention_mask, mask_value=MASK, max_iter=5,
+                init_method=init_method, iter_method=iter_method, beam_size=beam_size)
+            while not decoder.stop:
+                decoder.step()
+            results.append(decoder.result())
+    (ref_out, ref_logprob, ref_iter), (out, logprob, iter) = results
+    assert out.eq(ref_out).all().item()
+    assert (logprob - ref_logprob).abs().max().item() <= 1e-5
+    assert iter == ref_iter